@@ -0,0 +1,25 @@
+import rpg
+
+# Compare how long it takes to copy one frame into the framebuffer
+# at each colormode. 24 bit pixels are 3 bytes wide and so straddle
+# word boundaries, while 32 bit pixels are copied as whole words.
+# No Screen is needed, so this can be run from the desktop.
+
+resolution = (1280, 720)
+frame_budget = 1e6 / 60   #microseconds per refresh on a 60 Hz monitor
+
+results = rpg.benchmark_frame_copy(resolution, colormodes=(16, 24, 32), n_frames=300)
+
+for colormode, perf in results.items():
+    print("%2d bpp: %7.1f +/- %6.1f us per frame (%4.1f%% of a 60 Hz frame)"
+          %(colormode, perf.mean_frame_time, perf.stddev_frame_time,
+            100 * perf.mean_frame_time / frame_budget))
+
+# Gratings and raws stored as gray use one byte per pixel, and are
+# expanded through a palette to the Screen's colormode as they are copied.
+results = rpg.benchmark_frame_copy(resolution, colormodes=(16, 24, 32), n_frames=300, gray=True)
+
+for colormode, perf in results.items():
+    print("gray -> %2d bpp: %7.1f +/- %6.1f us per frame (%4.1f%% of a 60 Hz frame)"
+          %(colormode, perf.mean_frame_time, perf.stddev_frame_time,
+            100 * perf.mean_frame_time / frame_budget))
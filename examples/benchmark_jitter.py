@@ -0,0 +1,15 @@
+import rpg
+
+# Compare the interframe intervals of the display loop with real-time
+# mode off and on. Must be run as root (or with CAP_SYS_NICE and
+# CAP_IPC_LOCK). Start whatever else normally runs during an experiment
+# first, since jitter comes from competing for the CPU. For the best
+# results boot with isolcpus=3 and pin the display thread to core 3.
+
+with rpg.Screen((1280, 720)) as screen:
+    results = screen.benchmark_jitter(n_frames=600, priority=50, cpu=3)
+
+for mode, perf in results.items():
+    print("real-time %-3s: %8.1f +/- %6.1f us, 99th percentile %8.1f us, max %8.1f us, %d missed frames"
+          %(mode, perf.mean_interframe, perf.stddev_interframe,
+            perf.percentile_99, perf.max_interframe, perf.missed_frames))
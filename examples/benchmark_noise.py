@@ -0,0 +1,20 @@
+import rpg
+
+# Check that sparse noise and checkerboards can be generated within a
+# refresh at each colormode. Generation cost grows with the number of
+# cells, drawing costs about one frame copy. No Screen is needed.
+
+resolution = (1280, 720)
+frame_budget = 1e6 / 60   #microseconds per refresh on a 60 Hz monitor
+
+stimuli = {
+    "sparse 32x18": rpg.Noise(seed=1, grid=(32, 18), density=0.05, n_frames=600),
+    "checkerboard 64x36": rpg.Noise(seed=1, grid=(64, 36), density=0.5, kind="checkerboard", n_frames=600),
+    "checkerboard 160x90": rpg.Noise(seed=1, grid=(160, 90), density=0.5, kind="checkerboard", n_frames=600),
+}
+
+for name, noise in stimuli.items():
+    for colormode, perf in rpg.benchmark_noise(noise, resolution).items():
+        print("%-20s %2d bpp: %7.1f +/- %6.1f us per frame (%4.1f%% of a 60 Hz frame)"
+              %(name, colormode, perf.mean_frame_time, perf.stddev_frame_time,
+                100 * perf.mean_frame_time / frame_budget))
@@ -0,0 +1,37 @@
+import math
+import threading
+import time
+
+import rpg
+
+# Drive a drifting gabor around a circle from a second thread, as an
+# eye tracker or treadmill would from another process, and report how
+# many frames each update took to reach the screen.
+
+params = rpg.ParameterBlock("example", contrast=1)
+done = threading.Event()
+
+def writer():
+    # Update faster than the refresh rate; updates replaced before the
+    # next frame starts are simply not shown
+    start = time.perf_counter()
+    while not done.is_set():
+        t = time.perf_counter() - start
+        params.update(x=640 + 300 * math.cos(t), y=360 + 200 * math.sin(t),
+                      contrast=0.5 + 0.5 * math.sin(3 * t))
+        time.sleep(0.004)
+
+thread = threading.Thread(target=writer)
+thread.start()
+with rpg.Screen((1280, 720)) as screen:
+    perf = screen.display_closed_loop(params, {"duration": 10, "spac_freq": 0.1,
+                                               "temp_freq": 1, "percent_sigma": 4})
+    screen.display_greyscale(screen.background)
+done.set()
+thread.join()
+params.unlink()
+
+print("interframe %.1f +/- %.1f us" %(perf.mean_interframe, perf.stddev_interframe))
+print("%d updates written, %d displayed" %(perf.updates_written, perf.updates_displayed))
+print("latency from update to display: mean %.2f frames, max %.2f frames"
+      %(perf.mean_latency, perf.max_latency))
@@ -0,0 +1,30 @@
+import os
+
+import rpg
+
+# Build a centre and a surround as separate small patches, then show the
+# surround alone for half a second before the centre appears over it.
+# The patches are built at their own size, with the Screen's width given
+# so that spatial frequency is in cycles per degree of the whole Screen.
+
+screen_width = 1280
+surround = {"duration": 2, "angle": 0, "spac_freq": 0.1, "temp_freq": 1,
+            "percent_diameter": 100, "resolution": (400, 400),
+            "screen_width": screen_width, "colormode": "modulation"}
+centre = dict(surround, angle=90, resolution=(150, 150))
+
+directory = os.path.expanduser("~/patches")
+os.makedirs(directory, exist_ok=True)
+rpg.build_masked_grating(os.path.join(directory, "surround"), surround)
+rpg.build_masked_grating(os.path.join(directory, "centre"), centre)
+
+with rpg.Screen((screen_width, 720)) as screen:
+    surround_grating = screen.load_grating(os.path.join(directory, "surround"))
+    centre_grating = screen.load_grating(os.path.join(directory, "centre"))
+    perf = screen.display_patches([
+        rpg.Patch(surround_grating, 640, 360, contrast=0.5),
+        rpg.Patch(centre_grating, 640, 360, start=30, frames=90),
+    ])
+    screen.display_greyscale(screen.background)
+
+print("interframe %.1f +/- %.1f us" %(perf.mean_interframe, perf.stddev_interframe))
@@ -18,9 +18,19 @@ import os
 import sys
 import hashlib
 import random
+import asyncio
+import statistics
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 GratPerfRec = namedtuple("GratingPerformanceRecord",["mean_interframe","stddev_interframe","start_time"])
+FramePerfRec = namedtuple("FramePerformanceRecord",["mean_frame_time","stddev_frame_time"])
+ClosedLoopRec = namedtuple("ClosedLoopRecord",["mean_interframe","stddev_interframe","start_time",
+                                              "updates_written","updates_displayed","mean_latency","max_latency"])
+Patch = namedtuple("Patch",["stimulus","x","y","start","frames","contrast"], defaults=(0, None, None))
+JitterRec = namedtuple("JitterRecord",["mean_interframe","stddev_interframe","max_interframe","percentile_99","missed_frames"])
+DirectoryPlan = namedtuple("DirectoryPlan",["files","memory","available"])
 
 GRAY   = 127
 BLACK  = 0
@@ -32,8 +42,20 @@ SQUARE = 0b0000
 #probably don't change them unless you're confident you know what you're doing!
 RGB888MODE =  0b0010
 RGB565MODE =  0b0000
+XRGB8888MODE = 0b100000
+#Gratings and raws may also be stored as 8 bit grey levels, which are
+#expanded through a palette to the Screen's colormode as they are displayed
+GRAY8MODE = 0b1000000
+#Gratings may be stored as modulation about the background, with their
+#contrast and background chosen each time they are displayed
+MOD8MODE = 0b10000000
 
 import _rpigratings as rpigratings
+from rpg.pool import StimulusPool
+from rpg.closedloop import ParameterBlock
+from rpg.noise import Noise
+from rpg import catalog
+from rpg.catalog import read_catalog
 
 
 
@@ -61,7 +83,14 @@ def build_grating(filename, options):
 
           "background": 127,   #
           "resolution": (1280, 720)   #resolution of gratings. Must match Screen()
+          "screen_width": 1280   #width of the Screen, if resolution is smaller
+                                 #to build a patch for Screen.display_patches()
           "waveform": rpg.SINE #rpg.SQUARE (square wave) or rpg.SINE (sine wave)
+          "colormode": 16    #16, 24 or 32 to match Screen(), or "gray" to store
+                             #one byte per pixel, playable on any Screen, or
+                             #"modulation" to store one byte per pixel and choose
+                             #contrast and background in Screen.display_grating(),
+                             #in which case "contrast" and "background" must not be set
 
     For smooth propogation of the grating, the pixels-per-frame speed
     is truncated to the nearest interger; low resolutions combined with
@@ -80,7 +109,9 @@ def build_grating(filename, options):
                               options["spac_freq"], options["temp_freq"],
                               options["contrast"], options["background"],
                               options["resolution"][0], options["resolution"][1],
-                              options["waveform"], 0, 0, 0, 0, 0, options["colormode"])
+                              options["waveform"], 0, 0, 0, 0, 0, options["colormode"],
+                              options["screen_width"])
+    catalog.record(filename, "grating")
 
 def build_masked_grating(filename, options):
     """
@@ -110,6 +141,8 @@ def build_masked_grating(filename, options):
           "contrast": 1,     #maximum contrast
           "background": 127,   #
           "resolution": (1280, 720)   #resolution of gratings. Must match Screen()
+          "screen_width": 1280   #width of the Screen, if resolution is smaller
+                                 #to build a patch for Screen.display_patches()
           "waveform": rpg.SINE #rpg.SQUARE (square wave) or rpg.SINE (sine wave)
 
     Returns:
@@ -125,7 +158,9 @@ def build_masked_grating(filename, options):
                               options["resolution"][0], options["resolution"][1],
                               options["waveform"], 0, options["percent_diameter"],
                               options["percent_center_left"], options["percent_center_top"],
-                              options["percent_padding"], options["colormode"])
+                              options["percent_padding"], options["colormode"],
+                              options["screen_width"])
+    catalog.record(filename, "grating")
 
 def build_gabor(filename, options):
     """
@@ -155,6 +190,8 @@ def build_gabor(filename, options):
           "contrast": 1,     #maximum contrast
           "background": 127,   #
           "resolution": (1280, 720)   #resolution of gratings. Must match Screen()
+          "screen_width": 1280   #width of the Screen, if resolution is smaller
+                                 #to build a patch for Screen.display_patches()
           "waveform": rpg.SINE #rpg.SQUARE (square wave) or rpg.SINE (sine wave)
 
     Returns:
@@ -169,7 +206,9 @@ def build_gabor(filename, options):
                               options["resolution"][0], options["resolution"][1],
                               options["waveform"], options["percent_sigma"], 0,
                               options["percent_center_left"], options["percent_center_top"],
-                              0, options["colormode"])
+                              0, options["colormode"],
+                              options["screen_width"])
+    catalog.record(filename, "grating")
 
 
 
@@ -194,7 +233,8 @@ def build_list_of_gratings(func_string, directory_path, options):
     Files will be saved with names matching the element of the list they are generated
     from. e.g. if generated with options["angle"] = [0 45 90], then there will be three
     files generated with names "0", "45" and "90" in the directory specificied in 
-    directory path.
+    directory path. Each is also recorded in the directory's catalog, so that
+    Screen.plan_directory() can check the set before any of it is loaded.
 
     Returns:
       Nothing
@@ -244,26 +284,166 @@ def convert_raw(filename, new_filename, n_frames, width, height, refreshes_per_f
       new_filename: the exact path of the converted file to be produced e.g.
         "~/raws/raw1.raw".
       n_frames: the number of frames in the raw video/image
-      width: the width of the original file in pixels
+      width: the width of the original file in pixels. May be smaller than
+        the Screen, see Screen.load_raw.
       height: the height of the original file in pixels
       refreshes_per_frame: the number of monitor refreshes to display each frame for.
         For a movie to display at 30 frames per second, on a 60 Hz monitor, this would
         be 2. On a 75 Hz monitor, 25 frames per second would be acheived by setting this
         to 3. If a still image is displayed, if you require it displayed for X seconds,
         and your monitor refresh rate is R Hz, then this value should be set to X * R.
-      colormode: number of bits per pixel; must be 16 or 24.
+      colormode: number of bits per pixel; must be 16, 24 or 32, or "gray"
+        (8) to store the luminance of each pixel in a single byte. Gray
+        files are smaller and play on a Screen of any colormode.
     Returns:
       None
     """
-    if colormode in {0, 16, "rgb565", "RGB565", "565", "16"}:
-        colormode = RGB565MODE
-    elif colormode in {1, 24, "24", "rgb888", "RGB888", "888"}:
-        colormode = RGB888MODE
-    else:
-        raise ValueError("colormode must be 16 or 24, not %s"%op["colormode"].__repr__)
+    colormode = _parse_colormode(colormode, allow_gray=True)
     filename = os.path.expanduser(filename)
     new_filename = os.path.expanduser(new_filename)
     rpigratings.convertraw(filename, new_filename, n_frames, width, height, refreshes_per_frame,colormode)
+    catalog.record(new_filename, "raw")
+
+def ingest_raw(source, new_filename, width, height, refreshes_per_frame, colormode = 16, n_frames = None, chunk_frames = 8):
+    """
+    Converts a stream of raw video frames, saved as uint8: RGBRGBRGB...
+      starting in the top left pixel and proceeding rowwise, into a form
+      readily displayed by RPG. Unlike convert_raw, the movie does not need
+      to be on disc first: frames are read and converted chunk_frames at a
+      time, so memory use does not grow with the length of the movie. The
+      output of a decoder can be piped straight in, e.g.
+
+        ffmpeg -i movie.mp4 -f rawvideo -pix_fmt rgb24 -s 1280x720 - | rpg-ingest - ~/raws/movie.raw 1280 720 2
+
+    Args:
+      source: a binary file-like object with a read() method, such as
+        sys.stdin.buffer or the stdout of a subprocess, or a filename.
+        "-" reads from standard input.
+      new_filename: the exact path of the converted file to be produced.
+      width: the width of the frames in pixels
+      height: the height of the frames in pixels
+      refreshes_per_frame: the number of monitor refreshes to display each
+        frame for, as for convert_raw.
+      colormode: as for convert_raw.
+      n_frames: the number of frames to display. Defaults to every frame read.
+      chunk_frames: the number of frames read and converted at a time.
+    Returns:
+      The number of frames read
+    """
+    colormode = _parse_colormode(colormode, allow_gray=True)
+    new_filename = os.path.expanduser(new_filename)
+    close_source = False
+    if source == "-":
+        source = sys.stdin.buffer
+    elif isinstance(source, str):
+        source = open(os.path.expanduser(source), "rb")
+        close_source = True
+    frame_size = 3 * width * height
+    view = memoryview(bytearray(frame_size * chunk_frames))
+    frames_read = 0
+    try:
+        with open(new_filename, "wb") as new_file:
+            #The header records no frames until the stream has ended, so a
+            #file left by an interrupted ingest is rejected when loaded
+            new_file.write(rpigratings.raw_header(width, height, 0, 0, refreshes_per_frame, colormode))
+            while True:
+                filled = _read_into(source, view)
+                whole_frames = filled // frame_size
+                if whole_frames:
+                    new_file.write(rpigratings.convert_chunk(view[:whole_frames * frame_size], colormode))
+                    frames_read += whole_frames
+                if filled < len(view):
+                    break
+            if filled % frame_size:
+                print("Discarding %d bytes at the end of the stream, less than one frame" %(filled % frame_size))
+            if frames_read == 0:
+                raise ValueError("No complete %d x %d frames were read" %(width, height))
+            if n_frames is None:
+                n_frames = frames_read
+            elif n_frames > frames_read:
+                print("Only %d frames were read, n_frames reduced from %d" %(frames_read, n_frames))
+                n_frames = frames_read
+            new_file.seek(0)
+            new_file.write(rpigratings.raw_header(width, height, frames_read, n_frames, refreshes_per_frame, colormode))
+    finally:
+        if close_source:
+            source.close()
+    catalog.record(new_filename, "raw")
+    return frames_read
+
+def _read_into(source, view):
+    """
+    Internal function filling view from source, stopping early only at
+    the end of the stream. Pipes return short reads, so a single read()
+    is not enough.
+
+    Returns:
+      The number of bytes read
+    """
+    filled = 0
+    readinto = getattr(source, "readinto", None)
+    while filled < len(view):
+        if readinto is not None:
+            n = readinto(view[filled:])
+        else:
+            chunk = source.read(len(view) - filled)
+            n = len(chunk)
+            view[filled:filled + n] = chunk
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def benchmark_frame_copy(resolution=(1280, 720), colormodes=(16, 24, 32), n_frames=300, gray=False):
+    """
+    Time the loop that copies each frame into the framebuffer, for each
+    colormode, without needing a Screen. Useful for choosing a colormode:
+    the copy must finish well within one refresh (16.7 ms at 60 Hz).
+
+    Args:
+      resolution: (width, height) of the frames copied
+      colormodes: the colormodes to compare, as accepted by Screen()
+      n_frames: number of frames copied for each colormode
+      gray: if True, time frames stored as 8 bit grey levels instead,
+        which are expanded through a palette as they are copied. Gratings
+        stored as modulation are expanded the same way, through their
+        per-trial contrast and gamma lookup table, and take the same time.
+
+    Returns:
+      dictionary of colormode to FramePerfRec named tuple, with the fields
+      mean_frame_time and stddev_frame_time in microseconds
+    """
+    perf = {}
+    for colormode in colormodes:
+        tag = _parse_colormode(colormode)
+        source = GRAY8MODE if gray else tag
+        perf[colormode] = FramePerfRec(*rpigratings.benchmark_copy(resolution[0], resolution[1],
+                                                                   tag, n_frames, source))
+    return perf
+
+
+def benchmark_noise(noise, resolution=(1280, 720), colormodes=(16, 24, 32)):
+    """
+    Time generating and drawing each frame of a Noise stimulus, for each
+    colormode, without needing a Screen. Generation must finish well
+    within the time each frame is held for (16.7 ms at 60 Hz with hold 1).
+
+    Args:
+      noise: an rpg.Noise. n_frames frames are timed for each colormode.
+      resolution: (width, height) of the frames drawn
+      colormodes: the colormodes to compare, as accepted by Screen()
+
+    Returns:
+      dictionary of colormode to FramePerfRec named tuple, with the fields
+      mean_frame_time and stddev_frame_time in microseconds
+    """
+    perf = {}
+    for colormode in colormodes:
+        perf[colormode] = FramePerfRec(*rpigratings.benchmark_noise(resolution[0], resolution[1],
+                                                                    _parse_colormode(colormode),
+                                                                    noise._args()))
+    return perf
 
 
 class Screen:
@@ -283,33 +463,37 @@ class Screen:
           resolution of the physical display; the linux framebuffer device is
           automatically scaled up to fit the physical display.
 
-        The resolution of this object MUST match the resolution of any
-          grating animation files created by draw_grating; if the resolution
-          of the animation is smaller pixels will simply be misaligned, but
-          if the animation is larger then attempting to play it will cause a
-          segmentation fault.
+        Grating and raw files may not be larger than this object's
+          resolution. Smaller files are scaled up by the largest whole
+          number that fits (e.g. 640x360 is doubled on a 1280x720 Screen)
+          and centred, with the background shown around them, so they can
+          be built and stored at a lower resolution.
 
         Args:
           resolution: a tuple of the desired width of the display
             resolution as (width, height). Defaults to (1280,720).
           background: value between 0 and 255 for the background 
+          colormode: bits per pixel, 16 (RGB565), 24 (RGB888) or 32 (XRGB8888).
+            32 bit pixels are word aligned, so frames copy faster than at 24.
          """
+        self.isopen = False
+        self._display_executor = None
+        self._display_thread_id = None
+        self._realtime_state = None
+        self.realtime = None
+        self.gamma_table = None
         if (background < 0 or background > 255):
                 raise ValueError("Background must be between 0 and 255")
 
-        if colormode in {0, 16, "565", "rgb565", "RGB565", "16"}:
-                colormode = 0
-        elif colormode in {1, 24, "888", "rgb888", "RGB888", "24"}:
-                colormode = 2
-        else:
-                raise ValueError("Colormode must be 16 or 24, not %s"%colormode.__repr__)
+        colormode = _parse_colormode(colormode)
 
         self.background = background
         self.capsule = rpigratings.init(resolution[0],resolution[1], colormode)
         self.colormode = colormode
+        self.resolution = (resolution[0], resolution[1])
         self.isopen = True
 
-    def load_grating(self,filename):
+    def load_grating(self,filename, pool=None):
         """
         Load a grating file called filename into local memory. Once loaded
         in this way, display_grating() can be called to display the loaded file
@@ -318,33 +502,133 @@ class Screen:
         Args:
           filename: string containing the exact filename, either as an absolute
             or relative, e.g. "~/gratings/grat1.dat" or "home/pi/grating/grat1.dat"
+          pool: optional StimulusPool. The grating is attached from the pool's
+            shared memory, copying it into the pool first only if no up to date
+            copy is pooled yet, instead of being read into private memory.
         Returns:
           Grating object
         """
         filename = os.path.expanduser(filename)
-        return Grating(self,filename)
+        return Grating(self,filename, pool)
 
-    def load_raw(self, filename):
+    def load_raw(self, filename, pool=None):
         """
         Load a raw file into local memory. Once loaded in this way, the returned
         object can be displayed with display_raw()
 
+        Raws smaller than the Screen are kept at their own resolution, and
+        scaled up with nearest neighbour sampling as they are displayed, so
+        memory use and load time depend on the resolution of the raw. The
+        scale factor used is the raw object's scale attribute.
+
+        Each frame is compared with the frame two before it as it is
+        loaded, in 16 x 16 pixel tiles, and display_raw() only redraws
+        the tiles that changed. The raw object's changed_fraction
+        attribute is the mean fraction of each frame that is redrawn.
+        A raw attached from a pool is only compared the first time; the
+        map of changed tiles is saved with the pool entry, and later
+        attachments, from any process, share it.
+
         Args:
           filename: string containint the exact filename, either as an absolute
             or relative path.
+          pool: optional StimulusPool to attach the raw from, as for load_grating()
         Returns:
           Raw object
         """
 
         filename = os.path.expanduser(filename)
-        return Raw(self, filename)
+        return Raw(self, filename, pool)
+
+    def load_grating_set(self, gratings, share_frames=True):
+        """
+        Load a set of gratings, such as a directory built with
+        build_list_of_gratings(). A grating whose every frame is
+        identical, byte for byte (compared with memcmp once hashes
+        match), to some frame of a grating already in the set is not
+        kept in memory twice: it plays the other grating's frames in its
+        own order. Any such grating is shared, whatever it shows. In a
+        sine wave orientation set this pairs opposite directions (0 and
+        180 degrees hold the same frames in reverse order), roughly
+        halving the memory the set needs, as well as gratings that differ
+        only in phase. Square wave gratings are one pixel out between
+        directions, so their opposite directions usually do not match.
 
-    def display_grating(self, grating, trigger_pin = 0):
+        Args:
+          gratings: a directory containing only gratings, which is
+            checked with plan_directory() before any are loaded, or a
+            list of grating filenames
+          share_frames: set to False to load every grating in full
+        Returns:
+          GratingSet, from which gratings are indexed by file name
+        """
+        if isinstance(gratings, str):
+            gratings = self.plan_directory(gratings, "grating").files
+        return GratingSet(self, [os.path.expanduser(filename) for filename in gratings], share_frames)
+
+    def plan_directory(self, directory, kind = "grating"):
+        """
+        Check that every file in a directory can be loaded onto this
+        Screen, and that together they fit in memory, from the directory's
+        catalog and without reading any frames. Called by load_grating_set()
+        and the methods that display a directory, so that a bad file or
+        an oversized set is reported before loading starts rather than
+        part way through.
+
+        Args:
+          directory: a directory containing only gratings, or only raws
+          kind: "grating" or "raw"
+
+        Returns:
+          DirectoryPlan named tuple with the fields files (paths in the
+          order they are loaded), memory (bytes needed to load them all,
+          before any frames are shared by load_grating_set()) and
+          available (bytes of memory the kernel reports available)
+        Raises:
+          ValueError listing every file that cannot be loaded, or if
+          the files need more memory than is available
+        """
+        if kind not in catalog.STIM_TYPES:
+            raise ValueError("kind must be 'grating' or 'raw', not %s" %kind.__repr__())
+        directory = os.path.expanduser(directory)
+        entries = read_catalog(directory, kind, self.colormode)
+        width, height = self.resolution
+        playable = (self.colormode, GRAY8MODE, MOD8MODE) if kind == "grating" else (self.colormode, GRAY8MODE)
+        problems = []
+        for name, entry in entries.items():
+            if "error" in entry:
+                problems.append(entry["error"])
+            elif entry["width"] > width or entry["height"] > height:
+                problems.append("%s is %d x %d px, while Screen is %d x %d px" %(name, entry["width"],
+                                entry["height"], width, height))
+            elif entry["pixel_format"] not in playable:
+                problems.append("%s was built with a different colormode to the Screen" %name)
+        if not entries:
+            problems.append("%s contains no %ss" %(directory, kind))
+        memory = sum(entry.get("memory", 0) for entry in entries.values())
+        available = _available_memory()
+        if available is not None and memory > available:
+            problems.append("Loading %s needs %d MB, but only %d MB of memory is available"
+                            %(directory, memory // 2**20, available // 2**20))
+        if problems:
+            raise ValueError("Cannot load %s:\n  %s" %(directory, "\n  ".join(problems)))
+        return DirectoryPlan([directory + "/" + name for name in entries], memory, available)
+
+    def display_grating(self, grating, trigger_pin = 0, contrast = None, background = None):
         """
         Display the passed grating object (grating files are created with
         the draw_grating function and loaded with the Screen.load_grating
         method). 
 
+        Gratings built with colormode "modulation" store their modulation
+        about the background rather than finished pixels, so one loaded
+        grating can be shown at any contrast and background. These are
+        applied, along with any gamma table set with set_gamma(), through
+        a lookup table built for each trial:
+
+          >>> for contrast in (0.05, 0.1, 0.25, 0.5, 1):
+          ...     screen.display_grating(grating, contrast=contrast)
+
         Returns a namedtuple (from the collections module) with the fields
         mean_interframe, stddev_interframe and start_time; these refer
         respectively to the average interframe time in microseconds, the standard
@@ -359,15 +643,30 @@ class Screen:
             the GPIO pin (as defined by wiringPi) to wait for a trigger signal.
             Note: digital signal is 3.3 volts max, not 5 volt TTL. 5 volt signals
             risk permanently damaging the raspberry pi.
+          contrast: value between 0 and 1, for modulation gratings only.
+            Defaults to 1.
+          background: value between 0 and 255 that the grating modulates
+            about, for modulation gratings only. Defaults to the Screen's
+            background.
 
         Returns:
           performance record as a named tuple.
         """
         if trigger_pin == 1:
                 raise ValueError("trigger_pin cannot be set to 1. This pin is reserved for feedback")
-
-
-        rawtuple = rpigratings.display_grating(self.capsule, grating.capsule, trigger_pin)
+        if (contrast is not None or background is not None) and grating.pixel_format != MOD8MODE:
+                raise ValueError("contrast and background can only be set for gratings built with colormode 'modulation'")
+        if contrast is None:
+                contrast = 1
+        if background is None:
+                background = self.background
+        if contrast < 0 or contrast > 1:
+                raise ValueError("contrast must be between 0 and 1")
+        if background < 0 or background > 255:
+                raise ValueError("background must be between 0 and 255")
+
+        rawtuple = self._on_display_thread(rpigratings.display_grating, self.capsule, grating.capsule,
+                                           trigger_pin, contrast, background, self.gamma_table)
         if rawtuple is None:
                 return None
         else:
@@ -393,12 +692,151 @@ class Screen:
         if trigger_pin == 1:
                 raise ValueError("trigger_pin cannot be set to 1. This pin is reserved for feedback")
 
-        rawtuple = rpigratings.display_raw(self.capsule, raw.capsule, trigger_pin)
+        rawtuple = self._on_display_thread(rpigratings.display_raw, self.capsule, raw.capsule,
+                                           trigger_pin, self.gamma_table, self.background)
         if rawtuple is None:
                 return None
         else:
                 return GratPerfRec(*rawtuple)
 
+    def display_patches(self, patches, trigger_pin = 0):
+        """
+        Displays several gratings or raws at once, each at its own place
+        on the screen and on its own schedule, over the background. The
+        stimuli are built and loaded at the size of the patch (e.g. with
+        options["resolution"] = (200, 200)) and drawn unscaled, so one
+        small file per patch replaces a full screen file for every
+        combination of patches, and each refresh costs time in proportion
+        to the area of the patches being shown rather than the screen.
+
+        Args:
+          patches: list of rpg.Patch named tuples, with the fields
+            stimulus: a loaded Grating or Raw
+            x, y: centre of the patch in pixels from the top left of the screen
+            start: the refresh the patch first appears on, defaults to 0
+            frames: refreshes the patch is shown for, defaults to the
+              stimulus's own length. Gratings loop for longer durations.
+            contrast: for stimuli built with colormode "modulation", the
+              contrast to show it at, defaults to 1
+            Patches are drawn in list order, so later patches cover earlier
+            ones where they overlap, e.g. a centre patch over a surround.
+          trigger_pin: set to 0 to start as soon as possible, or the GPIO
+            pin (as defined by wiringPi) to wait for a 3.3V trigger on.
+
+        Returns:
+          Performance record as a named tuple, as for display_grating().
+        """
+        if trigger_pin == 1:
+                raise ValueError("trigger_pin cannot be set to 1. This pin is reserved for feedback")
+        args = []
+        for patch in patches:
+                patch = Patch(*patch)
+                stimulus = patch.stimulus
+                if patch.contrast is not None and stimulus.pixel_format != MOD8MODE:
+                        raise ValueError("contrast can only be set for stimuli built with colormode 'modulation'")
+                contrast = 1 if patch.contrast is None else patch.contrast
+                if contrast < 0 or contrast > 1:
+                        raise ValueError("contrast must be between 0 and 1")
+                args.append((stimulus.capsule, int(round(patch.x - stimulus.width / 2)),
+                             int(round(patch.y - stimulus.height / 2)), patch.start,
+                             0 if patch.frames is None else patch.frames, contrast))
+
+        rawtuple = self._on_display_thread(rpigratings.display_patches, self.capsule, args, trigger_pin,
+                                           self.gamma_table, self.background)
+        if rawtuple is None:
+                return None
+        else:
+                return GratPerfRec(*rawtuple)
+
+    def display_noise(self, noise, trigger_pin = 0, contrast = 1):
+        """
+        Displays a Noise stimulus, generating each frame as it is shown
+        from the stimulus's seed, so nothing is built or loaded first.
+        The frames shown can be regenerated afterwards with noise.frame().
+        Unlit sparse noise cells, and the screen around the grid, show
+        the background. set_gamma() applies.
+
+        Args:
+          noise: an rpg.Noise
+          trigger_pin: set to 0 to display as soon as possible, or the GPIO
+            pin (as defined by wiringPi) to wait for a 3.3V trigger on.
+          contrast: between 0 and 1, the contrast of white and black cells
+            about the background
+
+        Returns:
+          Performance record as a named tuple, as for display_raw(). The
+          interframe interval is between noise frames, i.e. hold refreshes.
+        """
+        if trigger_pin == 1:
+                raise ValueError("trigger_pin cannot be set to 1. This pin is reserved for feedback")
+        if contrast < 0 or contrast > 1:
+                raise ValueError("contrast must be between 0 and 1")
+
+        rawtuple = self._on_display_thread(rpigratings.display_noise, self.capsule, noise._args(),
+                                           trigger_pin, contrast, self.background, self.gamma_table)
+        if rawtuple is None:
+                return None
+        else:
+                return GratPerfRec(*rawtuple)
+
+    def display_closed_loop(self, params, options, trigger_pin = 0):
+        """
+        Displays a grating that is rendered afresh every frame from the
+        latest values in a ParameterBlock, so its position, phase,
+        contrast and orientation can be changed during playback by
+        another thread or process calling params.update(). Nothing is
+        built or loaded beforehand.
+
+        Rendering costs about as much per frame as displaying a grating
+        stored as "modulation", for the area inside the aperture. Full
+        screen closed-loop gratings may not fit in one refresh at high
+        resolutions, which benchmark_frame_copy(gray=True) gives an idea of.
+
+        Args:
+          params: a ParameterBlock
+          options: A dictionary with the required keys duration (seconds)
+            and spac_freq (cycles per degree), and the optional keys:
+              "temp_freq": 0,          #drift in cycles per second, added to params' phase
+              "waveform": rpg.SINE,    #rpg.SINE or rpg.SQUARE
+              "percent_diameter": 0,   #diameter of a circular aperture as percentage of screen width
+              "percent_sigma": 0,      #sigma of a gaussian aperture (a gabor) as percentage of screen width
+            With neither aperture the grating fills the Screen. The
+            background is the Screen's background, and set_gamma() applies.
+          trigger_pin: set to 0 to start as soon as possible, or the GPIO
+            pin (as defined by wiringPi) to wait for a 3.3V trigger on.
+
+        Returns:
+          ClosedLoopRec named tuple, with the fields mean_interframe,
+          stddev_interframe and start_time as for display_grating(), the
+          number of updates written to params during the display and the
+          number of them that were displayed (an update replaced before
+          the next frame started is never shown), and the mean and maximum
+          latency in frames from an update being written to the start of
+          the refresh that showed it. None if waiting for the trigger was
+          cancelled.
+        """
+        if trigger_pin == 1:
+                raise ValueError("trigger_pin cannot be set to 1. This pin is reserved for feedback")
+        op = options.copy()
+        if "duration" not in op or op["duration"] <= 0:
+                raise ValueError("Provide options['duration'] > 0 in options dictionary")
+        if "spac_freq" not in op or op["spac_freq"] <= 0:
+                raise ValueError("Provide options['spac_freq'] > 0 in options dictionary")
+        for key in ("temp_freq", "percent_diameter", "percent_sigma"):
+                if op.setdefault(key, 0) < 0:
+                        raise ValueError("options['%s'] must be >= 0" %key)
+        op.setdefault("waveform", SINE)
+
+        rawtuple = self._on_display_thread(rpigratings.display_closed_loop, self.capsule, params.buffer,
+                                           op["duration"], op["spac_freq"], op["temp_freq"], op["waveform"],
+                                           op["percent_diameter"], op["percent_sigma"], trigger_pin,
+                                           self.background, self.gamma_table)
+        if rawtuple is None:
+                return None
+        mean_interframe, stddev_interframe, start_time, written, displayed, mean_latency, max_latency = rawtuple
+        return ClosedLoopRec(mean_interframe, stddev_interframe, start_time, written, displayed,
+                             mean_latency / mean_interframe, max_latency / mean_interframe)
+
     def display_greyscale(self,color,blocking=True):
         """
         Fill the screen with a solid color until something else is
@@ -419,7 +857,236 @@ class Screen:
         if (color<0 or color>255):
                 self.close()
                 raise ValueError("Color must be between each between 0 and 255.")
-        rpigratings.display_color(self.capsule,color,color,color,self.colormode,blocking)
+        if self.gamma_table is not None:
+                color = self.gamma_table[color]
+        self._on_display_thread(rpigratings.display_color, self.capsule, color, color, color,
+                                self.colormode, blocking)
+
+    def set_gamma(self, gamma):
+        """
+        Set the gamma correction for this monitor. It is applied to
+        gratings and raws stored as "gray" or "modulation", and to
+        display_greyscale(), through the lookup table they are already
+        displayed with, so it costs nothing per frame. Stimuli stored
+        at 16, 24 or 32 bits per pixel are displayed unchanged.
+
+        Args:
+          gamma: None to remove any correction. A number, the monitor's
+            gamma, for which a power law correction is built. Or a
+            sequence of 256 values between 0 and 255, e.g. measured with
+            a photometer, giving the value to display for each grey level.
+
+        Returns:
+          None
+        """
+        if gamma is None:
+                self.gamma_table = None
+        elif isinstance(gamma, (int, float)):
+                if gamma <= 0:
+                        raise ValueError("gamma must be > 0")
+                self.gamma_table = bytes(int(round(255 * (level / 255) ** (1 / gamma))) for level in range(256))
+        else:
+                gamma = list(gamma)
+                if len(gamma) != 256 or min(gamma) < 0 or max(gamma) > 255:
+                        raise ValueError("gamma table must have 256 values between 0 and 255")
+                self.gamma_table = bytes(int(round(level)) for level in gamma)
+
+    def _display_thread(self):
+        """
+        Internal function returning the single worker thread that the
+        *_async methods run their displays on. Using one worker means
+        stimuli queued from several coroutines are shown one after the
+        other rather than fighting over the framebuffer.
+
+        Returns:
+          concurrent.futures.ThreadPoolExecutor with one worker
+        """
+        if self._display_executor is None:
+            self._display_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rpg-display",
+                                                         initializer=self._note_display_thread)
+        return self._display_executor
+
+    def _note_display_thread(self):
+        """
+        Internal function run by the display thread as it starts,
+        recording its identity so that work already on it is not
+        handed to it again and waited for, which would deadlock.
+        """
+        self._display_thread_id = threading.get_ident()
+
+    def _run_on_display_thread(self, func, *args):
+        """
+        Internal function calling func(*args) on the display thread and
+        waiting for the result, or directly if called from the display
+        thread itself, e.g. from a display queued with an *_async method.
+        """
+        if threading.get_ident() == self._display_thread_id:
+            return func(*args)
+        return self._display_thread().submit(func, *args).result()
+
+    def _on_display_thread(self, func, *args):
+        """
+        Internal function calling func(*args) on the display thread when
+        real-time mode is enabled, waiting for the result, so that every
+        frame is drawn with real-time priority whichever thread asked for
+        it. Otherwise func is called directly on the calling thread.
+        """
+        if self._realtime_state is None:
+            return func(*args)
+        return self._run_on_display_thread(func, *args)
+
+    def enable_realtime(self, priority=50, cpu=None):
+        """
+        Run every display on the display thread with real-time priority,
+        so that other processes and threads cannot delay a frame. The
+        display thread is given the SCHED_FIFO scheduling policy, pinned
+        to one CPU, and all of the process's memory is locked into RAM
+        (mlockall) with the thread's stack prefaulted, so no frame waits
+        on a page fault. While enabled, display_grating(), display_raw()
+        and display_greyscale() hand their work to the display thread
+        and wait for it, whichever thread they are called from.
+
+        mlockall() locks the whole Python process, not just the display
+        loop: everything mapped or allocated while real-time mode is on,
+        by any thread (StimulusPool entries, other threads' stacks, every
+        Python object), is pinned in RAM until disable_realtime(). Load
+        stimuli first, and keep the process well inside the memory the
+        Raspberry Pi has free, or allocations elsewhere in the process
+        will fail rather than page.
+
+        Needs root, or the CAP_SYS_NICE and CAP_IPC_LOCK capabilities.
+        For the least jitter, pin to a core that has been removed from
+        the general scheduler with the isolcpus= kernel parameter, e.g.
+        cpu=3 with isolcpus=3 on a Raspberry Pi 3 or 4.
+
+        Args:
+          priority: SCHED_FIFO priority from 1 to 99. Keep it below the
+            kernel's interrupt threads (50 on PREEMPT_RT kernels) unless
+            they are known not to be needed during a stimulus.
+          cpu: the CPU to pin the display thread to, or None to let it
+            run on any CPU.
+
+        Returns:
+          None
+
+        Raises:
+          OSError if the process lacks the needed privileges, in which
+          case nothing is changed.
+        """
+        if priority < 1 or priority > 99:
+            raise ValueError("priority must be between 1 and 99")
+        if cpu is not None and cpu not in os.sched_getaffinity(0):
+            raise ValueError("cpu %d is not available to this process" %cpu)
+        self.disable_realtime()
+        self._realtime_state = self._run_on_display_thread(
+            rpigratings.set_realtime, priority, -1 if cpu is None else cpu)
+        self.realtime = (priority, cpu)
+
+    def disable_realtime(self):
+        """
+        Restore the display thread's previous scheduling and CPU
+        affinity and unlock the process's memory. Does nothing if
+        real-time mode is not enabled. Called by close().
+
+        Returns:
+          None
+        """
+        if self._realtime_state is None:
+            return
+        state = self._realtime_state
+        self._realtime_state = None
+        self.realtime = None
+        self._run_on_display_thread(rpigratings.clear_realtime, *state)
+
+    def benchmark_jitter(self, n_frames=600, priority=50, cpu=None):
+        """
+        Measure how steady the display loop is, with real-time mode off
+        and then on. Each run flips n_frames solid background frames,
+        timed exactly as stimuli are, on the display thread. Best run
+        while the rest of the experiment (acquisition, logging) is also
+        running, since jitter comes from competition for the CPU.
+        Real-time mode is left as it was found.
+
+        Args:
+          n_frames: refreshes timed in each run; 600 is 10 s at 60 Hz
+          priority, cpu: as for enable_realtime()
+
+        Returns:
+          dictionary with keys "off" and "on", each holding a JitterRec
+          named tuple with the fields mean_interframe, stddev_interframe,
+          max_interframe and percentile_99 in microseconds, and
+          missed_frames, the count of intervals over 1.5 times the median
+          interval (i.e. refreshes where the flip was late)
+        """
+        previous = self.realtime
+        shade = self.background if self.gamma_table is None else self.gamma_table[self.background]
+        results = {}
+        try:
+            self.disable_realtime()
+            results["off"] = _jitter_record(self._run_on_display_thread(
+                rpigratings.vsync_intervals, self.capsule, n_frames, shade))
+            self.enable_realtime(priority, cpu)
+            results["on"] = _jitter_record(self._run_on_display_thread(
+                rpigratings.vsync_intervals, self.capsule, n_frames, shade))
+        finally:
+            self.disable_realtime()
+            if previous is not None:
+                self.enable_realtime(*previous)
+        return results
+
+    async def display_grating_async(self, grating, trigger_pin = 0, contrast = None, background = None):
+        """
+        Awaitable version of display_grating(). The grating is displayed on
+        a dedicated display thread, and the C module releases the GIL while
+        it runs, so other threads and coroutines (DAQ polling, network I/O,
+        logging) keep running during the stimulus.
+
+          >>> perf = await screen.display_grating_async(grating)
+
+        Do not call the blocking display methods from another thread while
+        an asynchronous display is in progress.
+
+        Args:
+          grating: a grating objected loaded with Screen.load_grating()
+          trigger_pin, contrast, background: as for display_grating()
+
+        Returns:
+          performance record as a named tuple, as for display_grating()
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._display_thread(), self.display_grating, grating,
+                                          trigger_pin, contrast, background)
+
+    async def display_raw_async(self, raw, trigger_pin = 0):
+        """
+        Awaitable version of display_raw(), run on the same display thread
+        as display_grating_async().
+
+        Args:
+          raw: a raw object loaded with Screen.load_raw()
+          trigger_pin: as for display_raw()
+
+        Returns:
+          Performance record as named tuple, as for display_raw()
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._display_thread(), self.display_raw, raw, trigger_pin)
+
+    async def display_greyscale_async(self, color, blocking=True):
+        """
+        Awaitable version of display_greyscale(), run on the same display
+        thread as display_grating_async() so it is ordered with any
+        stimulus already queued.
+
+        Args:
+          color: Value between 0 and 255.
+          blocking: as for display_greyscale()
+
+        Returns:
+          None
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._display_thread(), self.display_greyscale, color, blocking)
 
     def display_gratings_randomly(self, dir_containing_gratings, intertrial_time, algorithm = "md5", logfile_name="rpglog.txt"):
         """
@@ -451,10 +1118,9 @@ class Screen:
         """
 
         dir_containing_gratings = os.path.expanduser(dir_containing_gratings)
-        gratings = []
         print("Loading gratings...")
-        for file in os.listdir(dir_containing_gratings):
-            gratings.append((self.load_grating(dir_containing_gratings + "/" + file),dir_containing_gratings + "/" + file))
+        grating_set = self.load_grating_set(dir_containing_gratings)
+        gratings = [(grating, dir_containing_gratings + "/" + name) for name, grating in grating_set.items()]
         randomized_gratings = self._randomize_grating_list(gratings, algorithm = algorithm)
 
         print("Displaying in order of: " + str([x[1].split("/")[-1] for x in randomized_gratings ] ))
@@ -494,14 +1160,14 @@ class Screen:
           None
         """
 
-        dir_containing_raws = os.path.expanduser(dir_containing_raws)
+        plan = self.plan_directory(dir_containing_raws, "raw")
         raws = []
         print("Loading raws...")
-        for file in os.listdir(dir_containing_raws):
-            raws.append((self.load_raw(dir_containing_raws + "/" + file),dir_containing_raws + "/" + file))
+        for filename in plan.files:
+            raws.append((self.load_raw(filename), filename))
         randomized_raws = self._randomize_grating_list(raws, algorithm=algorithm)
 
-        print("Displaying in order of: " + str([x[1].split("/")[-1] for x in randomized_rawss ] ))
+        print("Displaying in order of: " + str([x[1].split("/")[-1] for x in randomized_raws ] ))
 
         for raw in randomized_raws:
             perf = self.display_raw(raw[0])
@@ -538,11 +1204,10 @@ class Screen:
         self.display_greyscale(self.background)
 
         dir_containing_gratings = os.path.expanduser(dir_containing_gratings)
-        gratings = []
         print("Loading gratings...")
-        for file in os.listdir(dir_containing_gratings):
-            gratings.append((self.load_grating(dir_containing_gratings + "/" + file),dir_containing_gratings + "/" + file))
-        randomized_gratings = self._randomize_grating_list(gratings, algorthm=algorithm)
+        grating_set = self.load_grating_set(dir_containing_gratings)
+        gratings = [(grating, dir_containing_gratings + "/" + name) for name, grating in grating_set.items()]
+        randomized_gratings = self._randomize_grating_list(gratings, algorithm=algorithm)
         print("Displaying in order of: " + str([x[1].split("/")[-1] for x in randomized_gratings ] ))
         print("Waiting for pulse on pin " + str(trigger_pin) + ".")
         print("Press any key to stop waiting...")
@@ -586,11 +1251,11 @@ class Screen:
 
         self.display_greyscale(self.background)
 
-        dir_containing_raws = os.path.expanduser(dir_containing_raws)
+        plan = self.plan_directory(dir_containing_raws, "raw")
         raws = []
         print("Loading raws...")
-        for file in os.listdir(dir_containing_raws):
-            raws.append((self.load_grating(dir_containing_raws + "/" + file),dir_containing_raws + "/" + file))
+        for filename in plan.files:
+            raws.append((self.load_raw(filename), filename))
         randomized_raws = self._randomize_grating_list(raws, algorithm=algorithm)
         print("Displaying in order of: " + str([x[1].split("/")[-1] for x in randomized_raws ] ))
         print("Waiting for pulse on pin " + str(trigger_pin) + ".")
@@ -652,7 +1317,9 @@ class Screen:
                 randomized_gratings.append( gratings[el[1]] )
             return randomized_gratings
         elif algorithm == "shuffle":
-            return random.shuffle(gratings)
+            shuffled_gratings = list(gratings)
+            random.shuffle(shuffled_gratings)
+            return shuffled_gratings
         else:
             raise ValueError("Algorithm parameter must be either set to 'md5' or 'shuffle'")
 
@@ -667,6 +1334,12 @@ class Screen:
         Returns:
           None
         """
+        if self._display_executor is not None:
+            self.disable_realtime()
+            #The display thread cannot wait for itself to finish
+            self._display_executor.shutdown(wait=threading.get_ident() != self._display_thread_id)
+            self._display_executor = None
+            self._display_thread_id = None
         if self.isopen:
             rpigratings.close_display(self.capsule)
             self.isopen = False
@@ -678,26 +1351,156 @@ class Screen:
     def __exit__(self,exception_type, exception_value, traceback):
         self.close()
 
+def _available_memory():
+    """
+    Internal function returning the bytes of memory the kernel reports
+    available for new allocations, or None if it does not say.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _jitter_record(intervals):
+    """
+    Internal function summarising interframe intervals as a JitterRec.
+    """
+    ordered = sorted(intervals)
+    median = statistics.median(ordered)
+    return JitterRec(statistics.mean(ordered), statistics.pstdev(ordered), ordered[-1],
+                     ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))],
+                     sum(1 for interval in ordered if interval > 1.5 * median))
+
+def _attach(pool, filename, kind, master):
+    """
+    Internal function attaching the grating or raw (kind) filename from
+    a StimulusPool. A raw's tile map is built by the first attachment
+    and saved with the pool entry, later attachments map it.
+
+    Returns:
+      (capsule, content hash, open file holding the pool reference)
+    """
+    path, length, content_hash, holder = pool.acquire(filename)
+    try:
+        if kind == "grating":
+            capsule = rpigratings.attach_grating(master.capsule, path, length)
+        else:
+            tile_map = pool.tile_map(content_hash)
+            capsule = rpigratings.attach_raw(master.capsule, path, length, tile_map)
+            if tile_map is None:
+                built = rpigratings.tile_map(capsule)
+                if built is not None:
+                    pool.store_tile_map(content_hash, built)
+    except:
+        pool.release(content_hash, holder)
+        raise
+    return capsule, content_hash, holder
+
+
 class Grating:
-    def __init__(self, master, filename):
+    def __init__(self, master, filename, pool=None):
         if type(master).__name__ != "Screen":
             raise ValueError("master must be a Screen instance")
         self.master = master
-        self.capsule = rpigratings.load_grating(master.capsule, filename)
+        if pool is None:
+            self.capsule = rpigratings.load_grating(master.capsule, filename)
+        else:
+            self.capsule, self.content_hash, holder = _attach(pool, filename, "grating", master)
+            self._pool_ref = (pool, holder)
+        properties = rpigratings.stimulus_properties(self.capsule)
+        self.pixel_format = properties["pixel_format"]
+        self.scale = properties["scale"]
+        self.width = properties["width"]
+        self.height = properties["height"]
     def __del__(self):
         if "capsule" in self.__dict__:
             rpigratings.unload_grating(self.capsule)
+        if "_pool_ref" in self.__dict__:
+            self._pool_ref[0].release(self.content_hash, self._pool_ref[1])
+
+
+    def _share_frames(self, source):
+        """
+        Internal function used by GratingSet. If every frame of this
+        grating is also a frame of source, frees this grating's frames
+        and shows source's instead.
+
+        Returns:
+          True if the frames are now shared
+        """
+        shared = rpigratings.share_frames(source.capsule, self.capsule)
+        if shared is None:
+            return False
+        rpigratings.unload_grating(self.capsule)
+        self.capsule = shared
+        #source's frames must outlive this grating
+        self.source = source
+        return True
+
+
+class GratingSet:
+    def __init__(self, master, filenames, share_frames=True):
+        """
+        A set of gratings, created with Screen.load_grating_set(), that
+        shares frames between gratings where it can. Gratings are indexed
+        by file name, e.g. grating_set["180"].
+
+        Args:
+          master: the Screen instance
+          filenames: list of grating filenames
+          share_frames: set to False to load every grating in full
+        """
+        self.master = master
+        self.gratings = {}
+        self.shared = {} #file name of each sharing grating to that of its source
+        for filename in filenames:
+            name = os.path.basename(filename)
+            grating = Grating(master, filename)
+            if share_frames:
+                for source_name, source in self.gratings.items():
+                    if source_name not in self.shared and grating._share_frames(source):
+                        self.shared[name] = source_name
+                        break
+            self.gratings[name] = grating
+
+    def __getitem__(self, name):
+        return self.gratings[name]
+
+    def __len__(self):
+        return len(self.gratings)
+
+    def __iter__(self):
+        return iter(self.gratings)
+
+    def items(self):
+        return self.gratings.items()
 
 
 class Raw:
-    def __init__(self, master, filename):
+    def __init__(self, master, filename, pool=None):
         if type(master).__name__ != "Screen":
             raise ValueError("master must be a Screen instance")
         self.master = master
-        self.capsule = rpigratings.load_raw(master.capsule, filename)
+        if pool is None:
+            self.capsule = rpigratings.load_raw(master.capsule, filename)
+        else:
+            self.capsule, self.content_hash, holder = _attach(pool, filename, "raw", master)
+            self._pool_ref = (pool, holder)
+        properties = rpigratings.stimulus_properties(self.capsule)
+        self.pixel_format = properties["pixel_format"]
+        self.scale = properties["scale"]
+        self.width = properties["width"]
+        self.height = properties["height"]
+        self.changed_fraction = properties["changed_fraction"]
     def __del__(self):
         if "capsule" in self.__dict__:
             rpigratings.unload_raw(self.capsule)
+        if "_pool_ref" in self.__dict__:
+            self._pool_ref[0].release(self.content_hash, self._pool_ref[1])
 
 def _parse_options(options):
     """
@@ -748,6 +1551,12 @@ def _parse_options(options):
     if "resolution" not in op:
         op["resolution"] = (1280, 720)
 
+    if "screen_width" in op:
+        if op["screen_width"] < op["resolution"][0]:
+            raise ValueError("options['screen_width'] set to invalid value of %d, must be at least the width of options['resolution']" %op["screen_width"])
+    else:
+        op["screen_width"] = op["resolution"][0]
+
     if "waveform" not in op:
         op["waveform"] = SINE
 
@@ -776,12 +1585,48 @@ def _parse_options(options):
         op["percent_padding"] = 0
 
     if "colormode" in op:
-        if op["colormode"] in {0, 16, "rgb565", "RGB565", "565", "16"}:
-            op["colormode"] = RGB565MODE
-        elif op["colormode"] in {1, 24, "24", "rgb888", "RGB888", "888"}:
-            op["colormode"] = RGB888MODE
-        else:
-            raise ValueError("options['colormode'] must be 16 or 24, not %s"%op["colormode"].__repr__)
+        op["colormode"] = _parse_colormode(op["colormode"], "options['colormode']",
+                                           allow_gray=True, allow_modulation=True)
     else:
         op["colormode"] = RGB565MODE
+
+    #Modulation gratings are stored at full contrast about mid grey, and the
+    #header records that, so a contrast or background asked for here would
+    #be silently lost
+    for name in ("contrast", "background"):
+        if name in options and op["colormode"] == MOD8MODE:
+            raise ValueError("options['%s'] cannot be set with colormode 'modulation', pass it to Screen.display_grating() instead" %name)
     return op
+
+def _parse_colormode(colormode, name="colormode", allow_gray=False, allow_modulation=False):
+    """
+    An internal function converting the ways a user may specify
+    bits per pixel into the tag passed to the C architecture.
+
+    Args:
+      colormode: 16, 24 or 32, or a string such as "rgb565"
+      name: how the value is referred to in error messages
+      allow_gray: accept 8 or "gray", for files stored as grey levels.
+        A Screen cannot itself be gray.
+      allow_modulation: accept "modulation", for gratings stored as
+        modulation about the background.
+
+    Returns:
+      RGB565MODE, RGB888MODE, XRGB8888MODE, GRAY8MODE or MOD8MODE
+    """
+    if colormode in {0, 16, "rgb565", "RGB565", "565", "16"}:
+        return RGB565MODE
+    elif colormode in {1, 24, "24", "rgb888", "RGB888", "888"}:
+        return RGB888MODE
+    elif colormode in {32, "32", "xrgb8888", "XRGB8888", "8888"}:
+        return XRGB8888MODE
+    elif allow_gray and colormode in {8, "8", "gray", "grey", "GRAY8", GRAY8MODE}:
+        return GRAY8MODE
+    elif allow_modulation and colormode in {"modulation", "mod", "MOD8", MOD8MODE}:
+        return MOD8MODE
+    accepted = "16, 24 or 32"
+    if allow_gray:
+        accepted = "8, " + accepted
+    if allow_modulation:
+        accepted = accepted.replace(" or ", ", ") + " or 'modulation'"
+    raise ValueError("%s must be %s, not %s" %(name, accepted, colormode.__repr__()))
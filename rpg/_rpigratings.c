@@ -5,6 +5,7 @@
 #include <inttypes.h>
 #include <unistd.h>
 #include <sys/mman.h>
+#include <sys/stat.h>
 #include <fcntl.h>
 #include <stdint.h>
 #include <sys/ioctl.h>
@@ -16,6 +17,10 @@
 #include <stropts.h>
 #include <stdbool.h>
 #include <linux/fb.h>
+#include <sched.h>
+#include <pthread.h>
+#include <errno.h>
+#include <stddef.h>
 
 #define ANGLE_0 -1
 #define ANGLE_90 -2
@@ -25,6 +30,9 @@
 #define SQUARE 		0b0000
 #define RGB888MODE 	0b0010
 #define RGB565MODE 	0b0000
+#define XRGB8888MODE	0b100000
+#define GRAY8MODE	0b1000000 //storage only, expanded to the Screen's colormode at display time
+#define MOD8MODE	0b10000000 //storage only, 128+127*modulation, contrast and background set at display time
 #define FULLSCREEN	0b0000
 #define CIRCLE		0b0100
 #define GABOR		0b1000
@@ -32,6 +40,25 @@
 #define OUTSIDEMASK	0b0100
 
 
+#define STIM_GRATING	1
+#define STIM_RAW	2
+#define RPG_MAGIC	0x00475052 //"RPG\0" read as a little endian uint32
+#define RPG_HEADER_VERSION	2
+#define MAX_HEADER_SIZE	4096
+#define CONVERT_CHUNK_PIXELS	65536
+#define PREFAULT_STACK_SIZE	(512*1024)
+#define TRIGGER_POLL_NS	20000 //between trigger polls on a real-time display thread
+#define WAVE_TABLE_BITS	10
+#define WAVE_TABLE_SIZE	(1 << WAVE_TABLE_BITS)
+#define SEQLOCK_RETRIES	1000
+#define DELTA_TILE	16 //side, in stored pixels, of the tiles compared for delta playback
+#define NOISE_SPARSE	0
+#define NOISE_CHECKERBOARD	1
+#define POLARITY_ON	1
+#define POLARITY_OFF	2
+#define POLARITY_BOTH	3
+
+
 #define DEGREES_SUBTENDED 80 //The degrees of visual angle
 			     // subtended by the screen
 
@@ -72,6 +99,138 @@ typedef struct {
 } fileheader_raw;
 
 
+typedef struct {
+	// Versioned header written at the start of grating and raw
+	// files. Older files start with a fileheader_t (gratings) or
+	// a fileheader_raw (raws) instead, and are told apart by magic.
+	uint32_t magic;
+	uint16_t version;
+	uint16_t header_size; //bytes from the start of the file to the first frame
+	uint16_t stim_type;
+	uint16_t pixel_format; //colormode tag the frames are stored in
+	uint16_t width;
+	uint16_t height;
+	uint32_t frames_stored; //frames of pixel data in the file
+	uint32_t n_frames; //frames displayed, gratings loop over frames_stored
+	uint16_t frames_per_second;
+	uint16_t refresh_per_frame;
+	uint16_t spacial_frequency;
+	uint16_t temporal_frequency;
+} fileheader_v1;
+
+typedef struct {
+	// The parameters a grating was built with, so that a directory of
+	// gratings can be described from their headers alone. All zero for
+	// raws, and for files with a version 1 or legacy header.
+	double duration;
+	double angle;
+	double spacial_frequency; //cycles per degree
+	double temporal_frequency; //cycles per second, as requested
+	double contrast;
+	double percent_sigma;
+	double percent_diameter;
+	double percent_center_left;
+	double percent_center_top;
+	double percent_padding;
+	int32_t background;
+	int32_t waveform;
+	int32_t screen_width;
+	int32_t _padding;
+} stimulus_params_t;
+
+typedef struct {
+	// Version 2 header, a version 1 header followed by the stimulus
+	// parameters. header_size covers both, so version 1 readers skip
+	// the parameters along with the rest of the header.
+	fileheader_v1 v1;
+	stimulus_params_t params;
+} fileheader_v2;
+
+typedef struct {
+	// A loaded grating or raw, as held by grating_data and raw_data
+	// capsules. Describes the frames independently of which header
+	// version they were read from and of how their memory was obtained.
+	int stim_type;
+	int pixel_format;
+	unsigned int width;
+	unsigned int height;
+	unsigned int frames_stored;
+	unsigned int n_frames;
+	unsigned int refresh_per_frame;
+	unsigned int frames_per_second;
+	unsigned int header_size;
+	unsigned int header_version; //0 for a legacy header
+	stimulus_params_t params; //as recorded in a version 2 header
+	size_t frame_size; //bytes per stored frame
+	uint8_t* frames; //first stored frame
+	void* block; //the header and frames, as read from the file
+	size_t block_size;
+	size_t mapped_length; //0 when block is malloc'd, else its mmap length
+	unsigned int scale; //integer upscaling onto the Screen, set when loaded
+	unsigned int offset_x; //position of the scaled frame on the Screen,
+	unsigned int offset_y; //non-zero when it is letterboxed
+	uint32_t* frame_map; //NULL, or the stored frame shown for each frame
+			     //of a grating sharing another grating's frames
+	uint64_t* frame_hashes; //NULL until needed to find shared frames
+	uint8_t* tile_map; //NULL, or for each frame of a raw a bit per tile,
+			   //set if the tile differs from two frames before
+	unsigned int tile_columns;
+	unsigned int tile_rows;
+	size_t tile_map_stride; //bytes of tile_map per frame
+	size_t tile_map_length; //0 when tile_map is malloc'd, else its mmap length
+	double changed_fraction; //mean fraction of tiles drawn per frame
+} stimulus_t;
+
+typedef struct {
+	// Sparse noise or a random checkerboard, generated frame by frame
+	// from a seed, so nothing is stored. Every cell of every frame is
+	// a function of (seed, frame, cell) alone, see noise_cells()
+	uint64_t seed;
+	int kind; //NOISE_SPARSE or NOISE_CHECKERBOARD
+	int polarity; //POLARITY_ON, POLARITY_OFF or POLARITY_BOTH, for sparse noise
+	unsigned int columns;
+	unsigned int rows;
+	uint32_t threshold; //a cell is lit if 24 random bits are below this
+	unsigned int hold; //refreshes each frame is shown for
+	unsigned int n_frames;
+} noise_t;
+
+typedef struct {
+	// One stimulus composited by display_patches(), drawn unscaled
+	// into its own rectangle of the Screen on its own schedule
+	stimulus_t* stim;
+	unsigned int x; //top left corner on the Screen
+	unsigned int y;
+	unsigned int start; //refresh the patch first appears on
+	unsigned int n_refreshes; //refreshes it is shown for
+	uint32_t palette[256]; //this patch's lookup table, if it is 8 bit
+} patch_t;
+
+typedef struct {
+	// Closed-loop stimulus parameters, shared between a writer and
+	// display_closed_loop() through a seqlock. sequence is odd while
+	// a write is in progress, and a reader retries its copy if
+	// sequence changed while it was copying.
+	uint32_t sequence;
+	uint32_t _padding;
+	uint64_t update_id; //number of writes so far
+	int64_t written_ns; //CLOCK_MONOTONIC time of the latest write
+	double x; //centre of the stimulus in pixels, NAN for the Screen centre
+	double y;
+	double phase; //degrees
+	double contrast;
+	double orientation; //degrees, as for the angle of build_grating
+} param_block_t;
+
+typedef struct {
+	// A grating rendered afresh each frame by display_closed_loop()
+	double wavelength; //pixels per cycle
+	double drift; //degrees of phase added each frame
+	int radius; //of the aperture in pixels, 0 for the full screen
+	uint16_t* envelope; //NULL, or (2*radius+1)^2 weights out of 256
+	int8_t wave[WAVE_TABLE_SIZE]; //one cycle of modulation, -127 to 127
+} closed_loop_t;
+
 typedef struct {
 	uint8_t red;
 	uint8_t green;
@@ -96,6 +255,66 @@ uint24_t rgb_to_uint_24bit(int red, int green, int blue){
 	return result;
 }
 
+uint32_t rgb_to_uint_32bit(int red, int green, int blue){
+	/*Convert an rgb value to a 32bit, XRGB8888
+	value. The unused top byte is left as zero.*/
+	return ((uint32_t)(red & 0xff) << 16)|
+	       ((uint32_t)(green & 0xff) << 8)|
+	        (uint32_t)(blue & 0xff);
+}
+
+int bytes_per_pixel(int colormode){
+	switch(colormode){
+		case(GRAY8MODE):
+		case(MOD8MODE):
+			return sizeof(uint8_t);
+		case(XRGB8888MODE):
+			return sizeof(uint32_t);
+		case(RGB888MODE):
+			return sizeof(uint24_t);
+		default:
+			return sizeof(uint16_t);
+	}
+}
+
+int colormode_of_depth(int depth){
+	/*Colormode tag for a framebuffer depth in bits per pixel*/
+	switch(depth){
+		case(32):
+			return XRGB8888MODE;
+		case(24):
+			return RGB888MODE;
+		default:
+			return RGB565MODE;
+	}
+}
+
+void* make_pixel(int red, int green, int blue, int colormode){
+	/*Returns a pointer to a newly malloc'd pixel of the
+	given color, in the format of the given colormode*/
+	void* pixel_ptr = malloc(bytes_per_pixel(colormode));
+	switch(colormode){
+		case(GRAY8MODE):
+			//Builders only make achromatic pixels, so any channel will do
+			*(uint8_t*)pixel_ptr = red;
+			break;
+		case(MOD8MODE):
+			//Built at full contrast about 127, so red-127 is 127 times
+			//the modulation. 128 is no modulation, 1 and 255 are -1 and 1
+			*(uint8_t*)pixel_ptr = red < 0 ? 1 : (red > 254 ? 255 : red + 1);
+			break;
+		case(XRGB8888MODE):
+			*(uint32_t*)pixel_ptr = rgb_to_uint_32bit(red, green, blue);
+			break;
+		case(RGB888MODE):
+			*(uint24_t*)pixel_ptr = rgb_to_uint_24bit(red, green, blue);
+			break;
+		default:
+			*(uint16_t*)pixel_ptr = rgb_to_uint(red, green, blue);
+	}
+	return pixel_ptr;
+}
+
 int gcd(int a, int b){
 	/*Helper function to get the greatest
 	common denominator of 2 ints*/
@@ -112,6 +331,16 @@ int gcd(int a, int b){
 	return gcd(a,b-a);
 }
 
+void set_error_nogil(PyObject* exception, const char* message){
+	/*Set a python exception from code that may be running
+	with the GIL released (display and build loops release it
+	so other python threads keep running). PyGILState_Ensure
+	is also safe to call when the GIL is already held*/
+	PyGILState_STATE gil_state = PyGILState_Ensure();
+	PyErr_SetString(exception, message);
+	PyGILState_Release(gil_state);
+}
+
 struct timespec get_current_time(int* status){
 	/*The status argument is passed so we can
 	write an error code to it in the event of an
@@ -119,7 +348,7 @@ struct timespec get_current_time(int* status){
 	struct timespec t;
 	if(clock_gettime(CLOCK_REALTIME,&t)){
 		*status = -1;
-		PyErr_SetString(PyExc_OSError,"Failed realtime clock_gettime call");
+		set_error_nogil(PyExc_OSError,"Failed realtime clock_gettime call");
 	}else{
 		*status = 0;
 	}
@@ -182,6 +411,31 @@ int kbhit(void) {
 	return bytesWaiting;
 }
 
+int wait_for_trigger(int trig_pin){
+	/*Wait for trig_pin to go high. Returns 0 once it has, or -1 if a
+	key was pressed first. A SCHED_FIFO thread (see set_realtime())
+	sleeps TRIGGER_POLL_NS between polls rather than spinning, since
+	spinning for as long as the trigger takes would starve everything
+	else on its CPU, kernel threads of lower priority included. Real
+	time threads have no timer slack, so this adds tens of
+	microseconds at most to the trigger latency, well inside a
+	refresh. Other threads poll as fast as they can.*/
+	struct timespec poll_interval = {0, TRIGGER_POLL_NS};
+	struct sched_param param;
+	int policy;
+	int realtime = !pthread_getschedparam(pthread_self(), &policy, &param) && policy == SCHED_FIFO;
+	pinMode(trig_pin, INPUT);
+	while (digitalRead(trig_pin) == 0) {
+		if (kbhit()) {
+			return -1;
+		}
+		if (realtime) {
+			nanosleep(&poll_interval, NULL);
+		}
+	}
+	return 0;
+}
+
 
 int int_round(float x) {
 	if (x < 0.0) {
@@ -193,8 +447,12 @@ int int_round(float x) {
 
 
 float mean_long(long a[], int  n) {
+	/*0 for n < 1, e.g. the intervals of a single frame*/
 	int i;
 	long sum = 0;
+	if (n < 1) {
+		return 0;
+	}
 	for (i = 0; i < n; i++) {
 		sum += a[i];
 	}
@@ -206,6 +464,9 @@ float std_long(long a[], int n) {
 	float error_sum = 0;
 	float error;
 	int i;
+	if (n < 1) {
+		return 0;
+	}
 	for (i = 0; i < n; i++) {
 		error = mean - a[i];
 		error_sum += error * error;
@@ -337,18 +598,7 @@ void* squarewave(int x, int y, int t, int wavelength, int speed, double angle, d
 	}
 
 	brightness = contrast * weight * (brightness-127) + 127;
-	void* pixel_ptr;
-	if(colormode==RGB888MODE){
-		uint24_t* pixel_ptr_24 = malloc(sizeof(uint24_t));
-		*pixel_ptr_24 = rgb_to_uint_24bit(brightness, brightness, brightness);
-		pixel_ptr = pixel_ptr_24;
-	}
-	else{
-		uint16_t* pixel_ptr_16 = malloc(sizeof(uint16_t));
-		*pixel_ptr_16 = rgb_to_uint(brightness, brightness, brightness);
-		pixel_ptr = pixel_ptr_16;
-	}
-	return pixel_ptr;
+	return make_pixel(brightness, brightness, brightness, colormode);
 }
 
 
@@ -373,19 +623,7 @@ void* sinewave(int x, int y, int t, int wavelength, int speed, double angle, dou
 
 	brightness = contrast * weight * 127 * sin(2*M_PI*(x_prime)/wavelength) + 127;
 	int bright_int = brightness;
-	void* pixel_ptr;
-	if(colormode==RGB888MODE){
-		uint24_t* pixel_ptr_24 = malloc(sizeof(uint24_t));
-
-		*pixel_ptr_24 = rgb_to_uint_24bit(bright_int, bright_int, bright_int);
-		pixel_ptr = pixel_ptr_24;
-	}
-	else{
-		uint16_t* pixel_ptr_16 = malloc(sizeof(uint16_t));
-		*pixel_ptr_16 = rgb_to_uint(bright_int, bright_int, bright_int);
-		pixel_ptr = pixel_ptr_16;
-	}
-	return pixel_ptr;
+	return make_pixel(bright_int, bright_int, bright_int, colormode);
 }
 
 
@@ -411,26 +649,12 @@ void* gabor(int x, int y, int t, int wavelength, int speed, double angle, double
           amplitude = contrast * weight * (255 - background);
         }
         brightness = amplitude * sin(2*M_PI*(x_prime)/wavelength) + background;
-	void* pixel_ptr;
-	if(colormode==RGB888MODE){
-		uint24_t* pixel_ptr_24 = malloc(sizeof(uint24_t));
-		*pixel_ptr_24 = rgb_to_uint_24bit(brightness, brightness, brightness);
-		pixel_ptr = pixel_ptr_24;
-	}
-	else{
-		uint16_t* pixel_ptr_16 = malloc(sizeof(uint16_t));
-		*pixel_ptr_16 = rgb_to_uint(brightness, brightness, brightness);
-		pixel_ptr = pixel_ptr_16;
-	}
-	return pixel_ptr;
+	return make_pixel(brightness, brightness, brightness, colormode);
 }
 
 void* circle(int waveform, int radius, int padding, int point_radius, int j,int i,int t,int wavelength,int speed, 
 		double angle,double cosine, double sine, double weight, double contrast, int background,
 		int colormode){
-	void* pixel_ptr;
-	uint16_t* pixel_ptr_16;
-	uint24_t* pixel_ptr_24;
 	int circle_case;
 //	printf("Weight passed to circle function as %d\n",weight);
 	if( point_radius > radius + padding) { 	//outside the circular mask
@@ -443,35 +667,15 @@ void* circle(int waveform, int radius, int padding, int point_radius, int j,int
 //		printf("In padding region, weight is %f\n",weight);
 		circle_case = INSIDEMASK;
 	}
-	switch(circle_case|colormode|waveform){
-		case(OUTSIDEMASK|RGB888MODE|SQUARE):
-		case(OUTSIDEMASK|RGB888MODE|SINE):
-			pixel_ptr_24 = malloc(sizeof(uint24_t));
-			*pixel_ptr_24 = rgb_to_uint_24bit(background,background,background);
-			break;
-		case(OUTSIDEMASK|RGB565MODE|SQUARE):
-		case(OUTSIDEMASK|RGB565MODE|SINE):
-			pixel_ptr_16 = malloc(sizeof(uint16_t));
-			*pixel_ptr_16 = rgb_to_uint(background,background,background);
-			break;
-		case(INSIDEMASK|RGB888MODE|SQUARE):
-			pixel_ptr_24 = squarewave(j,i,t,wavelength,speed,angle,cosine,sine,weight,contrast,background,colormode);
-			break;
-		case(INSIDEMASK|RGB888MODE|SINE):
-			pixel_ptr_24 = sinewave(j,i,t,wavelength,speed,angle,cosine,sine,weight,contrast,background,colormode);
-			break;
-		case(INSIDEMASK|RGB565MODE|SQUARE):
-			pixel_ptr_16 = squarewave(j,i,t,wavelength,speed,angle,cosine,sine,weight,contrast,background,colormode);
-			break;
-		case(INSIDEMASK|RGB565MODE|SINE):
-			pixel_ptr_16 = sinewave(j,i,t,wavelength,speed,angle,cosine,sine,weight,contrast,background,colormode);
-	}
-	if(colormode==RGB888MODE){
-		pixel_ptr = pixel_ptr_24;
-	}else{
-		pixel_ptr = pixel_ptr_16;
+	switch(circle_case|waveform){
+		case(OUTSIDEMASK|SQUARE):
+		case(OUTSIDEMASK|SINE):
+			return make_pixel(background,background,background,colormode);
+		case(INSIDEMASK|SQUARE):
+			return squarewave(j,i,t,wavelength,speed,angle,cosine,sine,weight,contrast,background,colormode);
+		default:
+			return sinewave(j,i,t,wavelength,speed,angle,cosine,sine,weight,contrast,background,colormode);
 	}
-	return pixel_ptr;
 }
 
 void * build_frame(int t, double angle, fb_config framebuffer, int wavelength, int speed, int waveform, 
@@ -491,58 +695,38 @@ void * build_frame(int t, double angle, fb_config framebuffer, int wavelength, i
 	double sine = sin(angle);
 	double cosine = cos(angle);
 	void* array_start = malloc(framebuffer.size);
-	uint24_t *write_location_24, *read_location_24;
-	uint16_t *write_location_16, *read_location_16;
-	write_location_24 = write_location_16 = array_start;
+	int pixel_size = bytes_per_pixel(colormode);
+	uint8_t *write_location = array_start;
+	void *read_location;
 	int i,j;
 	for(i=0;i<framebuffer.height;i++){ //for each row of pixels
 		for(j=0;j<framebuffer.width;j++){ //for each column of pixels
 			int point_radius = (int) sqrt( ((j-center_j) * (j-center_j)) + ((i-center_i) * (i-center_i)) );
 			double gauss_weight = gaussian(point_radius, sigma);
 			double circle_weight = padding==0?1:((double)(radius + padding - point_radius)) / padding;
-			switch(grating_type|colormode|waveform){
-				case(FULLSCREEN|SQUARE|RGB888MODE):
-					read_location_24 = squarewave(j,i,t,wavelength,speed,angle,cosine,sine, 1, contrast, background,colormode);
-					break;
-				case(FULLSCREEN|SQUARE|RGB565MODE):
-					read_location_16 = squarewave(j,i,t,wavelength,speed,angle,cosine,sine, 1, contrast, background,colormode);
+			switch(grating_type|waveform){
+				case(FULLSCREEN|SQUARE):
+					read_location = squarewave(j,i,t,wavelength,speed,angle,cosine,sine, 1, contrast, background,colormode);
 					break;
-				case(FULLSCREEN|SINE|RGB888MODE):
-					read_location_24 = sinewave(j,i,t,wavelength,speed,angle,cosine,sine, 1, contrast, background,colormode);
-					break;
-				case(FULLSCREEN|SINE|RGB565MODE):
-					read_location_16 = sinewave(j,i,t,wavelength,speed,angle,cosine,sine, 1, contrast, background,colormode);
+				case(FULLSCREEN|SINE):
+					read_location = sinewave(j,i,t,wavelength,speed,angle,cosine,sine, 1, contrast, background,colormode);
 					break;
 				//Squarewave gabor gratings are not supported
-				case(GABOR|SINE|RGB888MODE):
-					read_location_24 = gabor(j,i,t,wavelength,speed,angle,cosine,sine, gauss_weight, contrast, background,colormode);
-					break;
-				case(GABOR|SINE|RGB565MODE):
-					read_location_16 = gabor(j,i,t,wavelength,speed,angle,cosine,sine, gauss_weight, contrast, background,colormode);
+				case(GABOR|SINE):
+					read_location = gabor(j,i,t,wavelength,speed,angle,cosine,sine, gauss_weight, contrast, background,colormode);
 					break;
-				case(CIRCLE|SQUARE|RGB888MODE):
-				case(CIRCLE|SINE  |RGB888MODE):
-//					printf("Circle_weight in build_frame scope is %f; padding is %d\n",circle_weight,padding);
-					read_location_24 = circle(
-					waveform, radius, padding, point_radius,j,i,t,wavelength,speed,angle,cosine,sine,circle_weight,contrast,background,colormode);
-					break;
-				case(CIRCLE|SQUARE|RGB565MODE):
-				case(CIRCLE|SINE  |RGB565MODE):
-					read_location_16 = circle(waveform, radius, padding, point_radius,j,i,t,wavelength,speed,angle,cosine,sine,circle_weight,contrast,background,colormode);
+				case(CIRCLE|SQUARE):
+				case(CIRCLE|SINE):
+					read_location = circle(waveform, radius, padding, point_radius,j,i,t,wavelength,speed,angle,cosine,sine,circle_weight,contrast,background,colormode);
 					break;
 				default:
 					printf("ERROR:Invalid tags encountered in build_frame funnction.\n");
+					free(array_start);
 					return NULL;
 			}
-			if(colormode == RGB888MODE){
-				*write_location_24 = *read_location_24;
-				free(read_location_24);
-			}else{
-				*write_location_16 = *read_location_16;
-				free(read_location_16);
-			}
-			write_location_24++;
-			write_location_16++;
+			memcpy(write_location, read_location, pixel_size);
+			free(read_location);
+			write_location += pixel_size;
 
 		}
 	}
@@ -550,22 +734,69 @@ void * build_frame(int t, double angle, fb_config framebuffer, int wavelength, i
 	return (void *)array_start;
 }
 
+void fill_header(fileheader_v2* header, int stim_type, int pixel_format, int width, int height,
+		int frames_stored, int n_frames, int frames_per_second, int refresh_per_frame,
+		const stimulus_params_t* params){
+	/*params may be NULL for stimuli, such as raws, that are not built
+	from parameters*/
+	memset(header, 0, sizeof(fileheader_v2));
+	header->v1.magic = RPG_MAGIC;
+	header->v1.version = RPG_HEADER_VERSION;
+	header->v1.header_size = sizeof(fileheader_v2);
+	header->v1.stim_type = stim_type;
+	header->v1.pixel_format = pixel_format;
+	header->v1.width = width;
+	header->v1.height = height;
+	header->v1.frames_stored = frames_stored;
+	header->v1.n_frames = n_frames;
+	header->v1.frames_per_second = frames_per_second;
+	header->v1.refresh_per_frame = refresh_per_frame;
+	if(params != NULL){
+		header->params = *params;
+		header->v1.spacial_frequency = (uint16_t)(params->spacial_frequency);
+		header->v1.temporal_frequency = (uint16_t)(params->temporal_frequency);
+	}
+}
+
+void write_header(FILE* file, int stim_type, int pixel_format, int width, int height,
+		int frames_stored, int n_frames, int frames_per_second, int refresh_per_frame,
+		const stimulus_params_t* params){
+	fileheader_v2 header;
+	fill_header(&header, stim_type, pixel_format, width, height, frames_stored, n_frames,
+			frames_per_second, refresh_per_frame, params);
+	fwrite(&header, sizeof(fileheader_v2), 1, file);
+}
+
 int build_grating(char * filename, double duration, double angle, double sf, double tf, double contrast, int background, int width, int height, int waveform, double 
-	percent_sigma, double percent_diameter, double percent_center_left, double percent_center_top, double percent_padding, int colormode){ 
+	percent_sigma, double percent_diameter, double percent_center_left, double percent_center_top, double percent_padding, int colormode, int screen_width){ 
 	int fps = get_refresh_rate();
         printf("Refresh rate measured as: %d hz\n", fps);
+	if(colormode == MOD8MODE){
+		//Contrast and background are applied at display time, the
+		//frames, and the parameters in the header, are full contrast
+		//about mid grey. rpg.build_grating() refuses other values.
+		contrast = 1;
+		background = 127;
+	}
 	fb_config fb0;
 	fb0.width = width;
 	fb0.height = height;
-	fb0.depth = (colormode==RGB888MODE)?24:16;
+	fb0.depth = 8*bytes_per_pixel(colormode);
 	fb0.size = (fb0.height)*(fb0.depth)*(fb0.width)/8; //8 bits/byte
 	FILE * file = fopen(filename, "wb");
 	if(file == NULL){
 		perror("File creation failed\n");
-		PyErr_SetString(PyExc_OSError,"File creation failed.");
+		set_error_nogil(PyExc_OSError,"File creation failed.");
+		return 1;
+	}
+	//Spatial frequency is in cycles per degree of the Screen the grating
+	//is shown on, which is wider than a grating shown as a patch
+	int wavelength = (screen_width/DEGREES_SUBTENDED)/sf;
+	if(wavelength < 1){
+		fclose(file);
+		set_error_nogil(PyExc_ValueError, "spac_freq is too high for this resolution, a cycle would be less than a pixel.");
 		return 1;
 	}
-	int wavelength = (fb0.width/DEGREES_SUBTENDED)/sf;
 
 	int speed = wavelength*tf/fps;
 	if(speed==0){
@@ -582,148 +813,501 @@ int build_grating(char * filename, double duration, double angle, double sf, dou
 	}
 	//Calculate the minimum number of frames required for a full cycle
 	//(worst case is just FPS*DURATION) and write it, tf, and sf in a header.
-	fileheader_t header;
-	header.frames_per_second = fps;
-	header.frames_per_cycle = wavelength / gcd(wavelength,speed);
-	if(header.frames_per_cycle > fps * duration) {
-		header.frames_per_cycle = fps * duration;
-	}
-	header.n_frames = fps * duration;
-	header.spacial_frequency = (uint16_t)(sf);
-	header.temporal_frequency = (uint16_t)(tf);
-	header.width = (uint16_t)(width);
-	header.height = (uint16_t)(height);
-	fwrite(&header,sizeof(fileheader_t),1,file);
+	int frames_per_cycle = wavelength / gcd(wavelength,speed);
+	if(frames_per_cycle > fps * duration) {
+		frames_per_cycle = fps * duration;
+	}
+	stimulus_params_t params = {duration, angle, sf, tf, contrast, percent_sigma,
+		percent_diameter, percent_center_left, percent_center_top, percent_padding,
+		background, waveform, screen_width, 0};
+	write_header(file, STIM_GRATING, colormode, width, height, frames_per_cycle,
+			fps * duration, fps, 1, &params);
 	int t, clock_status;
 	struct timespec time1, time2;
 	time1 = get_current_time(&clock_status);
 	if(clock_status){
 		return -1;
 	}
-	uint24_t * frame_24;
-	uint16_t * frame_16;
-	for (t=0;t<header.frames_per_cycle;t++){
-		if(colormode == RGB888MODE){
-			frame_24 = build_frame(t,angle,fb0,wavelength, speed, waveform, contrast, background, center_j, center_i, sigma, radius, padding, colormode);
-			if(frame_24==NULL){return -1;}
-			fwrite(frame_24,sizeof(*frame_24),fb0.height*fb0.width,file);
-			free(frame_24);
-		}else{
-			frame_16 = build_frame(t,angle,fb0,wavelength, speed, waveform, contrast, background, center_j, center_i, sigma, radius, padding, colormode);
-			if(frame_16==NULL){return -1;}
-			fwrite(frame_16,sizeof(*frame_16),fb0.height*fb0.width,file);		
-			free(frame_16);
-		}
+	void * frame;
+	for (t=0;t<frames_per_cycle;t++){
+		frame = build_frame(t,angle,fb0,wavelength, speed, waveform, contrast, background, center_j, center_i, sigma, radius, padding, colormode);
+		if(frame==NULL){return -1;}
+		fwrite(frame,1,fb0.size,file);
+		free(frame);
 		if(t==4){
 			time2 = get_current_time(&clock_status);
 			if(clock_status){
 				return -1;
 			}
-			printf("Expected time to completion: %ld seconds\n",header.frames_per_cycle*cmp_times(time1,time2)/1000000/5);
+			printf("Expected time to completion: %ld seconds\n",frames_per_cycle*cmp_times(time1,time2)/1000000/5);
 		}
 	}
 	fclose(file);
 	return 0;
 }
-void* load_grating(char* filename, fb_config fb0){
+int parse_header(void* header_bytes, size_t header_length, size_t file_length, int stim_type,
+		int default_format, stimulus_t* stim){
+	/*Fill in stim from the header at the start of a grating or raw
+	file. Legacy headers do not record a pixel format, so their frames
+	are taken to be in default_format, the colormode of the Screen
+	loading them. Returns 0 on success and -1 if the file is not a
+	valid file of the expected type, or is shorter than its header
+	says it should be.*/
+	fileheader_v1* header = header_bytes;
+	memset(stim, 0, sizeof(stimulus_t));
+	stim->stim_type = stim_type;
+	if(header_length >= sizeof(fileheader_v1) && header->magic == RPG_MAGIC){
+		if(header->stim_type != stim_type || header->version < 1 ||
+				header->header_size < sizeof(fileheader_v1)){
+			return -1;
+		}
+		stim->pixel_format = header->pixel_format;
+		stim->width = header->width;
+		stim->height = header->height;
+		stim->frames_stored = header->frames_stored;
+		stim->n_frames = header->n_frames;
+		stim->refresh_per_frame = header->refresh_per_frame;
+		stim->frames_per_second = header->frames_per_second;
+		stim->header_size = header->header_size;
+		stim->header_version = header->version;
+		if(header->version >= 2 && header->header_size >= sizeof(fileheader_v2) &&
+				header_length >= sizeof(fileheader_v2)){
+			//Copied rather than cast, header_bytes need not be aligned for doubles
+			memcpy(&stim->params, (uint8_t*)header_bytes + offsetof(fileheader_v2, params),
+					sizeof(stimulus_params_t));
+		}
+	}else if(stim_type == STIM_GRATING){
+		fileheader_t* legacy = header_bytes;
+		if(header_length < sizeof(fileheader_t)){
+			return -1;
+		}
+		stim->pixel_format = default_format;
+		stim->width = legacy->width;
+		stim->height = legacy->height;
+		stim->frames_stored = legacy->frames_per_cycle;
+		stim->n_frames = legacy->n_frames;
+		stim->refresh_per_frame = 1;
+		stim->frames_per_second = legacy->frames_per_second;
+		stim->header_size = sizeof(fileheader_t);
+	}else{
+		fileheader_raw* legacy = header_bytes;
+		if(header_length < sizeof(fileheader_raw)){
+			return -1;
+		}
+		stim->pixel_format = default_format;
+		stim->width = legacy->width;
+		stim->height = legacy->height;
+		stim->n_frames = legacy->n_frames;
+		stim->refresh_per_frame = legacy->refresh_per_frame;
+		stim->header_size = sizeof(fileheader_raw);
+	}
+	stim->frame_size = (size_t)(stim->width)*stim->height*bytes_per_pixel(stim->pixel_format);
+	if(stim->frame_size == 0 || file_length < stim->header_size){
+		return -1;
+	}
+	if(stim->header_version == 0 && stim->stim_type == STIM_RAW){
+		//Legacy raws store every converted frame, which may be more
+		//than the n_frames that are displayed
+		stim->frames_stored = (file_length - stim->header_size) / stim->frame_size;
+	}
+	if(stim->header_version > 0 && (stim->frames_stored == 0 || stim->n_frames < 1)){
+		//A versioned header records no frames until its file is
+		//complete, e.g. one left by an interrupted ingest_raw()
+		return -1;
+	}
+	stim->block_size = stim->header_size + (size_t)(stim->frames_stored)*stim->frame_size;
+	if(stim->frames_stored == 0 || stim->block_size > file_length){
+		return -1;
+	}
+	if(stim->stim_type == STIM_RAW && stim->n_frames > stim->frames_stored){
+		return -1;
+	}
+	return 0;
+}
+
+int read_stimulus_header(char* filename, int stim_type, int default_format, stimulus_t* stim){
+	/*Reads and parses only the header of filename, so that it can be
+	checked against the Screen before any frames are read. Returns 0
+	on success, -1 if the file can't be opened and -2 if its header is
+	invalid*/
+	uint8_t header_bytes[MAX_HEADER_SIZE];
+	int filedes = open(filename, O_RDONLY);
+	if(filedes == -1){
+		perror("Failed to open file");
+		return -1;
+	}
+	struct stat file_stat;
+	if(fstat(filedes, &file_stat) == -1){
+		close(filedes);
+		return -1;
+	}
+	ssize_t header_length = pread(filedes, header_bytes, MAX_HEADER_SIZE, 0);
+	close(filedes);
+	if(header_length < 0){
+		return -1;
+	}
+	if(parse_header(header_bytes, header_length, file_stat.st_size, stim_type, default_format, stim)){
+		return -2;
+	}
+	return 0;
+}
+
+int load_stimulus(char* filename, stimulus_t* stim){
+	/*Copies the header and frames described by a stim filled in by
+	read_stimulus_header into private memory*/
 	int page_size = getpagesize();
-	int bytes_already_read = 0;
-	int read_size,frames;
-	int colormode = (fb0.depth==24)?RGB888MODE:RGB565MODE;
-	int filedes = open(filename, O_RDWR);
+	size_t bytes_already_read = 0;
+	size_t read_size;
+	int filedes = open(filename, O_RDONLY);
 	if(filedes == -1){
 		perror("Failed to open file");
-		return NULL;
+		return -1;
 	}
-	//Start by aquiring the header so we can determine the filesize...
-	fileheader_t* header = mmap(NULL,sizeof(fileheader_t),PROT_READ,MAP_PRIVATE,
-					filedes,0);
-	if(header==MAP_FAILED){
-		perror("From mmap for header access");
-		exit(1);
+	uint8_t *block = malloc(stim->block_size);
+	if(block == NULL){
+		close(filedes);
+		return -1;
 	}
-	frames = header->frames_per_cycle;
-	int file_fps = header->frames_per_second;
-	int refresh_rate = get_refresh_rate();
-	if (refresh_rate != file_fps) {
-		printf("File generated at %d FPS, but monitor running at %d HZ. This will cause inaccurate timing \n", file_fps, refresh_rate);
-	}
-	int file_size = frames*fb0.size + sizeof(fileheader_t);
-	//clean up the header from the heap
-	munmap(header, sizeof(fileheader_t));
-	//now copy file_size bytes across using mmap
-	uint8_t *frame_data;
-	frame_data = malloc(file_size);
-	while(bytes_already_read < file_size){
+	while(bytes_already_read < stim->block_size){
 		read_size = 20000*page_size;
-		if(read_size + bytes_already_read >= file_size){
-			read_size = file_size - bytes_already_read;
+		if(read_size + bytes_already_read >= stim->block_size){
+			read_size = stim->block_size - bytes_already_read;
 		}
 		void* mmap_start = mmap(NULL, read_size,PROT_READ,MAP_PRIVATE,
 						filedes,bytes_already_read);
 		if(mmap_start == MAP_FAILED){
 			perror("From MMAP attempt to read");
-			exit(1);
+			free(block);
+			close(filedes);
+			return -1;
 		}
 		//Copy read_size bytes across
-		memcpy(frame_data+bytes_already_read,mmap_start,read_size);
+		memcpy(block+bytes_already_read,mmap_start,read_size);
 		bytes_already_read += read_size;
 		munmap(mmap_start,read_size);
 	}
 	close(filedes);
-	return (void*) frame_data;
+	stim->block = block;
+	stim->frames = block + stim->header_size;
+	stim->mapped_length = 0;
+	return 0;
 }
 
-int debug_dump_grating(void* frame_data, fb_config fb0, char* filename){
-	/*This is a debugging function that just dumps the first 60
-	 * frames of a loaded grating (passed as a void pointer, or from 
-	 * python as a grating.capsule object)*/
-	uint24_t* frame_data_24 = frame_data;
-	FILE * file = fopen(filename, "wb");
-	if(file == NULL){
-		perror("File creation failed\n");
-		PyErr_SetString(PyExc_OSError,"File creation failed.");
-		return 1;
+int map_stimulus(char* filename, int stim_type, int default_format, size_t content_length, stimulus_t* stim){
+	/*Map a stimulus file that lives in shared memory (a tmpfs or
+	hugetlbfs file from a StimulusPool) rather than copying it into
+	private memory, so every process attaching the file shares the
+	same physical pages. MAP_POPULATE faults the whole mapping in
+	up front so that no page faults land inside the display loop.
+	Pool files are padded out to a whole number of pages, so
+	content_length gives the length of the stimulus itself, which
+	legacy raw headers take their frame count from. 0 uses the
+	length of the file.
+	Returns 0 on success, -1 if the file can't be mapped and -2 if
+	its header is invalid*/
+	int fd = open(filename, O_RDONLY);
+	if(fd == -1){
+		perror("Failed to open shared stimulus");
+		return -1;
 	}
-	fwrite(frame_data_24,1,fb0.size*60 + sizeof(fileheader_t),file);
-	fclose(file);
+	struct stat file_stat;
+	if(fstat(fd, &file_stat) == -1){
+		perror("Failed to stat shared stimulus");
+		close(fd);
+		return -1;
+	}
+	if(content_length == 0){
+		content_length = file_stat.st_size;
+	}
+	if(content_length > (size_t)file_stat.st_size){
+		close(fd);
+		return -2;
+	}
+	void* map = mmap(NULL, file_stat.st_size, PROT_READ, MAP_SHARED|MAP_POPULATE, fd, 0);
+	close(fd);
+	if(map == MAP_FAILED){
+		perror("Failed to mmap shared stimulus");
+		return -1;
+	}
+	if(parse_header(map, content_length, content_length, stim_type, default_format, stim)){
+		munmap(map, file_stat.st_size);
+		return -2;
+	}
+	stim->block = map;
+	stim->frames = (uint8_t*)map + stim->header_size;
+	stim->mapped_length = file_stat.st_size;
+	return 0;
+}
+
+int unload_stimulus(stimulus_t* stim){
+	//A grating sharing another's frames has no block of its own
+	free(stim->frame_map);
+	free(stim->frame_hashes);
+	if(stim->tile_map_length){
+		munmap(stim->tile_map, stim->tile_map_length);
+	}else{
+		free(stim->tile_map);
+	}
+	if(stim->mapped_length){
+		munmap(stim->block, stim->mapped_length);
+	}else{
+		free(stim->block);
+	}
+	free(stim);
 	return 0;
 }
 
+void check_refresh_rate(stimulus_t* stim){
+	int refresh_rate = get_refresh_rate();
+	if (stim->frames_per_second && refresh_rate != stim->frames_per_second) {
+		printf("File generated at %d FPS, but monitor running at %d HZ. This will cause inaccurate timing \n", stim->frames_per_second, refresh_rate);
+	}
+}
+
+uint8_t* stored_frame(stimulus_t* stim, unsigned int frame){
+	/*Start of the pixels shown for frame, which for a grating
+	sharing another's frames is found through its frame map*/
+	if(stim->frame_map != NULL){
+		frame = stim->frame_map[frame];
+	}
+	return stim->frames + (size_t)frame*stim->frame_size;
+}
 
-void* load_raw(char* filename) {
-	int page_size = getpagesize();
-	int bytes_already_read = 0;
-	int read_size;
-	int fh = open(filename, O_RDWR);
-	if(fh == -1) {
-		perror("Failed to open file");
+uint64_t hash_frame(uint8_t* frame, size_t size){
+	/*FNV-1a, taken a 64 bit word at a time, used to find candidate
+	frames shared between gratings before comparing them in full*/
+	uint64_t hash = 14695981039346656037ULL;
+	uint64_t word;
+	size_t i;
+	size_t n_words = size / sizeof(uint64_t);
+	for(i = 0; i < n_words; i++){
+		memcpy(&word, frame + i*sizeof(uint64_t), sizeof(uint64_t));
+		hash = (hash ^ word) * 1099511628211ULL;
+	}
+	for(i = n_words*sizeof(uint64_t); i < size; i++){
+		hash = (hash ^ frame[i]) * 1099511628211ULL;
+	}
+	return hash;
+}
+
+uint64_t* stimulus_hashes(stimulus_t* stim){
+	/*The hash of every stored frame of stim, computed the first
+	time it is needed and kept until stim is unloaded*/
+	unsigned int frame;
+	if(stim->frame_hashes == NULL){
+		uint64_t* hashes = malloc(stim->frames_stored*sizeof(uint64_t));
+		if(hashes == NULL){
+			return NULL;
+		}
+		for(frame = 0; frame < stim->frames_stored; frame++){
+			hashes[frame] = hash_frame(stored_frame(stim, frame), stim->frame_size);
+		}
+		stim->frame_hashes = hashes;
+	}
+	return stim->frame_hashes;
+}
+
+stimulus_t* share_frames(stimulus_t* source, stimulus_t* candidate){
+	/*If every stored frame of candidate is also a stored frame of
+	source, returns a new stimulus describing candidate that shows
+	source's frames through a frame map, so candidate's own frames
+	can be freed. This finds the direction pairs of an orientation
+	set (0 and 180 degrees hold the same frames in reverse order)
+	and gratings that differ only in phase (the same frames shifted).
+	Returns NULL if any frame is not found. The new stimulus is only
+	valid while source is loaded*/
+	if(source->width != candidate->width || source->height != candidate->height ||
+			source->pixel_format != candidate->pixel_format ||
+			source->frame_size != candidate->frame_size){
 		return NULL;
 	}
-	off_t len = lseek(fh, 0, SEEK_END);
-	if (len == -1) {
-		printf("Checking File Length Failed.\n");
+	uint64_t* source_hashes = stimulus_hashes(source);
+	uint64_t* candidate_hashes = stimulus_hashes(candidate);
+	uint32_t* frame_map = malloc(candidate->frames_stored*sizeof(uint32_t));
+	if(source_hashes == NULL || candidate_hashes == NULL || frame_map == NULL){
+		free(frame_map);
 		return NULL;
 	}
-
-	uint8_t *frame_data = malloc(len);
-	while(bytes_already_read < len) {
-		read_size = 20000*page_size;
-		if(read_size + bytes_already_read >= len) {
-			read_size = len - bytes_already_read;
+	unsigned int frame, step, match;
+	unsigned int n_source = source->frames_stored;
+	for(frame = 0; frame < candidate->frames_stored; frame++){
+		//Reversed and shifted copies match at a constant step from the
+		//previous frame's match, so search outwards from that guess
+		unsigned int guess = 0;
+		if(frame >= 2){
+			guess = (2*frame_map[frame-1] + n_source - frame_map[frame-2]) % n_source;
+		}
+		for(step = 0; step < n_source; step++){
+			match = (guess + step) % n_source;
+			if(source_hashes[match] == candidate_hashes[frame] &&
+					!memcmp(stored_frame(source, match), stored_frame(candidate, frame), source->frame_size)){
+				break;
+			}
 		}
-		void *mmap_start = mmap(NULL, read_size, PROT_READ,
-					    MAP_PRIVATE, fh, bytes_already_read);
-		if(mmap_start == MAP_FAILED) {
-			perror("MMAP failed to read");
+		if(step == n_source){
+			free(frame_map);
 			return NULL;
 		}
-		memcpy(frame_data+bytes_already_read,mmap_start,read_size);
-		bytes_already_read += read_size;
-		munmap(mmap_start,read_size);
+		frame_map[frame] = source->frame_map != NULL ? source->frame_map[match] : match;
+	}
+	stimulus_t* shared = malloc(sizeof(stimulus_t));
+	*shared = *candidate;
+	shared->frames = source->frames;
+	shared->block = NULL;
+	shared->block_size = 0;
+	shared->mapped_length = 0;
+	shared->frame_map = frame_map;
+	//The frames are identical, so candidate's hashes stay valid
+	shared->frame_hashes = candidate->frame_hashes;
+	candidate->frame_hashes = NULL;
+	shared->tile_map = NULL;
+	shared->tile_map_length = 0;
+	return shared;
+}
+
+void set_tile_geometry(stimulus_t* stim){
+	/*Sets the size of stim's tile map, without building it. Every
+	frame is drawn in full until a map is built or mapped*/
+	stim->tile_columns = (stim->width + DELTA_TILE - 1)/DELTA_TILE;
+	stim->tile_rows = (stim->height + DELTA_TILE - 1)/DELTA_TILE;
+	stim->tile_map_stride = ((size_t)(stim->tile_columns)*stim->tile_rows + 7)/8;
+	stim->changed_fraction = 1;
+}
+
+int build_tile_map(stimulus_t* stim){
+	/*Works out, for each frame of a loaded raw, which DELTA_TILE
+	square tiles differ from the frame two before it. With double
+	buffering the back buffer a frame is drawn into last held the
+	frame two before, so delta_blit_frame() only redraws those tiles.
+	Frames 0 and 1 are always drawn in full. Rows of pixels are
+	compared in memory order, so each frame is read once. Returns -1,
+	leaving every frame to be drawn in full, if the map can't be
+	allocated*/
+	unsigned int frame, y, tile_x, tile_y, rows;
+	size_t pixel_bytes = bytes_per_pixel(stim->pixel_format);
+	size_t stride = (size_t)(stim->width)*pixel_bytes;
+	size_t n_tiles, changed = 0;
+	set_tile_geometry(stim);
+	n_tiles = (size_t)(stim->tile_columns)*stim->tile_rows;
+	if(stim->n_frames < 3){
+		return 0;
+	}
+	stim->tile_map = calloc(stim->n_frames, stim->tile_map_stride);
+	if(stim->tile_map == NULL){
+		return -1;
+	}
+	for(frame = 2; frame < stim->n_frames; frame++){
+		uint8_t* current = stored_frame(stim, frame);
+		uint8_t* previous = stored_frame(stim, frame - 2);
+		uint8_t* bits = stim->tile_map + (size_t)frame*stim->tile_map_stride;
+		for(tile_y = 0; tile_y < stim->tile_rows; tile_y++){
+			rows = stim->height - tile_y*DELTA_TILE;
+			rows = rows < DELTA_TILE ? rows : DELTA_TILE;
+			for(y = tile_y*DELTA_TILE; y < tile_y*DELTA_TILE + rows; y++){
+				for(tile_x = 0; tile_x < stim->tile_columns; tile_x++){
+					size_t tile = (size_t)tile_y*stim->tile_columns + tile_x;
+					if(bits[tile/8] & (1 << (tile%8))){
+						continue;
+					}
+					size_t offset = y*stride + tile_x*DELTA_TILE*pixel_bytes;
+					size_t length = stride - tile_x*DELTA_TILE*pixel_bytes;
+					length = length < DELTA_TILE*pixel_bytes ? length : DELTA_TILE*pixel_bytes;
+					if(memcmp(current + offset, previous + offset, length)){
+						bits[tile/8] |= 1 << (tile%8);
+						changed++;
+					}
+				}
+			}
+		}
+	}
+	stim->changed_fraction = (2.0*n_tiles + changed) / ((double)n_tiles*stim->n_frames);
+	return 0;
+}
+
+int map_tile_map(stimulus_t* stim, char* filename){
+	/*Maps a tile map that build_tile_map() made for the same raw,
+	saved to filename by a StimulusPool, so that attaching a pooled
+	raw does not compare every frame again, and every process
+	attaching it shares one copy of the map. Returns -1, leaving stim
+	without a map, if the file can't be mapped or is the wrong size*/
+	size_t n_tiles, changed = 0, byte;
+	set_tile_geometry(stim);
+	n_tiles = (size_t)(stim->tile_columns)*stim->tile_rows;
+	size_t length = (size_t)(stim->n_frames)*stim->tile_map_stride;
+	int fd = open(filename, O_RDONLY);
+	if(fd == -1){
+		return -1;
+	}
+	struct stat file_stat;
+	if(stim->n_frames < 3 || fstat(fd, &file_stat) == -1 || (size_t)file_stat.st_size != length){
+		close(fd);
+		return -1;
+	}
+	void* map = mmap(NULL, length, PROT_READ, MAP_SHARED|MAP_POPULATE, fd, 0);
+	close(fd);
+	if(map == MAP_FAILED){
+		return -1;
+	}
+	stim->tile_map = map;
+	stim->tile_map_length = length;
+	for(byte = 0; byte < length; byte++){
+		changed += __builtin_popcount(stim->tile_map[byte]);
+	}
+	stim->changed_fraction = (2.0*n_tiles + changed) / ((double)n_tiles*stim->n_frames);
+	return 0;
+}
+
+int debug_dump_grating(stimulus_t* stim, char* filename){
+	/*This is a debugging function that just dumps the header and
+	 * first 60 frames of a loaded grating (passed from python as a
+	 * grating.capsule object)*/
+	unsigned int frame;
+	unsigned int frames = stim->frames_stored < 60 ? stim->frames_stored : 60;
+	FILE * file = fopen(filename, "wb");
+	if(file == NULL){
+		perror("File creation failed\n");
+		PyErr_SetString(PyExc_OSError,"File creation failed.");
+		return 1;
+	}
+	if(stim->block != NULL){
+		fwrite(stim->block,1,stim->header_size,file);
+	}else{
+		write_header(file, stim->stim_type, stim->pixel_format, stim->width, stim->height,
+				frames, stim->n_frames, stim->frames_per_second, stim->refresh_per_frame, &stim->params);
+	}
+	for(frame = 0; frame < frames; frame++){
+		fwrite(stored_frame(stim, frame),1,stim->frame_size,file);
+	}
+	fclose(file);
+	return 0;
+}
+
+void convert_pixels(uint8_t* rgb, size_t n_pixels, uint8_t* write_loc, int colormode){
+	/*Convert n_pixels interleaved uint8 RGB pixels into colormode,
+	writing n_pixels*bytes_per_pixel(colormode) bytes to write_loc*/
+	size_t pixel;
+	unsigned char r, g, b;
+	uint16_t new_pixel_16;
+	uint24_t new_pixel_24;
+	uint32_t new_pixel_32;
+	for(pixel = 0; pixel < n_pixels; pixel++){
+		r = rgb[3*pixel];
+		g = rgb[3*pixel+1];
+		b = rgb[3*pixel+2];
+		if(colormode==GRAY8MODE){
+			//Rec. 601 luma, so that colour movies can be stored as grayscale
+			write_loc[pixel] = (299*r + 587*g + 114*b + 500)/1000;
+		}else if(colormode==XRGB8888MODE){
+			new_pixel_32 = rgb_to_uint_32bit(r,g,b);
+			memcpy(write_loc + pixel*sizeof(uint32_t), &new_pixel_32, sizeof(uint32_t));
+		}else if(colormode==RGB888MODE){
+			new_pixel_24 = rgb_to_uint_24bit(r,g,b);
+			memcpy(write_loc + pixel*sizeof(uint24_t), &new_pixel_24, sizeof(uint24_t));
+		}else{
+			new_pixel_16 = rgb_to_uint(r,g,b);
+			memcpy(write_loc + pixel*sizeof(uint16_t), &new_pixel_16, sizeof(uint16_t));
+		}
 	}
-	close(fh);
-	return frame_data;
 }
 
 int convert_raw(char* filename, char* new_filename, int n_frames, int width, int height, int refresh_per_frame, int colormode) {
@@ -740,107 +1324,575 @@ int convert_raw(char* filename, char* new_filename, int n_frames, int width, int
 		return 1;
 	}
 
-	fileheader_raw header;
-	header.n_frames = n_frames;
-	header.width = width;
-	header.height = height;
-	header.refresh_per_frame = refresh_per_frame;
-	fwrite(&header, sizeof(fileheader_raw),1,new_file);
-
 	off_t len = lseek(fh, 0, SEEK_END);
 	if (len == -1) {
 		printf("Checking File Length Failed.\n");
 		return 1;
 	}
-	char *buffer = mmap(0, len, PROT_READ, MAP_PRIVATE, fh, 0);
+	write_header(new_file, STIM_RAW, colormode, width, height, len/(3*(off_t)width*height),
+			n_frames, 0, refresh_per_frame, NULL);
+	uint8_t *buffer = mmap(0, len, PROT_READ, MAP_PRIVATE, fh, 0);
 
 	if (buffer == MAP_FAILED){
 		PyErr_SetString(PyExc_OSError,"MMAP failed");
 		return 1;
 	}
-	int i = 0;
-	char r, g, b;
-	uint16_t new_pixel_16;
-	uint24_t new_pixel_24;
-	while (i < len) {
-		r = buffer[i];
-		g = buffer[i+1];
-		b = buffer[i+2];
-		i += 3;
-		if(colormode==RGB888MODE){
-			new_pixel_24 = rgb_to_uint_24bit(r,g,b);
-			fwrite(&new_pixel_24,sizeof(uint24_t), 1, new_file);
-		}else{
-			new_pixel_16 = rgb_to_uint(r,g,b);
-			fwrite(&new_pixel_16,sizeof(uint16_t), 1, new_file);
-               }
+	//Convert a chunk of pixels at a time rather than writing each one
+	size_t chunk_pixels = CONVERT_CHUNK_PIXELS;
+	uint8_t* converted = malloc(chunk_pixels*bytes_per_pixel(colormode));
+	size_t n_pixels = len/3;
+	size_t pixel;
+	for (pixel = 0; pixel < n_pixels; pixel += chunk_pixels) {
+		if (n_pixels - pixel < chunk_pixels) {
+			chunk_pixels = n_pixels - pixel;
+		}
+		convert_pixels(buffer + 3*pixel, chunk_pixels, converted, colormode);
+		fwrite(converted, bytes_per_pixel(colormode), chunk_pixels, new_file);
 	}
+	free(converted);
 	munmap(buffer, len);
 	fclose(new_file);
 	close(fh);
 	return 0;
 }
 
-double* display_raw(void *frame_data, fb_config* fb0, int trig_pin, int colormode) {
+void* back_buffer(fb_config* fb0){
+	/*Start of the buffer that is not currently on screen*/
+	if(!fb0->current_buffer){
+		return (uint8_t*)(fb0->map) + fb0->size;
+	}
+	return fb0->map;
+}
 
-	pinMode(1, OUTPUT);
-	digitalWrite(1, LOW);
-	if (trig_pin > 0) {
-		pinMode(trig_pin, INPUT);
-		while (digitalRead(trig_pin) == 0) {
-			if (kbhit()) {
-				return 0;
-			}
+void copy_frame(void* write_loc, void* read_loc, fb_config* fb0, int colormode){
+	/*Copy one frame of pixels into a framebuffer buffer. 32 bit
+	pixels are copied as whole aligned words, whereas 24 bit
+	pixels are 3 byte units that straddle word boundaries*/
+	int pixel;
+	int n_pixels = fb0->width*fb0->height;
+	if(colormode == XRGB8888MODE){
+		uint32_t* write_loc_32 = write_loc;
+		uint32_t* read_loc_32 = read_loc;
+		for(pixel = 0; pixel < n_pixels; pixel++){
+			write_loc_32[pixel] = read_loc_32[pixel];
+		}
+	}else if(colormode == RGB888MODE){
+		uint24_t* write_loc_24 = write_loc;
+		uint24_t* read_loc_24 = read_loc;
+		for(pixel = 0; pixel < n_pixels; pixel++){
+			write_loc_24[pixel] = read_loc_24[pixel];
+		}
+	}else{
+		uint16_t* write_loc_16 = write_loc;
+		uint16_t* read_loc_16 = read_loc;
+		for(pixel = 0; pixel < n_pixels; pixel++){
+			write_loc_16[pixel] = read_loc_16[pixel];
 		}
 	}
-	fileheader_raw* header = frame_data;
-	frame_data = header + 1;
-	uint24_t * frame_data_24 = frame_data;
-	uint16_t * frame_data_16 = frame_data;
-
-	uint24_t * write_loc_24 = (uint24_t *)(fb0->map) + fb0->width*fb0->height;
-	uint16_t * write_loc_16 = (uint16_t *)(fb0->map) + fb0->width*fb0->height;
-	int t, pixel, clock_status, waits, pixel_size;
-	if (colormode == RGB888MODE){pixel_size = sizeof(uint24_t);    }
-	else                        {pixel_size = sizeof(uint16_t);    }
-	float *frame_duration_mean = malloc(2*sizeof(float));
-	float *frame_duration_std = frame_duration_mean+1;
-	struct timespec frame_start, frame_end;
-	__u32 dummy = 0;
+}
 
-	int n_frames = header -> n_frames;
-	int refresh_per_frame = header -> refresh_per_frame;
-        long timings[n_frames-1];
-	for (t = 0; t < n_frames; t++) {
-		frame_end = frame_start;
-		frame_start = get_current_time(&clock_status);
-		if(clock_status) {
-			return NULL;
-		}
-		if(!fb0->current_buffer){
-			write_loc_24 = fb0->map + 3*fb0->width*fb0->height;
-			write_loc_16 = fb0->map + 2*fb0->width*fb0->height;
-		} else {
-			write_loc_24 = fb0->map;
-			write_loc_16 = fb0->map;
-		}
-		for(pixel = 0; pixel < fb0->width*fb0->height; pixel++) {
-			if(colormode == RGB888MODE){
-				*write_loc_24 = frame_data_24[(t*fb0->size/pixel_size)+pixel];
-				write_loc_24++;
-			}else{
-				*write_loc_16 = frame_data_16[(t*fb0->size/pixel_size)+pixel];
-				write_loc_16++;
+void build_palette(void* palette, int colormode, int pixel_format, double contrast, int background, uint8_t* gamma){
+	/*Fill palette with the pixel, in colormode, for each of the 256
+	values an 8 bit stored pixel can take. GRAY8MODE values are grey
+	levels. MOD8MODE values are a modulation about background, scaled
+	by contrast as in build_grating. gamma, if not NULL, is a 256 entry
+	table mapping each grey level to the value written to the screen.
+	palette must have room for 256 uint32_t*/
+	int value, shade;
+	double modulation;
+	int amplitude = background < 128 ? background : 255 - background;
+	for(value = 0; value < 256; value++){
+		shade = value;
+		if(pixel_format == MOD8MODE){
+			modulation = (value - 128) / 127.0;
+			if(modulation < -1){
+				modulation = -1;
 			}
+			shade = int_round(background + contrast * amplitude * modulation);
+			shade = shade < 0 ? 0 : (shade > 255 ? 255 : shade);
 		}
-		if(t==0){
-			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		if(gamma != NULL){
+			shade = gamma[shade];
 		}
-		flip_buffer(fb0);
-		for (waits = 0; waits < refresh_per_frame; waits++) {
-			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
-			if (waits == 0) {
-				digitalWrite(1,HIGH);
+		if(colormode == XRGB8888MODE){
+			((uint32_t*)palette)[value] = rgb_to_uint_32bit(shade, shade, shade);
+		}else if(colormode == RGB888MODE){
+			((uint24_t*)palette)[value] = rgb_to_uint_24bit(shade, shade, shade);
+		}else{
+			((uint16_t*)palette)[value] = rgb_to_uint(shade, shade, shade);
+		}
+	}
+}
+
+void expand_pixels(void* write_loc, uint8_t* read_loc, int n_pixels, int colormode, void* palette){
+	/*Expand n_pixels consecutive 8 bit pixels through a palette*/
+	int pixel;
+	if(colormode == XRGB8888MODE){
+		uint32_t* write_loc_32 = write_loc;
+		uint32_t* palette_32 = palette;
+		for(pixel = 0; pixel < n_pixels; pixel++){
+			write_loc_32[pixel] = palette_32[read_loc[pixel]];
+		}
+	}else if(colormode == RGB888MODE){
+		uint24_t* write_loc_24 = write_loc;
+		uint24_t* palette_24 = palette;
+		for(pixel = 0; pixel < n_pixels; pixel++){
+			write_loc_24[pixel] = palette_24[read_loc[pixel]];
+		}
+	}else{
+		uint16_t* write_loc_16 = write_loc;
+		uint16_t* palette_16 = palette;
+		for(pixel = 0; pixel < n_pixels; pixel++){
+			write_loc_16[pixel] = palette_16[read_loc[pixel]];
+		}
+	}
+}
+
+void expand_frame(void* write_loc, uint8_t* read_loc, fb_config* fb0, int colormode, void* palette){
+	/*Expand one frame of 8 bit stored pixels into the colormode of
+	the framebuffer through a 256 entry palette*/
+	expand_pixels(write_loc, read_loc, fb0->width*fb0->height, colormode, palette);
+}
+
+void fill_pixels(void* write_loc, int n_pixels, int red, int green, int blue, int colormode){
+	/*Fill n_pixels consecutive pixels with a solid color*/
+	int pixel;
+	if(colormode == XRGB8888MODE){
+		uint32_t color_32 = rgb_to_uint_32bit(red,green,blue);
+		uint32_t* write_loc_32 = write_loc;
+		for(pixel = 0; pixel<n_pixels; pixel++){
+			write_loc_32[pixel] = color_32;
+		}
+	}else if(colormode == RGB888MODE){
+		uint24_t color_24 = rgb_to_uint_24bit(red,green,blue);
+		uint24_t* write_loc_24 = write_loc;
+		for(pixel = 0; pixel<n_pixels; pixel++){
+			write_loc_24[pixel] = color_24;
+		}
+	}else{
+		uint16_t color_16 = rgb_to_uint(red,green,blue);
+		uint16_t* write_loc_16 = write_loc;
+		for(pixel = 0; pixel<n_pixels; pixel++){
+			write_loc_16[pixel] = color_16;
+		}
+	}
+}
+
+void fill_frame(void* write_loc, fb_config* fb0, int red, int green, int blue, int colormode){
+	/*Fill one framebuffer buffer with a solid color*/
+	fill_pixels(write_loc, fb0->width*fb0->height, red, green, blue, colormode);
+}
+
+void scale_region(void* write_loc, uint8_t* read_loc, fb_config* fb0, stimulus_t* stim,
+		unsigned int left, unsigned int top, unsigned int width, unsigned int height,
+		int colormode, void* palette){
+	/*Nearest neighbour upscale of the width x height rectangle of a
+	stored frame with its top left corner at (left, top), by
+	stim->scale into a framebuffer buffer at the offset worked out
+	when it was loaded. Each stored row is widened once, expanding it
+	through palette if it is 8 bit, then copied to the scale-1 rows
+	below it. Pixels outside the scaled rectangle are left as they are*/
+	unsigned int x, y, k;
+	unsigned int scale = stim->scale;
+	int in_8bit = bytes_per_pixel(stim->pixel_format) == 1;
+	size_t out_stride = (size_t)(fb0->width)*bytes_per_pixel(colormode);
+	size_t row_bytes = (size_t)width*scale*bytes_per_pixel(colormode);
+	uint8_t* out_row = (uint8_t*)write_loc + (stim->offset_y + (size_t)top*scale)*out_stride +
+		(stim->offset_x + (size_t)left*scale)*bytes_per_pixel(colormode);
+	for(y = top; y < top + height; y++){
+		uint8_t* in_row = read_loc + ((size_t)y*stim->width + left)*bytes_per_pixel(stim->pixel_format);
+		if(colormode == XRGB8888MODE){
+			uint32_t* out_32 = (uint32_t*)out_row;
+			for(x = 0; x < width; x++){
+				uint32_t pixel_32 = in_8bit ? ((uint32_t*)palette)[in_row[x]] : ((uint32_t*)in_row)[x];
+				for(k = 0; k < scale; k++){
+					*out_32++ = pixel_32;
+				}
+			}
+		}else if(colormode == RGB888MODE){
+			uint24_t* out_24 = (uint24_t*)out_row;
+			for(x = 0; x < width; x++){
+				uint24_t pixel_24 = in_8bit ? ((uint24_t*)palette)[in_row[x]] : ((uint24_t*)in_row)[x];
+				for(k = 0; k < scale; k++){
+					*out_24++ = pixel_24;
+				}
+			}
+		}else{
+			uint16_t* out_16 = (uint16_t*)out_row;
+			for(x = 0; x < width; x++){
+				uint16_t pixel_16 = in_8bit ? ((uint16_t*)palette)[in_row[x]] : ((uint16_t*)in_row)[x];
+				for(k = 0; k < scale; k++){
+					*out_16++ = pixel_16;
+				}
+			}
+		}
+		for(k = 1; k < scale; k++){
+			memcpy(out_row + k*out_stride, out_row, row_bytes);
+		}
+		out_row += scale*out_stride;
+	}
+}
+
+void scale_frame(void* write_loc, uint8_t* read_loc, fb_config* fb0, stimulus_t* stim, int colormode, void* palette){
+	/*Nearest neighbour upscale of one stored frame, smaller than the
+	Screen, into a framebuffer buffer, see scale_region()*/
+	scale_region(write_loc, read_loc, fb0, stim, 0, 0, stim->width, stim->height, colormode, palette);
+}
+
+int is_scaled(fb_config* fb0, stimulus_t* stim){
+	/*True if stim does not exactly fill the Screen*/
+	return stim->width != fb0->width || stim->height != fb0->height;
+}
+
+void blit_frame(fb_config* fb0, stimulus_t* stim, unsigned int frame, int colormode, void* palette){
+	/*Write stored frame number frame of stim into the back buffer,
+	expanding it through palette if it is stored as 8 bit gray or
+	modulation, and upscaling it if it is smaller than the Screen*/
+	uint8_t* frame_data = stored_frame(stim, frame);
+	if(is_scaled(fb0, stim)){
+		scale_frame(back_buffer(fb0), frame_data, fb0, stim, colormode, palette);
+	}else if(bytes_per_pixel(stim->pixel_format) == 1){
+		expand_frame(back_buffer(fb0), frame_data, fb0, colormode, palette);
+	}else{
+		copy_frame(back_buffer(fb0), frame_data, fb0, colormode);
+	}
+}
+
+void blit_region(fb_config* fb0, stimulus_t* stim, uint8_t* frame_data, unsigned int left,
+		unsigned int top, unsigned int width, unsigned int height, int colormode, void* palette){
+	/*Write a rectangle of a stored frame into the same place in the
+	back buffer as blit_frame() would put it*/
+	unsigned int y;
+	if(stim->scale != 1){
+		scale_region(back_buffer(fb0), frame_data, fb0, stim, left, top, width, height, colormode, palette);
+		return;
+	}
+	size_t in_stride = (size_t)(stim->width)*bytes_per_pixel(stim->pixel_format);
+	size_t out_stride = (size_t)(fb0->width)*bytes_per_pixel(colormode);
+	uint8_t* in_row = frame_data + top*in_stride + left*bytes_per_pixel(stim->pixel_format);
+	uint8_t* out_row = (uint8_t*)back_buffer(fb0) + (stim->offset_y + top)*out_stride +
+		(stim->offset_x + left)*bytes_per_pixel(colormode);
+	for(y = 0; y < height; y++){
+		if(bytes_per_pixel(stim->pixel_format) == 1){
+			expand_pixels(out_row, in_row, width, colormode, palette);
+		}else{
+			memcpy(out_row, in_row, (size_t)width*bytes_per_pixel(colormode));
+		}
+		in_row += in_stride;
+		out_row += out_stride;
+	}
+}
+
+void delta_blit_frame(fb_config* fb0, stimulus_t* stim, unsigned int frame, int colormode, void* palette){
+	/*As blit_frame(), but for a raw with a tile map only redraws the
+	tiles that differ from frame-2, which the back buffer still holds.
+	Runs of changed tiles along a row of tiles are drawn as one
+	rectangle, so a frame where everything changed costs about the
+	same as a full copy*/
+	unsigned int tile_x, tile_y, first, left, top, width, height;
+	if(stim->tile_map == NULL || frame < 2){
+		blit_frame(fb0, stim, frame, colormode, palette);
+		return;
+	}
+	uint8_t* frame_data = stored_frame(stim, frame);
+	uint8_t* bits = stim->tile_map + (size_t)frame*stim->tile_map_stride;
+	for(tile_y = 0; tile_y < stim->tile_rows; tile_y++){
+		top = tile_y*DELTA_TILE;
+		height = stim->height - top < DELTA_TILE ? stim->height - top : DELTA_TILE;
+		tile_x = 0;
+		while(tile_x < stim->tile_columns){
+			size_t tile = (size_t)tile_y*stim->tile_columns + tile_x;
+			if(!(bits[tile/8] & (1 << (tile%8)))){
+				tile_x++;
+				continue;
+			}
+			first = tile_x;
+			do{
+				tile_x++;
+				tile++;
+			}while(tile_x < stim->tile_columns && (bits[tile/8] & (1 << (tile%8))));
+			left = first*DELTA_TILE;
+			width = (tile_x*DELTA_TILE < stim->width ? tile_x*DELTA_TILE : stim->width) - left;
+			blit_region(fb0, stim, frame_data, left, top, width, height, colormode, palette);
+		}
+	}
+}
+
+void blit_patch(fb_config* fb0, patch_t* patch, unsigned int frame, int colormode){
+	/*Write stored frame number frame of a patch into its rectangle of
+	the back buffer, row by row, so the cost is the patch's area and
+	not the Screen's*/
+	stimulus_t* stim = patch->stim;
+	unsigned int row;
+	uint8_t* in_row = stored_frame(stim, frame);
+	size_t in_stride = (size_t)(stim->width)*bytes_per_pixel(stim->pixel_format);
+	size_t out_stride = (size_t)(fb0->width)*bytes_per_pixel(colormode);
+	uint8_t* out_row = (uint8_t*)back_buffer(fb0) + patch->y*out_stride + patch->x*bytes_per_pixel(colormode);
+	int in_8bit = bytes_per_pixel(stim->pixel_format) == 1;
+	for(row = 0; row < stim->height; row++){
+		if(in_8bit){
+			expand_pixels(out_row, in_row, stim->width, colormode, patch->palette);
+		}else{
+			memcpy(out_row, in_row, in_stride);
+		}
+		in_row += in_stride;
+		out_row += out_stride;
+	}
+}
+
+void clear_patch(fb_config* fb0, patch_t* patch, int border, int colormode){
+	/*Fill a patch's rectangle of the back buffer with the border shade*/
+	unsigned int row;
+	size_t out_stride = (size_t)(fb0->width)*bytes_per_pixel(colormode);
+	uint8_t* out_row = (uint8_t*)back_buffer(fb0) + patch->y*out_stride + patch->x*bytes_per_pixel(colormode);
+	for(row = 0; row < patch->stim->height; row++){
+		fill_pixels(out_row, patch->stim->width, border, border, border, colormode);
+		out_row += out_stride;
+	}
+}
+
+unsigned int patch_frame(patch_t* patch, unsigned int refresh){
+	/*The stored frame of a patch shown refresh refreshes after it
+	first appeared. Gratings loop over their stored frames, raws
+	hold each frame for refresh_per_frame refreshes and loop if
+	shown for longer than they last*/
+	stimulus_t* stim = patch->stim;
+	if(stim->stim_type == STIM_RAW && stim->refresh_per_frame > 1){
+		refresh /= stim->refresh_per_frame;
+	}
+	return refresh % stim->frames_stored;
+}
+
+double* display_patches(fb_config* fb0, patch_t* patches, int n_patches, int trig_pin, int colormode, int border){
+	/*Composite several stimuli, each smaller than the Screen, over
+	the border shade. Both buffers are filled with the border once,
+	after which each refresh only writes the rectangles of patches
+	that are showing, and clears those of patches that stopped in
+	the last two refreshes (the back buffer still holds the frame
+	from two refreshes ago). Patches are drawn in order, so later
+	patches cover earlier ones where they overlap. Returns the mean
+	and standard deviation of the interframe interval in usecs, or
+	NULL on failure*/
+	int i, t, clock_status;
+	int n_refreshes = 0;
+	__u32 dummy = 0;
+	struct timespec frame_start, frame_end;
+	for(i = 0; i < n_patches; i++){
+		if((int)(patches[i].start + patches[i].n_refreshes) > n_refreshes){
+			n_refreshes = patches[i].start + patches[i].n_refreshes;
+		}
+	}
+	if(n_refreshes < 1){
+		set_error_nogil(PyExc_ValueError, "Patches have no refreshes to display");
+		return NULL;
+	}
+	fill_frame(fb0->map, fb0, border, border, border, colormode);
+	fill_frame((uint8_t*)(fb0->map) + fb0->size, fb0, border, border, border, colormode);
+	pinMode(1, OUTPUT);
+	digitalWrite(1, LOW);
+	if (trig_pin > 0 && wait_for_trigger(trig_pin)) {
+		return NULL;
+	}
+	double* frame_duration_mean = malloc(2*sizeof(double));
+	double* frame_duration_std = frame_duration_mean+1;
+	long timings[n_refreshes > 1 ? n_refreshes-1 : 1];
+	for(t = 0; t < n_refreshes; t++){
+		frame_end = frame_start;
+		frame_start = get_current_time(&clock_status);
+		if(clock_status){
+			free(frame_duration_mean);
+			return NULL;
+		}
+		for(i = 0; i < n_patches; i++){
+			int end = patches[i].start + patches[i].n_refreshes;
+			if(t >= end && t < end + 2){
+				clear_patch(fb0, &patches[i], border, colormode);
+			}
+		}
+		for(i = 0; i < n_patches; i++){
+			if(t >= (int)patches[i].start && t < (int)(patches[i].start + patches[i].n_refreshes)){
+				blit_patch(fb0, &patches[i], patch_frame(&patches[i], t - patches[i].start), colormode);
+			}
+		}
+		if(t==0){
+			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		}
+		flip_buffer(fb0);
+		ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		digitalWrite(1,HIGH);
+		usleep(2000);
+		digitalWrite(1,LOW);
+		if(t != 0){
+			timings[t-1] = cmp_times(frame_end, frame_start);
+		}
+	}
+	*frame_duration_mean = mean_long(timings, n_refreshes-1);
+	*frame_duration_std = std_long(timings, n_refreshes-1);
+	return frame_duration_mean;
+}
+
+uint64_t noise_random(uint64_t seed, uint64_t counter){
+	/*The counter'th output of a splitmix64 generator started at seed,
+	computed directly so that any frame can be generated on its own.
+	rpg/noise.py repeats this exactly, so analysis can regenerate
+	frames without the C module*/
+	uint64_t z = seed + (counter + 1)*0x9E3779B97F4A7C15ULL;
+	z = (z ^ (z >> 30))*0xBF58476D1CE4E5B9ULL;
+	z = (z ^ (z >> 27))*0x94D049BB133111EBULL;
+	return z ^ (z >> 31);
+}
+
+void noise_cells(noise_t* noise, unsigned int frame, uint8_t* cells){
+	/*Fill cells with frame number frame of noise, one modulation level
+	per cell as stored by MOD8MODE gratings: 255 for white, 1 for black
+	and 128 for background*/
+	unsigned int cell;
+	unsigned int n_cells = noise->columns*noise->rows;
+	for(cell = 0; cell < n_cells; cell++){
+		uint64_t z = noise_random(noise->seed, (uint64_t)frame*n_cells + cell);
+		int lit = (z >> 40) < noise->threshold;
+		if(noise->kind == NOISE_CHECKERBOARD){
+			cells[cell] = lit ? 255 : 1;
+		}else if(!lit){
+			cells[cell] = 128;
+		}else if(noise->polarity == POLARITY_BOTH){
+			cells[cell] = (z & 1) ? 255 : 1;
+		}else{
+			cells[cell] = noise->polarity == POLARITY_ON ? 255 : 1;
+		}
+	}
+}
+
+void render_noise(void* write_loc, fb_config* fb0, noise_t* noise, uint8_t* cells, uint8_t* row_buffer, int colormode, void* palette){
+	/*Draw one frame of cells into a framebuffer buffer. Cells are the
+	largest whole number of pixels that fits the grid onto the Screen,
+	and the grid is centred. One row of pixels is expanded through the
+	palette per row of cells, then copied to the rows below it, so the
+	cost is about that of one frame copy. Pixels around the grid are
+	left as they are*/
+	unsigned int row, column, k;
+	unsigned int cell_width = fb0->width / noise->columns;
+	unsigned int cell_height = fb0->height / noise->rows;
+	unsigned int grid_width = cell_width*noise->columns;
+	size_t out_stride = (size_t)(fb0->width)*bytes_per_pixel(colormode);
+	size_t row_bytes = (size_t)grid_width*bytes_per_pixel(colormode);
+	uint8_t* out_row = (uint8_t*)write_loc + ((fb0->height - cell_height*noise->rows)/2)*out_stride
+		+ ((fb0->width - grid_width)/2)*bytes_per_pixel(colormode);
+	for(row = 0; row < noise->rows; row++){
+		for(column = 0; column < noise->columns; column++){
+			memset(row_buffer + column*cell_width, cells[row*noise->columns + column], cell_width);
+		}
+		expand_pixels(out_row, row_buffer, grid_width, colormode, palette);
+		for(k = 1; k < cell_height; k++){
+			memcpy(out_row + k*out_stride, out_row, row_bytes);
+		}
+		out_row += cell_height*out_stride;
+	}
+}
+
+double* benchmark_copy(int width, int height, int colormode, int n_frames, int source_format){
+	/*Times the per-frame copy between two private buffers, without a
+	framebuffer or vsync, to compare the cost of each colormode and of
+	expanding 8 bit frames (source_format GRAY8MODE or MOD8MODE) through
+	a palette. MOD8MODE frames are timed through a quarter contrast LUT.
+	Consecutive frames come from alternating source buffers so the
+	copy is not served from a warm cache. Returns the mean and
+	standard deviation in usecs, or NULL on failure*/
+	fb_config fb0;
+	fb0.width = width;
+	fb0.height = height;
+	fb0.size = width*height*bytes_per_pixel(colormode);
+	size_t source_size = (size_t)width*height*bytes_per_pixel(source_format);
+	uint32_t palette[256];
+	build_palette(palette, colormode, source_format, 0.25, 127, NULL);
+	uint8_t* source = malloc(2*source_size);
+	uint8_t* dest = malloc(fb0.size);
+	double* result = malloc(2*sizeof(double));
+	long* timings = malloc(n_frames*sizeof(long));
+	if(source == NULL || dest == NULL || result == NULL || timings == NULL || n_frames < 1){
+		free(source); free(dest); free(result); free(timings);
+		return NULL;
+	}
+	memset(source, 0x5a, 2*source_size);
+	memset(dest, 0, fb0.size);
+	int t, clock_status;
+	struct timespec copy_start, copy_end;
+	for(t = 0; t < n_frames; t++){
+		copy_start = get_current_time(&clock_status);
+		if(bytes_per_pixel(source_format) == 1){
+			expand_frame(dest, source + (t%2)*source_size, &fb0, colormode, palette);
+		}else{
+			copy_frame(dest, source + (t%2)*source_size, &fb0, colormode);
+		}
+		copy_end = get_current_time(&clock_status);
+		if(clock_status){
+			free(source); free(dest); free(result); free(timings);
+			return NULL;
+		}
+		timings[t] = cmp_times(copy_start, copy_end);
+	}
+	result[0] = mean_long(timings, n_frames);
+	result[1] = std_long(timings, n_frames);
+	free(source);
+	free(dest);
+	free(timings);
+	return result;
+}
+
+void fill_border(fb_config* fb0, stimulus_t* stim, int border, int colormode){
+	/*Letterboxed frames only cover part of the Screen, so fill both
+	buffers with the border shade once, before the first frame*/
+	if(is_scaled(fb0, stim)){
+		fill_frame(fb0->map, fb0, border, border, border, colormode);
+		fill_frame((uint8_t*)(fb0->map) + fb0->size, fb0, border, border, border, colormode);
+	}
+}
+
+double* display_noise(noise_t* noise, fb_config* fb0, int trig_pin, int colormode, void* palette, int border){
+	/*Generate and display each frame of noise in turn, holding each
+	for noise->hold refreshes, as display_raw() holds the frames of
+	a raw. Returns the mean and standard deviation of the interval
+	between frames in usecs, or NULL on failure*/
+	uint8_t* cells = malloc(noise->columns*noise->rows);
+	uint8_t* row_buffer = malloc(fb0->width);
+	if(cells == NULL || row_buffer == NULL){
+		free(cells); free(row_buffer);
+		set_error_nogil(PyExc_MemoryError, "Could not allocate noise frame");
+		return NULL;
+	}
+	fill_frame(fb0->map, fb0, border, border, border, colormode);
+	fill_frame((uint8_t*)(fb0->map) + fb0->size, fb0, border, border, border, colormode);
+	pinMode(1, OUTPUT);
+	digitalWrite(1, LOW);
+	if (trig_pin > 0 && wait_for_trigger(trig_pin)) {
+		free(cells); free(row_buffer);
+		return NULL;
+	}
+	int t, clock_status, waits;
+	double *frame_duration_mean = malloc(2*sizeof(double));
+	double *frame_duration_std = frame_duration_mean+1;
+	struct timespec frame_start, frame_end;
+	__u32 dummy = 0;
+
+	int n_frames = noise->n_frames;
+	long timings[n_frames > 1 ? n_frames-1 : 1];
+	for (t = 0; t < n_frames; t++) {
+		frame_end = frame_start;
+		frame_start = get_current_time(&clock_status);
+		if(clock_status) {
+			free(cells); free(row_buffer); free(frame_duration_mean);
+			return NULL;
+		}
+		noise_cells(noise, t, cells);
+		render_noise(back_buffer(fb0), fb0, noise, cells, row_buffer, colormode, palette);
+		if(t==0){
+			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		}
+		flip_buffer(fb0);
+		for (waits = 0; waits < noise->hold; waits++) {
+			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+			if (waits == 0) {
+				digitalWrite(1,HIGH);
 				usleep(2000);
 				digitalWrite(1,LOW);
 			}
@@ -849,43 +1901,129 @@ double* display_raw(void *frame_data, fb_config* fb0, int trig_pin, int colormod
 			timings[t-1] = cmp_times(frame_end, frame_start);
 		}
 	}
+	free(cells);
+	free(row_buffer);
 	*frame_duration_mean = mean_long(timings, n_frames-1);
 	*frame_duration_std = std_long(timings, n_frames-1);
 	return frame_duration_mean;
 }
 
-double* display_grating(void* frame_data, fb_config* fb0, int trig_pin, int colormode){
+double* benchmark_noise(int width, int height, int colormode, noise_t* noise){
+	/*Times generating and drawing each frame of noise into a private
+	buffer, without a framebuffer or vsync, for comparison with the
+	time available per refresh. Returns the mean and standard
+	deviation in usecs, or NULL on failure*/
+	fb_config fb0;
+	fb0.width = width;
+	fb0.height = height;
+	fb0.size = width*height*bytes_per_pixel(colormode);
+	uint32_t palette[256];
+	build_palette(palette, colormode, MOD8MODE, 1, 127, NULL);
+	uint8_t* dest = malloc(fb0.size);
+	uint8_t* cells = malloc(noise->columns*noise->rows);
+	uint8_t* row_buffer = malloc(width);
+	double* result = malloc(2*sizeof(double));
+	long* timings = malloc(noise->n_frames*sizeof(long));
+	if(dest == NULL || cells == NULL || row_buffer == NULL || result == NULL || timings == NULL){
+		free(dest); free(cells); free(row_buffer); free(result); free(timings);
+		return NULL;
+	}
+	memset(dest, 0, fb0.size);
+	unsigned int t;
+	int clock_status;
+	struct timespec start, end;
+	for(t = 0; t < noise->n_frames; t++){
+		start = get_current_time(&clock_status);
+		noise_cells(noise, t, cells);
+		render_noise(dest, &fb0, noise, cells, row_buffer, colormode, palette);
+		end = get_current_time(&clock_status);
+		if(clock_status){
+			free(dest); free(cells); free(row_buffer); free(result); free(timings);
+			return NULL;
+		}
+		timings[t] = cmp_times(start, end);
+	}
+	result[0] = mean_long(timings, noise->n_frames);
+	result[1] = std_long(timings, noise->n_frames);
+	free(dest);
+	free(cells);
+	free(row_buffer);
+	free(timings);
+	return result;
+}
+
+double* display_raw(stimulus_t* stim, fb_config* fb0, int trig_pin, int colormode, void* palette, int border) {
 
+	if (stim->n_frames < 1) {
+		set_error_nogil(PyExc_ValueError, "Raw has no frames to display");
+		return NULL;
+	}
+	fill_border(fb0, stim, border, colormode);
 	pinMode(1, OUTPUT);
 	digitalWrite(1, LOW);
-	if (trig_pin > 0) {
-		pinMode(trig_pin, INPUT);
-		while (digitalRead(trig_pin) == 0) {
-			if (kbhit()) {
-				return NULL;
+	if (trig_pin > 0 && wait_for_trigger(trig_pin)) {
+		return NULL;
+	}
+	int t, clock_status, waits;
+	double *frame_duration_mean = malloc(2*sizeof(double));
+	double *frame_duration_std = frame_duration_mean+1;
+	struct timespec frame_start, frame_end;
+	__u32 dummy = 0;
+
+	int n_frames = stim->n_frames;
+	int refresh_per_frame = stim->refresh_per_frame;
+	//A still image is a single frame, with no intervals to time
+	long timings[n_frames > 1 ? n_frames-1 : 1];
+	for (t = 0; t < n_frames; t++) {
+		frame_end = frame_start;
+		frame_start = get_current_time(&clock_status);
+		if(clock_status) {
+			return NULL;
+		}
+		delta_blit_frame(fb0, stim, t, colormode, palette);
+		if(t==0){
+			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		}
+		flip_buffer(fb0);
+		for (waits = 0; waits < refresh_per_frame; waits++) {
+			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+			if (waits == 0) {
+				digitalWrite(1,HIGH);
+				usleep(2000);
+				digitalWrite(1,LOW);
 			}
 		}
+		if (t != 0) {
+			timings[t-1] = cmp_times(frame_end, frame_start);
+		}
 	}
+	*frame_duration_mean = mean_long(timings, n_frames-1);
+	*frame_duration_std = std_long(timings, n_frames-1);
+	return frame_duration_mean;
+}
 
-	fileheader_t* header = frame_data;
-	frame_data = (header + 1);
-	uint24_t * frame_data_24 = frame_data;
-	uint16_t * frame_data_16 = frame_data;
+double* display_grating(stimulus_t* stim, fb_config* fb0, int trig_pin, int colormode, void* palette, int border){
 
-	uint24_t * write_loc_24 = (uint24_t *)(fb0->map) + fb0->width*fb0->height;
-	uint16_t * write_loc_16 = (uint16_t *)(fb0->map) + fb0->width*fb0->height;
+	if (stim->n_frames < 1) {
+		set_error_nogil(PyExc_ValueError, "Grating has no frames to display");
+		return NULL;
+	}
+	fill_border(fb0, stim, border, colormode);
+	pinMode(1, OUTPUT);
+	digitalWrite(1, LOW);
+	if (trig_pin > 0 && wait_for_trigger(trig_pin)) {
+		return NULL;
+	}
 
-	int t, pixel, frame, clock_status, pixel_size;
-	if (colormode == RGB888MODE){pixel_size = sizeof(uint24_t);    }
-	else                        {pixel_size = sizeof(uint16_t);    }
+	int t, frame, clock_status;
 
 	double* frame_duration_mean = malloc(2*sizeof(double));
 	double* frame_duration_std = frame_duration_mean+1;
 	struct timespec frame_start, frame_end;
 	__u32 dummy = 0;
 
-	int n_frames = header->n_frames;
-	long timings[n_frames-1];
+	int n_frames = stim->n_frames;
+	long timings[n_frames > 1 ? n_frames-1 : 1];
 	for (t=0; t < n_frames; t++){
                 frame_end = frame_start;
                 frame_start = get_current_time(&clock_status);
@@ -893,23 +2031,8 @@ double* display_grating(void* frame_data, fb_config* fb0, int trig_pin, int colo
 			return NULL;
 		}
 
-		frame = t%(header->frames_per_cycle);
-		if(!fb0->current_buffer){
-			write_loc_24 = fb0->map + 3*fb0->width*fb0->height;
-			write_loc_16 = fb0->map + 2*fb0->width*fb0->height;
-		} else {
-			write_loc_24 = fb0->map;
-			write_loc_16 = fb0->map;
-		}
-		for(pixel = 0; pixel<fb0->width*fb0->height; pixel++){
-			if(colormode == RGB888MODE){
-				*write_loc_24 = frame_data_24[(frame*fb0->size/pixel_size)+pixel];
-				write_loc_24++;
-			}else{
-				*write_loc_16 = frame_data_16[(frame*fb0->size/pixel_size)+pixel];
-				write_loc_16++;
-			}
-		}
+		frame = t%(stim->frames_stored);
+		blit_frame(fb0, stim, frame, colormode, palette);
 		if(t==0){
 			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
 		}
@@ -927,49 +2050,342 @@ double* display_grating(void* frame_data, fb_config* fb0, int trig_pin, int colo
 	return frame_duration_mean;
 }
 
-int unload_grating(void* frame_data){
-	free(frame_data);
+int display_color(fb_config* fb0, int red, int green, int blue, int colormode, int blocking){
+	__u32 dummy = 0;
+	fill_frame(back_buffer(fb0), fb0, red, green, blue, colormode);
+	flip_buffer(fb0);
+	if(blocking){
+		ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		digitalWrite(1,HIGH);
+		usleep(2000);
+		digitalWrite(1,LOW);
+	}
 	return 0;
 }
 
-int unload_raw(uint16_t* raw_data) {
-	free(raw_data);
+int64_t monotonic_ns(void){
+	/*CLOCK_MONOTONIC in nsecs. Unlike get_current_time() this clock
+	is shared by every process and never steps, so the time a
+	parameter was written can be compared with the time it was shown*/
+	struct timespec t;
+	clock_gettime(CLOCK_MONOTONIC, &t);
+	return t.tv_nsec + 1000000000*(int64_t)(t.tv_sec);
+}
+
+uint64_t write_params(param_block_t* block, param_block_t* values){
+	/*Copy the parameters in values into the shared block. There must
+	only be one writer. Returns the update_id of the write*/
+	uint32_t sequence = __atomic_load_n(&block->sequence, __ATOMIC_RELAXED);
+	__atomic_store_n(&block->sequence, sequence + 1, __ATOMIC_RELAXED);
+	__atomic_thread_fence(__ATOMIC_RELEASE);
+	uint64_t update_id = block->update_id + 1;
+	block->update_id = update_id;
+	block->written_ns = monotonic_ns();
+	block->x = values->x;
+	block->y = values->y;
+	block->phase = values->phase;
+	block->contrast = values->contrast;
+	block->orientation = values->orientation;
+	__atomic_store_n(&block->sequence, sequence + 2, __ATOMIC_RELEASE);
+	return update_id;
+}
+
+int read_params(param_block_t* block, param_block_t* snapshot){
+	/*Copy a consistent snapshot of the shared block. Never blocks on
+	the writer: gives up after SEQLOCK_RETRIES attempts, leaving
+	snapshot as it was, and returns 0. Returns 1 on success*/
+	int attempt;
+	uint32_t before, after;
+	param_block_t copy;
+	for(attempt = 0; attempt < SEQLOCK_RETRIES; attempt++){
+		before = __atomic_load_n(&block->sequence, __ATOMIC_ACQUIRE);
+		if(before & 1){
+			continue;
+		}
+		memcpy(&copy, block, sizeof(param_block_t));
+		__atomic_thread_fence(__ATOMIC_ACQUIRE);
+		after = __atomic_load_n(&block->sequence, __ATOMIC_RELAXED);
+		if(before == after){
+			*snapshot = copy;
+			return 1;
+		}
+	}
 	return 0;
 }
 
-int display_color(fb_config* fb0, uint16_t color_16, uint24_t color_24, int colormode, int blocking){
-	__u32 dummy = 0;
-	uint16_t *write_loc_16;
-	uint24_t *write_loc_24;
-	int pixel;
-	if(!fb0->current_buffer){
-		write_loc_24 = fb0->map + 3*fb0->width*fb0->height;
-		write_loc_16 = fb0->map + 2*fb0->width*fb0->height;
-	} else {
-		write_loc_24 = fb0->map;
-		write_loc_16 = fb0->map;
+int init_closed_loop(closed_loop_t* stim, int width, double sf, double tf, int fps, int waveform, double percent_diameter, double percent_sigma){
+	/*Work out everything about a closed-loop grating that does not
+	change from frame to frame: one cycle of the waveform, and the
+	aperture, which is a hard edged circle of percent_diameter, a
+	gaussian of percent_sigma cut off at percent_diameter (or at
+	3 sigma), or the whole Screen. Returns 0, or -1 if out of memory*/
+	int i, j, size;
+	double r;
+	int sigma = width * percent_sigma / 100;
+	stim->wavelength = (width/(double)DEGREES_SUBTENDED)/sf;
+	stim->drift = 360*tf/fps;
+	stim->radius = width * percent_diameter / 200;
+	if(stim->radius == 0 && sigma > 0){
+		stim->radius = 3*sigma;
+	}
+	for(i = 0; i < WAVE_TABLE_SIZE; i++){
+		if(waveform == SQUARE){
+			stim->wave[i] = i < WAVE_TABLE_SIZE/2 ? 127 : -127;
+		}else{
+			stim->wave[i] = int_round(127*sin(2*M_PI*i/WAVE_TABLE_SIZE));
+		}
+	}
+	stim->envelope = NULL;
+	if(stim->radius == 0){
+		return 0;
 	}
+	size = 2*stim->radius + 1;
+	stim->envelope = malloc((size_t)size*size*sizeof(uint16_t));
+	if(stim->envelope == NULL){
+		return -1;
+	}
+	for(i = 0; i < size; i++){
+		for(j = 0; j < size; j++){
+			r = sqrt((i-stim->radius)*(i-stim->radius) + (j-stim->radius)*(j-stim->radius));
+			if(r > stim->radius){
+				stim->envelope[i*size + j] = 0;
+			}else if(sigma > 0){
+				stim->envelope[i*size + j] = int_round(256*exp(-r*r/(2.0*sigma*sigma)));
+			}else{
+				stim->envelope[i*size + j] = 256;
+			}
+		}
+	}
+	return 0;
+}
 
-	for(pixel = 0; pixel<fb0->width*fb0->height; pixel++){
-		if(colormode == RGB888MODE){
-			*write_loc_24 = color_24;
-			write_loc_24++;
+void render_closed_loop(uint8_t* frame, fb_config* fb0, closed_loop_t* stim, param_block_t* params, double phase){
+	/*Render one frame of a closed-loop grating as 8 bit modulation
+	levels, as stored by MOD8MODE gratings, to be expanded through a
+	palette. The phase of each pixel is kept as a 32 bit fixed point
+	fraction of a cycle, stepped by one add per pixel, and its top
+	WAVE_TABLE_BITS index the waveform. Only the aperture is rendered,
+	the rest of the frame is set to no modulation (background)*/
+	int x, y, x0, x1, dy;
+	int width = fb0->width;
+	int height = fb0->height;
+	int radius = stim->radius;
+	int size = 2*radius + 1;
+	int centre_x = isnan(params->x) ? width/2 : (int)lround(params->x);
+	int centre_y = isnan(params->y) ? height/2 : (int)lround(params->y);
+	double angle = (180 - params->orientation)*M_PI/180;
+	uint32_t step_x = (uint32_t)llround(cos(angle)/stim->wavelength*4294967296.0);
+	uint32_t step_y = (uint32_t)llround(sin(angle)/stim->wavelength*4294967296.0);
+	uint32_t start = (uint32_t)llround(fmod(phase, 360)/360*4294967296.0);
+	for(y = 0; y < height; y++){
+		uint8_t* row = frame + (size_t)y*width;
+		dy = y - centre_y;
+		x0 = radius ? centre_x - radius : 0;
+		x1 = radius ? centre_x + radius : width - 1;
+		x0 = x0 < 0 ? 0 : x0;
+		x1 = x1 > width - 1 ? width - 1 : x1;
+		if((radius && (dy < -radius || dy > radius)) || x0 > x1){
+			memset(row, 128, width);
+			continue;
+		}
+		memset(row, 128, x0);
+		memset(row + x1 + 1, 128, width - 1 - x1);
+		uint32_t acc = start + (uint32_t)(x0 - centre_x)*step_x + (uint32_t)dy*step_y;
+		if(stim->envelope == NULL){
+			for(x = x0; x <= x1; x++){
+				row[x] = 128 + stim->wave[acc >> (32 - WAVE_TABLE_BITS)];
+				acc += step_x;
+			}
 		}else{
-			*write_loc_16 = color_16;
-			write_loc_16++;
+			uint16_t* weights = stim->envelope + (dy + radius)*size + (x0 - centre_x + radius);
+			for(x = x0; x <= x1; x++){
+				row[x] = 128 + ((stim->wave[acc >> (32 - WAVE_TABLE_BITS)] * *weights++) >> 8);
+				acc += step_x;
+			}
 		}
 	}
+}
 
-	flip_buffer(fb0);
-	if(blocking){
+double* display_closed_loop(fb_config* fb0, param_block_t* block, closed_loop_t* stim, int n_frames, int trig_pin, int colormode, int background, uint8_t* gamma){
+	/*Display a grating rendered each frame from the latest parameters
+	in block, for n_frames refreshes. Returns the mean and standard
+	deviation of the interframe interval in usecs, the number of
+	parameter writes made during the display, the number of them
+	that were shown (writes superseded within one frame are never
+	shown), and the mean and maximum latency from a write to the
+	refresh that first showed it, in usecs. NULL on failure*/
+	int t, clock_status, n_shown = 0;
+	__u32 dummy = 0;
+	struct timespec frame_start, frame_end;
+	param_block_t params;
+	uint32_t palette[256];
+	double contrast = -1;
+	uint8_t* frame = malloc((size_t)fb0->width*fb0->height);
+	long* timings = malloc((n_frames-1)*sizeof(long));
+	long* latencies = malloc(n_frames*sizeof(long));
+	double* result = malloc(6*sizeof(double));
+	if(frame == NULL || timings == NULL || latencies == NULL || result == NULL){
+		free(frame); free(timings); free(latencies); free(result);
+		set_error_nogil(PyExc_MemoryError, "Could not allocate closed-loop frame");
+		return NULL;
+	}
+	memset(&params, 0, sizeof(param_block_t));
+	params.x = params.y = NAN;
+	read_params(block, &params);
+	uint64_t first_update = params.update_id;
+	uint64_t last_shown = first_update;
+
+	pinMode(1, OUTPUT);
+	digitalWrite(1, LOW);
+	if (trig_pin > 0 && wait_for_trigger(trig_pin)) {
+		free(frame); free(timings); free(latencies); free(result);
+		return NULL;
+	}
+	for(t = 0; t < n_frames; t++){
+		frame_end = frame_start;
+		frame_start = get_current_time(&clock_status);
+		if(clock_status){
+			free(frame); free(timings); free(latencies); free(result);
+			return NULL;
+		}
+		read_params(block, &params);
+		if(params.contrast != contrast){
+			contrast = params.contrast < 0 ? 0 : (params.contrast > 1 ? 1 : params.contrast);
+			build_palette(palette, colormode, MOD8MODE, contrast, background, gamma);
+			contrast = params.contrast;
+		}
+		render_closed_loop(frame, fb0, stim, &params, params.phase + stim->drift*t);
+		expand_frame(back_buffer(fb0), frame, fb0, colormode, palette);
+		if(t==0){
+			ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		}
+		flip_buffer(fb0);
 		ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		if(params.update_id != last_shown){
+			latencies[n_shown++] = (monotonic_ns() - params.written_ns)/1000;
+			last_shown = params.update_id;
+		}
 		digitalWrite(1,HIGH);
 		usleep(2000);
 		digitalWrite(1,LOW);
+		if(t != 0){
+			timings[t-1] = cmp_times(frame_end, frame_start);
+		}
+	}
+	read_params(block, &params);
+	result[0] = mean_long(timings, n_frames-1);
+	result[1] = std_long(timings, n_frames-1);
+	result[2] = params.update_id - first_update;
+	result[3] = n_shown;
+	result[4] = n_shown ? mean_long(latencies, n_shown) : 0;
+	result[5] = 0;
+	for(t = 0; t < n_shown; t++){
+		if(latencies[t] > result[5]){
+			result[5] = latencies[t];
+		}
+	}
+	free(frame);
+	free(timings);
+	free(latencies);
+	return result;
+}
+
+double* vsync_intervals(fb_config* fb0, int n_frames, int shade, int colormode){
+	/*Flips between buffers filled with shade for n_frames refreshes,
+	timing each frame as display_grating does, so the jitter of the
+	display loop can be measured without a stimulus. Returns the
+	n_frames-1 interframe intervals in usecs, or NULL on failure*/
+	int t, clock_status;
+	__u32 dummy = 0;
+	struct timespec frame_start, frame_end;
+	double* intervals = malloc((n_frames-1)*sizeof(double));
+	if(intervals == NULL){
+		return NULL;
+	}
+	for(t = 0; t < n_frames; t++){
+		frame_end = frame_start;
+		frame_start = get_current_time(&clock_status);
+		if(clock_status){
+			free(intervals);
+			return NULL;
+		}
+		fill_frame(back_buffer(fb0), fb0, shade, shade, shade, colormode);
+		flip_buffer(fb0);
+		ioctl(fb0->framebuffer, FBIO_WAITFORVSYNC, &dummy);
+		if(t != 0){
+			intervals[t-1] = cmp_times(frame_end, frame_start);
+		}
+	}
+	return intervals;
+}
+
+void prefault_stack(void){
+	/*Touch PREFAULT_STACK_SIZE bytes of stack, so that once memory
+	is locked the display loop never faults while its stack grows*/
+	uint8_t stack[PREFAULT_STACK_SIZE];
+	int i;
+	for(i = 0; i < PREFAULT_STACK_SIZE; i += 4096){
+		stack[i] = 0;
 	}
+	//Stops the compiler dropping the writes as dead stores
+	__asm__ volatile("" : : "r"(stack) : "memory");
+}
+
+int set_realtime(int priority, int cpu, int* old_policy, int* old_priority, cpu_set_t* old_affinity){
+	/*Give the calling thread SCHED_FIFO priority, pin it to cpu
+	(unless cpu is negative) and lock all of the process's memory,
+	so the display loop is not preempted or paged between the frame
+	copy and the flip. MCL_FUTURE locks every later mapping in the
+	process too, from any thread, until clear_realtime(). The thread's previous scheduling is written
+	to the old_ arguments for clear_realtime(). Returns 0, or an
+	errno value with nothing changed*/
+	pthread_t self = pthread_self();
+	struct sched_param param;
+	cpu_set_t affinity;
+	int error = pthread_getschedparam(self, old_policy, &param);
+	if(error){
+		return error;
+	}
+	*old_priority = param.sched_priority;
+	error = pthread_getaffinity_np(self, sizeof(cpu_set_t), old_affinity);
+	if(error){
+		return error;
+	}
+	if(mlockall(MCL_CURRENT|MCL_FUTURE)){
+		return errno;
+	}
+	if(cpu >= 0){
+		CPU_ZERO(&affinity);
+		CPU_SET(cpu, &affinity);
+		error = pthread_setaffinity_np(self, sizeof(cpu_set_t), &affinity);
+		if(error){
+			munlockall();
+			return error;
+		}
+	}
+	param.sched_priority = priority;
+	error = pthread_setschedparam(self, SCHED_FIFO, &param);
+	if(error){
+		pthread_setaffinity_np(self, sizeof(cpu_set_t), old_affinity);
+		munlockall();
+		return error;
+	}
+	prefault_stack();
 	return 0;
 }
 
+int clear_realtime(int old_policy, int old_priority, cpu_set_t* old_affinity){
+	/*Undo set_realtime() on the calling thread. Returns 0 or an
+	errno value*/
+	pthread_t self = pthread_self();
+	struct sched_param param;
+	param.sched_priority = old_priority;
+	int error = pthread_setschedparam(self, old_policy, &param);
+	int affinity_error = pthread_setaffinity_np(self, sizeof(cpu_set_t), old_affinity);
+	munlockall();
+	return error ? error : affinity_error;
+}
+
 int is_current_resolution(int xres, int yres){
 	int fd = open("/dev/vcio",0);
 	if(fd == -1){
@@ -1037,11 +2453,7 @@ fb_config init(int width, int height, int colormode){
 	fb0.orig_depth = (int)(property[10]);
 	fb0.width = width;
 	fb0.height = height;
-	if(colormode == RGB888MODE){
-		fb0.depth = 24;
-	}else{
-		fb0.depth = 16;
-	}
+	fb0.depth = 8*bytes_per_pixel(colormode);
 	fb0.size = (fb0.height)*(fb0.depth)*(fb0.width)/8;
 	char fbset_str[80];
 	sprintf(fbset_str,
@@ -1113,95 +2525,347 @@ int close_display(fb_config* fb0){
 /* Python Module Implementation                       */
 /*----------------------------------------------------*/
 
-static PyObject* py_buildgrating(PyObject *self, PyObject *args) {
-    char* filename;
-    double duration, angle, sf, tf, contrast, percent_sigma, percent_diameter,
-           percent_center_left, percent_center_top, percent_padding;
-    int width, height, waveform, background, colormode;
-    if (!PyArg_ParseTuple(args, "sdddddiiiidddddi", &filename, &duration, &angle,
-                          &sf, &tf, &contrast, &background, &width, &height, &waveform,
-                          &percent_sigma, &percent_diameter, &percent_center_left,
-			  &percent_center_top, &percent_padding,&colormode)){
+static PyObject* py_buildgrating(PyObject *self, PyObject *args) {
+    char* filename;
+    double duration, angle, sf, tf, contrast, percent_sigma, percent_diameter,
+           percent_center_left, percent_center_top, percent_padding;
+    int width, height, waveform, background, colormode;
+    int screen_width = 0;
+    if (!PyArg_ParseTuple(args, "sdddddiiiidddddi|i", &filename, &duration, &angle,
+                          &sf, &tf, &contrast, &background, &width, &height, &waveform,
+                          &percent_sigma, &percent_diameter, &percent_center_left,
+			  &percent_center_top, &percent_padding,&colormode,&screen_width)){
+        return NULL;
+    }
+    if (screen_width <= 0) {
+        screen_width = width;
+    }
+    int build_status;
+    Py_BEGIN_ALLOW_THREADS
+    build_status = build_grating(filename,duration,angle,sf,tf,contrast,background,width,height,waveform,
+			percent_sigma, percent_diameter,percent_center_left,
+			percent_center_top, percent_padding,colormode,screen_width);
+    Py_END_ALLOW_THREADS
+    if(build_status){
+        return NULL;
+    }
+    Py_RETURN_NONE; 
+}
+
+
+
+static PyObject* py_init(PyObject *self, PyObject *args) {
+    int xres,yres,colormode;
+    if (!PyArg_ParseTuple(args, "iii", &xres, &yres,&colormode)) {
+        return NULL;
+    }
+    fb_config* fb0_pointer = malloc(sizeof(fb_config)); 
+    *fb0_pointer = init(xres,yres,colormode);
+    if(fb0_pointer->error){
+        return NULL;
+    }
+    PyObject* fb0_capsule = PyCapsule_New(fb0_pointer, "framebuffer",NULL);
+    Py_INCREF(fb0_capsule);
+    return fb0_capsule;
+}
+
+static PyObject* py_displaycolor(PyObject* self, PyObject* args){
+    PyObject* fb0_capsule;
+    int r,g,b,colormode,blocking;
+        if (!PyArg_ParseTuple(args, "Oiiiii", &fb0_capsule,&r,&g,&b,&colormode,&blocking)) {
+        return NULL;
+    }
+    fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule,"framebuffer");
+    Py_BEGIN_ALLOW_THREADS
+    display_color(fb0_pointer,r,g,b,colormode,blocking);
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
+}
+
+static PyObject* py_vsyncintervals(PyObject* self, PyObject* args){
+    PyObject* fb0_capsule;
+    int n_frames, shade;
+    if (!PyArg_ParseTuple(args, "Oii", &fb0_capsule, &n_frames, &shade)) {
+        return NULL;
+    }
+    fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule,"framebuffer");
+    if (fb0_pointer == NULL) {
+        return NULL;
+    }
+    if (n_frames < 2) {
+        PyErr_SetString(PyExc_ValueError, "n_frames must be at least 2");
+        return NULL;
+    }
+    int colormode = colormode_of_depth(fb0_pointer->depth);
+    double* intervals;
+    Py_BEGIN_ALLOW_THREADS
+    intervals = vsync_intervals(fb0_pointer, n_frames, shade, colormode);
+    Py_END_ALLOW_THREADS
+    if (intervals == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_NoMemory();
+        }
+        return NULL;
+    }
+    PyObject* interval_list = PyList_New(n_frames-1);
+    int i;
+    for (i = 0; i < n_frames-1; i++) {
+        PyList_SET_ITEM(interval_list, i, PyFloat_FromDouble(intervals[i]));
+    }
+    free(intervals);
+    return interval_list;
+}
+
+static PyObject* py_setrealtime(PyObject* self, PyObject* args){
+    int priority, cpu;
+    if (!PyArg_ParseTuple(args, "ii", &priority, &cpu)) {
+        return NULL;
+    }
+    int old_policy, old_priority;
+    cpu_set_t old_affinity;
+    int error = set_realtime(priority, cpu, &old_policy, &old_priority, &old_affinity);
+    if (error) {
+        PyErr_Format(PyExc_OSError, "Could not enter real-time mode: %s. Run as root, or grant CAP_SYS_NICE and CAP_IPC_LOCK.", strerror(error));
+        return NULL;
+    }
+    PyObject* cpus = PyList_New(0);
+    int i;
+    for (i = 0; i < CPU_SETSIZE; i++) {
+        if (CPU_ISSET(i, &old_affinity)) {
+            PyObject* cpu_number = PyLong_FromLong(i);
+            PyList_Append(cpus, cpu_number);
+            Py_DECREF(cpu_number);
+        }
+    }
+    return Py_BuildValue("(iiN)", old_policy, old_priority, cpus);
+}
+
+static PyObject* py_clearrealtime(PyObject* self, PyObject* args){
+    int old_policy, old_priority;
+    PyObject* cpus;
+    if (!PyArg_ParseTuple(args, "iiO", &old_policy, &old_priority, &cpus)) {
+        return NULL;
+    }
+    cpu_set_t old_affinity;
+    CPU_ZERO(&old_affinity);
+    PyObject* iterator = PyObject_GetIter(cpus);
+    if (iterator == NULL) {
+        return NULL;
+    }
+    PyObject* cpu_number;
+    while ((cpu_number = PyIter_Next(iterator)) != NULL) {
+        CPU_SET(PyLong_AsLong(cpu_number), &old_affinity);
+        Py_DECREF(cpu_number);
+    }
+    Py_DECREF(iterator);
+    if (PyErr_Occurred()) {
+        return NULL;
+    }
+    int error = clear_realtime(old_policy, old_priority, &old_affinity);
+    if (error) {
+        PyErr_Format(PyExc_OSError, "Could not restore normal scheduling: %s", strerror(error));
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static int parse_gamma(PyObject* gamma_object, uint8_t** gamma){
+    /*Sets gamma to the table held in gamma_object, a bytes object
+    of length 256, or to NULL if gamma_object is None*/
+    *gamma = NULL;
+    if (gamma_object == Py_None) {
+        return 0;
+    }
+    if (!PyBytes_Check(gamma_object) || PyBytes_Size(gamma_object) != 256) {
+        PyErr_SetString(PyExc_ValueError, "gamma table must be a bytes object of length 256");
+        return -1;
+    }
+    *gamma = (uint8_t*)PyBytes_AsString(gamma_object);
+    return 0;
+}
+
+static param_block_t* get_param_block(Py_buffer* buffer){
+    /*The parameter block held in a buffer, e.g. an mmap of the
+    shared memory file, or NULL with an exception set*/
+    if (buffer->len < (Py_ssize_t)sizeof(param_block_t) || ((uintptr_t)buffer->buf % sizeof(double))) {
+        PyErr_Format(PyExc_ValueError, "parameter block must be an aligned buffer of at least %d bytes", (int)sizeof(param_block_t));
+        return NULL;
+    }
+    return buffer->buf;
+}
+
+static PyObject* py_writeparameters(PyObject* self, PyObject* args){
+    Py_buffer buffer;
+    param_block_t values;
+    if (!PyArg_ParseTuple(args, "w*ddddd", &buffer, &values.x, &values.y, &values.phase,
+                          &values.contrast, &values.orientation)) {
         return NULL;
     }
-    if(build_grating(filename,duration,angle,sf,tf,contrast,background,width,height,waveform,
-			percent_sigma, percent_diameter,percent_center_left,
-			percent_center_top, percent_padding,colormode)){
+    param_block_t* block = get_param_block(&buffer);
+    if (block == NULL) {
+        PyBuffer_Release(&buffer);
         return NULL;
     }
-    Py_RETURN_NONE; 
+    uint64_t update_id = write_params(block, &values);
+    PyBuffer_Release(&buffer);
+    return PyLong_FromUnsignedLongLong(update_id);
 }
 
-
-
-static PyObject* py_init(PyObject *self, PyObject *args) {
-    int xres,yres,colormode;
-    if (!PyArg_ParseTuple(args, "iii", &xres, &yres,&colormode)) {
+static PyObject* py_readparameters(PyObject* self, PyObject* args){
+    Py_buffer buffer;
+    param_block_t params;
+    if (!PyArg_ParseTuple(args, "y*", &buffer)) {
         return NULL;
     }
-    fb_config* fb0_pointer = malloc(sizeof(fb_config)); 
-    *fb0_pointer = init(xres,yres,colormode);
-    if(fb0_pointer->error){
+    param_block_t* block = get_param_block(&buffer);
+    if (block == NULL) {
+        PyBuffer_Release(&buffer);
         return NULL;
     }
-    PyObject* fb0_capsule = PyCapsule_New(fb0_pointer, "framebuffer",NULL);
-    Py_INCREF(fb0_capsule);
-    return fb0_capsule;
+    int consistent = read_params(block, &params);
+    PyBuffer_Release(&buffer);
+    if (!consistent) {
+        PyErr_SetString(PyExc_OSError, "parameter block is stuck mid-write, was its writer killed?");
+        return NULL;
+    }
+    return Py_BuildValue("(KLddddd)", (unsigned long long)params.update_id, (long long)params.written_ns,
+                         params.x, params.y, params.phase, params.contrast, params.orientation);
 }
 
-static PyObject* py_displaycolor(PyObject* self, PyObject* args){
+static PyObject* py_displayclosedloop(PyObject* self, PyObject* args){
     PyObject* fb0_capsule;
-    int r,g,b,colormode,blocking;
-        if (!PyArg_ParseTuple(args, "Oiiiii", &fb0_capsule,&r,&g,&b,&colormode,&blocking)) {
+    Py_buffer buffer;
+    double duration, sf, tf, percent_diameter, percent_sigma;
+    int waveform, trig_pin, background;
+    PyObject* gamma_object = Py_None;
+    uint8_t* gamma;
+    if (!PyArg_ParseTuple(args, "Oy*dddiddii|O", &fb0_capsule, &buffer, &duration, &sf, &tf,
+                          &waveform, &percent_diameter, &percent_sigma, &trig_pin, &background,
+                          &gamma_object)) {
         return NULL;
     }
-    uint16_t color_16 = rgb_to_uint(r,g,b);
-    uint24_t color_24 = rgb_to_uint_24bit(r,g,b);
-    fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule,"framebuffer");
-    display_color(fb0_pointer,color_16,color_24,colormode,blocking);
-    Py_RETURN_NONE;
+    fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule, "framebuffer");
+    param_block_t* block = get_param_block(&buffer);
+    if (fb0_pointer == NULL || block == NULL || parse_gamma(gamma_object, &gamma)) {
+        PyBuffer_Release(&buffer);
+        return NULL;
+    }
+    if (background < 0 || background > 255) {
+        PyBuffer_Release(&buffer);
+        PyErr_SetString(PyExc_ValueError, "background must be between 0 and 255");
+        return NULL;
+    }
+    int colormode = colormode_of_depth(fb0_pointer->depth);
+    closed_loop_t stim;
+    int start_time = time(NULL);
+    double* loop_info = NULL;
+    Py_BEGIN_ALLOW_THREADS
+    int fps = get_refresh_rate();
+    int n_frames = fps * duration;
+    if (n_frames < 2) {
+        set_error_nogil(PyExc_ValueError, "duration must cover at least 2 frames");
+    } else if (init_closed_loop(&stim, fb0_pointer->width, sf, tf, fps, waveform, percent_diameter, percent_sigma)) {
+        set_error_nogil(PyExc_MemoryError, "Could not allocate closed-loop aperture");
+    } else {
+        loop_info = display_closed_loop(fb0_pointer, block, &stim, n_frames, trig_pin, colormode, background, gamma);
+        free(stim.envelope);
+    }
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&buffer);
+    if (loop_info == NULL) {
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+        Py_RETURN_NONE;
+    }
+    PyObject* return_tuple = Py_BuildValue("(ddiiidd)", loop_info[0], loop_info[1], start_time,
+                                           (int)loop_info[2], (int)loop_info[3], loop_info[4], loop_info[5]);
+    free(loop_info);
+    return return_tuple;
 }
 
+static int check_stimulus(fb_config* fb0_pointer, stimulus_t* stim, const char* kind){
+    /*Sets a python exception and returns -1 if stim cannot be
+    displayed on the Screen described by fb0_pointer. Otherwise
+    works out how stim is scaled onto the Screen: by the largest
+    integer factor that fits, centred, with any remaining border
+    letterboxed*/
+    if (fb0_pointer->width < stim->width || fb0_pointer->height < stim->height) {
+        PyErr_Format(PyExc_ValueError, "%s cannot be displayed at current Screen solution. %s is %d x %d px, while Screen is %d x %d px.", kind, kind, stim->width, stim->height, fb0_pointer->width, fb0_pointer->height);
+        return -1;
+    }
+    stim->scale = fb0_pointer->width / stim->width;
+    if (fb0_pointer->height / stim->height < stim->scale) {
+        stim->scale = fb0_pointer->height / stim->height;
+    }
+    stim->offset_x = (fb0_pointer->width - stim->scale*stim->width) / 2;
+    stim->offset_y = (fb0_pointer->height - stim->scale*stim->height) / 2;
+    int colormode = colormode_of_depth(fb0_pointer->depth);
+    if (bytes_per_pixel(stim->pixel_format) != 1 && stim->pixel_format != colormode) {
+        PyErr_Format(PyExc_ValueError, "%s was built with %d bits per pixel, while Screen has %d.", kind, 8*bytes_per_pixel(stim->pixel_format), fb0_pointer->depth);
+        return -1;
+    }
+    return 0;
+}
 
-static PyObject* py_loadgrating(PyObject* self, PyObject* args){
+static PyObject* py_load(PyObject* args, int stim_type){
+    /*Shared by load_grating and load_raw*/
     PyObject* fb0_capsule;
     char* filename;
-        if (!PyArg_ParseTuple(args, "Os", &fb0_capsule,&filename)) {
+    const char* kind = (stim_type == STIM_GRATING) ? "Grating" : "Raw";
+    if (!PyArg_ParseTuple(args, "Os", &fb0_capsule,&filename)) {
         return NULL;
     }
     fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule,"framebuffer");
+    if (fb0_pointer == NULL) {
+        return NULL;
+    }
+    stimulus_t* stim = malloc(sizeof(stimulus_t));
 
     //Check file height/width against framebuffer height/width
-
-    int filedes = open(filename, O_RDWR);
-    if(filedes == -1){
-        perror("Failed to open file");
+    //before any frames are read
+    int status = read_stimulus_header(filename, stim_type, colormode_of_depth(fb0_pointer->depth), stim);
+    if (status == -1) {
+        free(stim);
+        PyErr_Format(PyExc_FileNotFoundError, "You probably mistyped the file name. Parsed as %s", filename);
         return NULL;
     }
-
-    fileheader_t* header = mmap(NULL,sizeof(fileheader_t),PROT_READ,MAP_PRIVATE,
-					filedes,0);
-    close(filedes);
-
-    if(header==MAP_FAILED){
-        perror("From mmap for header access");
-        exit(1);
+    if (status == -2) {
+        free(stim);
+        PyErr_Format(PyExc_ValueError, "%s is not a valid %s file, or is truncated", filename, kind);
+        return NULL;
+    }
+    if (check_stimulus(fb0_pointer, stim, kind)) {
+        free(stim);
+        return NULL;
     }
 
-    if (fb0_pointer->width != header->width || fb0_pointer->height != header->height) {
-        PyErr_Format(PyExc_ValueError, "Grating cannot be displayed at current Screen solution. Grating is %d x %d px, while Screen is %d x %d px.", header->width, header->height, fb0_pointer->width, fb0_pointer->height);
+    if (stim_type == STIM_GRATING) {
+        check_refresh_rate(stim);
+    }
+    Py_BEGIN_ALLOW_THREADS
+    status = load_stimulus(filename, stim);
+    if (status == 0 && stim_type == STIM_RAW) {
+        //Without a map every frame is drawn in full, so failure is not an error
+        build_tile_map(stim);
+    }
+    Py_END_ALLOW_THREADS
+    if (status) {
+        free(stim);
+        PyErr_Format(PyExc_OSError, "Failed to read %s into memory", filename);
         return NULL;
     }
+    PyObject* capsule = PyCapsule_New(stim, (stim_type == STIM_GRATING) ? "grating_data" : "raw_data", NULL);
+    Py_INCREF(capsule);
+    return capsule;
+}
 
-    void* grating_data = load_grating(filename,*fb0_pointer);
+static PyObject* py_loadgrating(PyObject* self, PyObject* args){
+    return py_load(args, STIM_GRATING);
+}
 
-    if (grating_data == NULL) {
-        PyErr_Format(PyExc_FileNotFoundError, "You probably mistyped the file name. Parsed as %s", filename);
- 	return NULL;
-    }
-    PyObject* grating_capsule = PyCapsule_New(grating_data, "grating_data",NULL);
-    Py_INCREF(grating_capsule);
-    return grating_capsule;
+static PyObject* py_loadraw(PyObject* self, PyObject* args){
+    return py_load(args, STIM_RAW);
 }
 
 static PyObject* py_debugdumpgrating(PyObject* self, PyObject* args){
@@ -1211,78 +2875,219 @@ static PyObject* py_debugdumpgrating(PyObject* self, PyObject* args){
     if (!PyArg_ParseTuple(args, "OOs", &fb0_capsule,&grating_capsule,&filename)) {
         return NULL;
     }
-    fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule,"framebuffer");
-    void* grating_data = PyCapsule_GetPointer(grating_capsule,"grating_data");
+    stimulus_t* grating_data = PyCapsule_GetPointer(grating_capsule,"grating_data");
     if(grating_data == NULL){
         return NULL;
     }
-    if (debug_dump_grating(grating_data,*fb0_pointer,filename)){
+    if (debug_dump_grating(grating_data,filename)){
 	    return NULL;
     }
     Py_RETURN_NONE;
 }
 
-static PyObject* py_loadraw(PyObject* self, PyObject* args){
+static PyObject* py_attach(PyObject* args, int stim_type){
+    /*Shared by attach_grating and attach_raw*/
     PyObject* fb0_capsule;
     char* filename;
-    if (!PyArg_ParseTuple(args, "Os", &fb0_capsule, &filename)) {
+    Py_ssize_t content_length = 0;
+    char* tile_map_filename = NULL;
+    const char* kind = (stim_type == STIM_GRATING) ? "Grating" : "Raw";
+    if (!PyArg_ParseTuple(args, "Os|nz", &fb0_capsule, &filename, &content_length, &tile_map_filename)) {
+        return NULL;
+    }
+    if (content_length < 0) {
+        PyErr_SetString(PyExc_ValueError, "length must not be negative");
         return NULL;
     }
-
     fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule,"framebuffer");
+    if (fb0_pointer == NULL) {
+        return NULL;
+    }
+    stimulus_t* stim = malloc(sizeof(stimulus_t));
+    int status;
+    Py_BEGIN_ALLOW_THREADS
+    status = map_stimulus(filename, stim_type, colormode_of_depth(fb0_pointer->depth), (size_t)content_length, stim);
+    Py_END_ALLOW_THREADS
+    if (status == -1) {
+        free(stim);
+        PyErr_Format(PyExc_FileNotFoundError, "Could not map shared stimulus %s", filename);
+        return NULL;
+    }
+    if (status == -2) {
+        free(stim);
+        PyErr_Format(PyExc_ValueError, "Shared stimulus %s is not a valid %s file, or is truncated", filename, kind);
+        return NULL;
+    }
+    if (check_stimulus(fb0_pointer, stim, kind)) {
+        unload_stimulus(stim);
+        return NULL;
+    }
+    if (stim_type == STIM_RAW) {
+        //A map saved with the pool entry is shared. Without one, the
+        //map is built here, once, and the caller saves it to the pool
+        Py_BEGIN_ALLOW_THREADS
+        if (tile_map_filename == NULL || map_tile_map(stim, tile_map_filename)) {
+            build_tile_map(stim);
+        }
+        Py_END_ALLOW_THREADS
+    }
+    PyObject* capsule = PyCapsule_New(stim, (stim_type == STIM_GRATING) ? "grating_data" : "raw_data", NULL);
+    Py_INCREF(capsule);
+    return capsule;
+}
 
-    //Check file height/width against framebuffer height/width
-
-    int filedes = open(filename, O_RDWR);
-    if(filedes == -1){
-        perror("Failed to open file");
+static PyObject* py_tilemap(PyObject* self, PyObject* args){
+    PyObject* raw_capsule;
+    if (!PyArg_ParseTuple(args, "O", &raw_capsule)) {
+        return NULL;
+    }
+    stimulus_t* stim = PyCapsule_GetPointer(raw_capsule, "raw_data");
+    if (stim == NULL) {
         return NULL;
     }
+    if (stim->tile_map == NULL) {
+        Py_RETURN_NONE;
+    }
+    return PyBytes_FromStringAndSize((char*)stim->tile_map, (Py_ssize_t)(stim->n_frames)*stim->tile_map_stride);
+}
+
+static PyObject* py_attachgrating(PyObject* self, PyObject* args){
+    return py_attach(args, STIM_GRATING);
+}
 
-    fileheader_raw* header = mmap(NULL,sizeof(fileheader_raw),PROT_READ,MAP_PRIVATE,
-					filedes,0);
-    close(filedes);
+static PyObject* py_attachraw(PyObject* self, PyObject* args){
+    return py_attach(args, STIM_RAW);
+}
 
-    if(header==MAP_FAILED){
-        perror("From mmap for header access");
-        exit(1);
+static PyObject* py_stimulusproperties(PyObject* self, PyObject* args){
+    PyObject* capsule;
+    if (!PyArg_ParseTuple(args, "O", &capsule)) {
+        return NULL;
+    }
+    const char* name = PyCapsule_GetName(capsule);
+    if (name == NULL || (strcmp(name, "grating_data") && strcmp(name, "raw_data"))) {
+        PyErr_SetString(PyExc_TypeError, "Expected a grating_data or raw_data capsule");
+        return NULL;
+    }
+    stimulus_t* stim = PyCapsule_GetPointer(capsule, name);
+    if (stim == NULL) {
+        return NULL;
     }
+    return Py_BuildValue("{s:i,s:i,s:i,s:I,s:I,s:i,s:i,s:I,s:d}",
+        "pixel_format", stim->pixel_format,
+        "width", stim->width,
+        "height", stim->height,
+        "frames_stored", stim->frames_stored,
+        "n_frames", stim->n_frames,
+        "refresh_per_frame", stim->refresh_per_frame,
+        "frames_per_second", stim->frames_per_second,
+        "scale", stim->scale,
+        "changed_fraction", stim->tile_map != NULL ? stim->changed_fraction : 1.0);
+}
 
-    if (fb0_pointer->width != header->width || fb0_pointer->height != header->height) {
-        PyErr_Format(PyExc_ValueError, "Raw cannot be displayed at current Screen solution. Raw is %d x %d px, while Screen is %d x %d px.", header->width, header->height, fb0_pointer->width, fb0_pointer->height);
+static PyObject* py_readheader(PyObject* self, PyObject* args){
+    char* filename;
+    int stim_type, default_format;
+    if (!PyArg_ParseTuple(args, "sii", &filename, &stim_type, &default_format)) {
+        return NULL;
+    }
+    stimulus_t stim;
+    int status = read_stimulus_header(filename, stim_type, default_format, &stim);
+    if (status == -1) {
+        PyErr_Format(PyExc_FileNotFoundError, "Could not read %s", filename);
+        return NULL;
+    }
+    if (status == -2) {
+        PyErr_Format(PyExc_ValueError, "%s is not a valid %s file, or is truncated", filename,
+                     (stim_type == STIM_GRATING) ? "Grating" : "Raw");
+        return NULL;
+    }
+    PyObject* params;
+    if (stim.header_version >= 2 && stim_type == STIM_GRATING) {
+        params = Py_BuildValue("{s:d,s:d,s:d,s:d,s:d,s:i,s:i,s:d,s:d,s:d,s:d,s:d,s:i}",
+            "duration", stim.params.duration,
+            "angle", stim.params.angle,
+            "spac_freq", stim.params.spacial_frequency,
+            "temp_freq", stim.params.temporal_frequency,
+            "contrast", stim.params.contrast,
+            "background", stim.params.background,
+            "waveform", stim.params.waveform,
+            "percent_sigma", stim.params.percent_sigma,
+            "percent_diameter", stim.params.percent_diameter,
+            "percent_center_left", stim.params.percent_center_left,
+            "percent_center_top", stim.params.percent_center_top,
+            "percent_padding", stim.params.percent_padding,
+            "screen_width", stim.params.screen_width);
+    } else {
+        params = Py_None;
+        Py_INCREF(Py_None);
+    }
+    if (params == NULL) {
         return NULL;
     }
+    return Py_BuildValue("{s:I,s:i,s:I,s:I,s:I,s:I,s:I,s:I,s:I,s:n,s:N}",
+        "header_version", stim.header_version,
+        "pixel_format", stim.pixel_format,
+        "width", stim.width,
+        "height", stim.height,
+        "frames_stored", stim.frames_stored,
+        "n_frames", stim.n_frames,
+        "refresh_per_frame", stim.refresh_per_frame,
+        "frames_per_second", stim.frames_per_second,
+        "header_size", stim.header_size,
+        "memory", (Py_ssize_t)stim.block_size,
+        "parameters", params);
+}
 
-    void* raw_data = load_raw(filename);
-    if (raw_data == NULL) {
-        PyErr_Format(PyExc_FileNotFoundError, "You probably mistyped the file name. Parsed as %s", filename);
+static PyObject* py_shareframes(PyObject* self, PyObject* args){
+    PyObject* source_capsule;
+    PyObject* candidate_capsule;
+    if (!PyArg_ParseTuple(args, "OO", &source_capsule, &candidate_capsule)) {
+        return NULL;
+    }
+    stimulus_t* source = PyCapsule_GetPointer(source_capsule, "grating_data");
+    stimulus_t* candidate = PyCapsule_GetPointer(candidate_capsule, "grating_data");
+    if (source == NULL || candidate == NULL) {
         return NULL;
     }
-    PyObject* raw_capsule = PyCapsule_New(raw_data, "raw_data", NULL);
-    Py_INCREF(raw_capsule);
-    return raw_capsule;
+    stimulus_t* shared;
+    Py_BEGIN_ALLOW_THREADS
+    shared = share_frames(source, candidate);
+    Py_END_ALLOW_THREADS
+    if (shared == NULL) {
+        Py_RETURN_NONE;
+    }
+    PyObject* capsule = PyCapsule_New(shared, "grating_data", NULL);
+    Py_INCREF(capsule);
+    return capsule;
 }
 
 static PyObject* py_unloadgrating(PyObject* self, PyObject* args){
     PyObject* grating_capsule;
-    void* grating_pointer;
+    stimulus_t* grating_pointer;
     if (!PyArg_ParseTuple(args, "O", &grating_capsule)) {
         return NULL;
     }
     grating_pointer = PyCapsule_GetPointer(grating_capsule,"grating_data");
-    unload_grating(grating_pointer);
+    if (grating_pointer == NULL) {
+        return NULL;
+    }
+    unload_stimulus(grating_pointer);
     Py_DECREF(grating_capsule);
     Py_RETURN_NONE;
 }
 
 static PyObject* py_unloadraw(PyObject* self, PyObject* args) {
     PyObject* raw_capsule;
-    void* raw_pointer;
+    stimulus_t* raw_pointer;
     if (!PyArg_ParseTuple(args, "O", &raw_capsule)) {
         return NULL;
     }
     raw_pointer = PyCapsule_GetPointer(raw_capsule, "raw_data");
-    unload_raw(raw_pointer);
+    if (raw_pointer == NULL) {
+        return NULL;
+    }
+    unload_stimulus(raw_pointer);
     Py_DECREF(raw_capsule);
     Py_RETURN_NONE;
 }
@@ -1291,24 +3096,35 @@ static PyObject* py_displaygrating(PyObject* self, PyObject* args){
     PyObject* fb0_capsule;
     PyObject* grating_capsule;
     int trig_pin;
-    if (!PyArg_ParseTuple(args, "OOi", &fb0_capsule,&grating_capsule,&trig_pin)) {
+    double contrast = 1;
+    int background = 127;
+    PyObject* gamma_object = Py_None;
+    uint8_t* gamma;
+    if (!PyArg_ParseTuple(args, "OOi|diO", &fb0_capsule,&grating_capsule,&trig_pin,&contrast,&background,&gamma_object)) {
         return NULL;
     }
     fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule,"framebuffer");
-    void* grating_data = PyCapsule_GetPointer(grating_capsule,"grating_data");
-    int colormode;
-    if(fb0_pointer->depth==24){
-        colormode = RGB888MODE;
-    }else{
-        colormode = RGB565MODE;
+    stimulus_t* grating_data = PyCapsule_GetPointer(grating_capsule,"grating_data");
+    int colormode = colormode_of_depth(fb0_pointer->depth);
+    if(grating_data == NULL || parse_gamma(gamma_object, &gamma)){
+        return NULL;
     }
-    if(grating_data == NULL){
+    if (background < 0 || background > 255) {
+        PyErr_SetString(PyExc_ValueError, "background must be between 0 and 255");
         return NULL;
     }
+    //The lookup table for this trial, used if the grating is 8 bit
+    uint32_t palette[256];
+    build_palette(palette, colormode, grating_data->pixel_format, contrast, background, gamma);
     int start_time = time(NULL);
-    double* grat_info = display_grating(grating_data,fb0_pointer,trig_pin,colormode);
+    double* grat_info;
+    Py_BEGIN_ALLOW_THREADS
+    grat_info = display_grating(grating_data,fb0_pointer,trig_pin,colormode,palette,gamma ? gamma[background] : background);
+    Py_END_ALLOW_THREADS
     if (grat_info == NULL) {
-        free(grat_info);
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
         PyErr_Format(PyExc_KeyboardInterrupt, "Key pressed while waiting for pulse - or maybe a very weird error?");
  	return NULL;
     } else {
@@ -1318,28 +3134,243 @@ static PyObject* py_displaygrating(PyObject* self, PyObject* args){
     }
 }
 
+static int parse_noise(PyObject* noise_args, noise_t* noise, unsigned int width, unsigned int height){
+    /*Fill noise from the tuple built by rpg.noise.Noise._args(), or
+    set an exception and return -1*/
+    unsigned long long seed;
+    double density;
+    if (!PyArg_ParseTuple(noise_args, "KiiIIdII;noise must be (seed, kind, polarity, columns, rows, density, hold, n_frames)",
+                          &seed, &noise->kind, &noise->polarity, &noise->columns, &noise->rows,
+                          &density, &noise->hold, &noise->n_frames)) {
+        return -1;
+    }
+    if (noise->columns < 1 || noise->rows < 1 || noise->columns > width || noise->rows > height) {
+        PyErr_Format(PyExc_ValueError, "A %u x %u grid does not fit on a %u x %u px Screen", noise->columns, noise->rows, width, height);
+        return -1;
+    }
+    if (density < 0 || density > 1 || noise->hold < 1 || noise->n_frames < 2) {
+        PyErr_SetString(PyExc_ValueError, "density must be between 0 and 1, hold at least 1 and n_frames at least 2");
+        return -1;
+    }
+    noise->seed = seed;
+    noise->threshold = density*16777216.0;
+    return 0;
+}
+
+static PyObject* py_displaynoise(PyObject* self, PyObject* args){
+    PyObject* fb0_capsule;
+    PyObject* noise_args;
+    int trig_pin;
+    double contrast = 1;
+    int background = 127;
+    PyObject* gamma_object = Py_None;
+    uint8_t* gamma;
+    if (!PyArg_ParseTuple(args, "OOi|diO", &fb0_capsule, &noise_args, &trig_pin, &contrast, &background, &gamma_object)) {
+        return NULL;
+    }
+    fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule, "framebuffer");
+    noise_t noise;
+    if (fb0_pointer == NULL || parse_gamma(gamma_object, &gamma) ||
+        parse_noise(noise_args, &noise, fb0_pointer->width, fb0_pointer->height)) {
+        return NULL;
+    }
+    if (background < 0 || background > 255) {
+        PyErr_SetString(PyExc_ValueError, "background must be between 0 and 255");
+        return NULL;
+    }
+    int colormode = colormode_of_depth(fb0_pointer->depth);
+    uint32_t palette[256];
+    build_palette(palette, colormode, MOD8MODE, contrast, background, gamma);
+    int start_time = time(NULL);
+    double* noise_info;
+    Py_BEGIN_ALLOW_THREADS
+    noise_info = display_noise(&noise, fb0_pointer, trig_pin, colormode, palette, gamma ? gamma[background] : background);
+    Py_END_ALLOW_THREADS
+    if (noise_info == NULL) {
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+        Py_RETURN_NONE;
+    }
+    PyObject* return_tuple = Py_BuildValue("(ddi)", noise_info[0], noise_info[1], start_time);
+    free(noise_info);
+    return return_tuple;
+}
+
+static PyObject* py_noisecells(PyObject* self, PyObject* args){
+    PyObject* noise_args;
+    unsigned int frame;
+    if (!PyArg_ParseTuple(args, "OI", &noise_args, &frame)) {
+        return NULL;
+    }
+    noise_t noise;
+    if (parse_noise(noise_args, &noise, UINT_MAX, UINT_MAX)) {
+        return NULL;
+    }
+    PyObject* cells = PyBytes_FromStringAndSize(NULL, noise.columns*noise.rows);
+    if (cells == NULL) {
+        return NULL;
+    }
+    noise_cells(&noise, frame, (uint8_t*)PyBytes_AS_STRING(cells));
+    return cells;
+}
+
+static PyObject* py_benchmarknoise(PyObject* self, PyObject* args){
+    int width, height, colormode;
+    PyObject* noise_args;
+    if (!PyArg_ParseTuple(args, "iiiO", &width, &height, &colormode, &noise_args)) {
+        return NULL;
+    }
+    noise_t noise;
+    if (width < 1 || height < 1) {
+        PyErr_SetString(PyExc_ValueError, "width and height must be positive");
+        return NULL;
+    }
+    if (parse_noise(noise_args, &noise, width, height)) {
+        return NULL;
+    }
+    double* result;
+    Py_BEGIN_ALLOW_THREADS
+    result = benchmark_noise(width, height, colormode, &noise);
+    Py_END_ALLOW_THREADS
+    if (result == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_NoMemory();
+        }
+        return NULL;
+    }
+    PyObject* return_tuple = Py_BuildValue("(dd)", result[0], result[1]);
+    free(result);
+    return return_tuple;
+}
+
+static PyObject* py_displaypatches(PyObject* self, PyObject* args){
+    PyObject* fb0_capsule;
+    PyObject* patch_list;
+    int trig_pin;
+    PyObject* gamma_object = Py_None;
+    uint8_t* gamma;
+    int background = 127;
+    if (!PyArg_ParseTuple(args, "OOi|Oi", &fb0_capsule, &patch_list, &trig_pin, &gamma_object, &background)) {
+        return NULL;
+    }
+    fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule, "framebuffer");
+    if (fb0_pointer == NULL || parse_gamma(gamma_object, &gamma)) {
+        return NULL;
+    }
+    if (background < 0 || background > 255) {
+        PyErr_SetString(PyExc_ValueError, "background must be between 0 and 255");
+        return NULL;
+    }
+    PyObject* patch_seq = PySequence_Fast(patch_list, "patches must be a sequence");
+    if (patch_seq == NULL) {
+        return NULL;
+    }
+    int n_patches = PySequence_Fast_GET_SIZE(patch_seq);
+    patch_t* patches = malloc((n_patches ? n_patches : 1)*sizeof(patch_t));
+    if (patches == NULL) {
+        Py_DECREF(patch_seq);
+        return PyErr_NoMemory();
+    }
+    int colormode = colormode_of_depth(fb0_pointer->depth);
+    int i, longest = 0;
+    for (i = 0; i < n_patches; i++) {
+        PyObject* capsule;
+        int x, y, start, n_refreshes;
+        double contrast;
+        if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(patch_seq, i), "Oiiiid;each patch must be (capsule, x, y, start, refreshes, contrast)",
+                              &capsule, &x, &y, &start, &n_refreshes, &contrast)) {
+            break;
+        }
+        const char* name = PyCapsule_GetName(capsule);
+        if (name == NULL || (strcmp(name, "grating_data") && strcmp(name, "raw_data"))) {
+            PyErr_SetString(PyExc_TypeError, "Expected a grating_data or raw_data capsule");
+            break;
+        }
+        stimulus_t* stim = PyCapsule_GetPointer(capsule, name);
+        if (stim == NULL) {
+            break;
+        }
+        if (x < 0 || y < 0 || x + stim->width > fb0_pointer->width || y + stim->height > fb0_pointer->height) {
+            PyErr_Format(PyExc_ValueError, "Patch %d (%d x %d px at %d, %d) does not fit on the %d x %d px Screen",
+                         i, stim->width, stim->height, x, y, fb0_pointer->width, fb0_pointer->height);
+            break;
+        }
+        if (start < 0 || n_refreshes < 0) {
+            PyErr_Format(PyExc_ValueError, "Patch %d has a negative start or length", i);
+            break;
+        }
+        if (n_refreshes == 0) {
+            n_refreshes = stim->stim_type == STIM_RAW ? stim->n_frames*stim->refresh_per_frame : stim->n_frames;
+        }
+        patches[i].stim = stim;
+        patches[i].x = x;
+        patches[i].y = y;
+        patches[i].start = start;
+        patches[i].n_refreshes = n_refreshes;
+        build_palette(patches[i].palette, colormode, stim->pixel_format, contrast, background, gamma);
+        if (start + n_refreshes > longest) {
+            longest = start + n_refreshes;
+        }
+    }
+    Py_DECREF(patch_seq);
+    if (PyErr_Occurred()) {
+        free(patches);
+        return NULL;
+    }
+    if (longest < 2) {
+        free(patches);
+        PyErr_SetString(PyExc_ValueError, "patches must be shown for at least 2 refreshes");
+        return NULL;
+    }
+    int start_time = time(NULL);
+    double* patch_info;
+    Py_BEGIN_ALLOW_THREADS
+    patch_info = display_patches(fb0_pointer, patches, n_patches, trig_pin, colormode, gamma ? gamma[background] : background);
+    Py_END_ALLOW_THREADS
+    free(patches);
+    if (patch_info == NULL) {
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+        Py_RETURN_NONE;
+    }
+    PyObject* return_tuple = Py_BuildValue("(ddi)", patch_info[0], patch_info[1], start_time);
+    free(patch_info);
+    return return_tuple;
+}
+
 static PyObject* py_displayraw(PyObject* self, PyObject* args){
     PyObject* fb0_capsule;
     PyObject* raw_capsule;
     int trig_pin;
-    if (!PyArg_ParseTuple(args, "OOi", &fb0_capsule, &raw_capsule, &trig_pin)) {
+    PyObject* gamma_object = Py_None;
+    uint8_t* gamma;
+    int background = 127;
+    if (!PyArg_ParseTuple(args, "OOi|Oi", &fb0_capsule, &raw_capsule, &trig_pin, &gamma_object, &background)) {
         return NULL;
     }
     fb_config* fb0_pointer = PyCapsule_GetPointer(fb0_capsule, "framebuffer");
-    void* raw_data = PyCapsule_GetPointer(raw_capsule, "raw_data");
-    if(raw_data == NULL){
+    stimulus_t* raw_data = PyCapsule_GetPointer(raw_capsule, "raw_data");
+    if(raw_data == NULL || parse_gamma(gamma_object, &gamma)){
         return NULL;
     }
-    int colormode;    
-    if(fb0_pointer->depth==24){
-        colormode = RGB888MODE;
-    }else{
-        colormode = RGB565MODE;
+    if (background < 0 || background > 255) {
+        PyErr_SetString(PyExc_ValueError, "background must be between 0 and 255");
+        return NULL;
     }
+    int colormode = colormode_of_depth(fb0_pointer->depth);
+    uint32_t palette[256];
+    build_palette(palette, colormode, raw_data->pixel_format, 1, 127, gamma);
     int start_time = time(NULL);
-    float* raw_info = display_raw(raw_data, fb0_pointer, trig_pin, colormode);
-    if (raw_info == 0) {
-        free(raw_info);
+    double* raw_info;
+    Py_BEGIN_ALLOW_THREADS
+    raw_info = display_raw(raw_data, fb0_pointer, trig_pin, colormode, palette, gamma ? gamma[background] : background);
+    Py_END_ALLOW_THREADS
+    if (raw_info == NULL) {
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
         Py_RETURN_NONE;
     } else {
         PyObject* return_tuple = Py_BuildValue("(ddi)", *raw_info, *(raw_info+1), start_time);
@@ -1376,6 +3407,67 @@ static PyObject* py_convertraw(PyObject* self, PyObject* args){
 	Py_RETURN_NONE;
 }
 
+static PyObject* py_convertchunk(PyObject* self, PyObject* args){
+	Py_buffer rgb;
+	int colormode;
+	if (!PyArg_ParseTuple(args, "y*i", &rgb, &colormode)) {
+		return NULL;
+	}
+	if (rgb.len % 3) {
+		PyBuffer_Release(&rgb);
+		PyErr_SetString(PyExc_ValueError, "RGB data must be a whole number of 3 byte pixels");
+		return NULL;
+	}
+	size_t n_pixels = rgb.len / 3;
+	PyObject* converted = PyBytes_FromStringAndSize(NULL, n_pixels*bytes_per_pixel(colormode));
+	if (converted == NULL) {
+		PyBuffer_Release(&rgb);
+		return NULL;
+	}
+	uint8_t* write_loc = (uint8_t*)PyBytes_AS_STRING(converted);
+	Py_BEGIN_ALLOW_THREADS
+	convert_pixels(rgb.buf, n_pixels, write_loc, colormode);
+	Py_END_ALLOW_THREADS
+	PyBuffer_Release(&rgb);
+	return converted;
+}
+
+static PyObject* py_rawheader(PyObject* self, PyObject* args){
+	int width, height, frames_stored, n_frames, refresh_per_frame, colormode;
+	if (!PyArg_ParseTuple(args, "iiiiii", &width, &height, &frames_stored,
+				&n_frames, &refresh_per_frame, &colormode)) {
+		return NULL;
+	}
+	fileheader_v2 header;
+	fill_header(&header, STIM_RAW, colormode, width, height, frames_stored, n_frames,
+			0, refresh_per_frame, NULL);
+	return PyBytes_FromStringAndSize((char*)&header, sizeof(fileheader_v2));
+}
+
+static PyObject* py_benchmarkcopy(PyObject* self, PyObject* args){
+    int width, height, colormode, n_frames;
+    int source_format = -1;
+    if (!PyArg_ParseTuple(args, "iiii|i", &width, &height, &colormode, &n_frames, &source_format)) {
+        return NULL;
+    }
+    if (source_format == -1) {
+        source_format = colormode;
+    }
+    double* copy_info;
+    Py_BEGIN_ALLOW_THREADS
+    copy_info = benchmark_copy(width, height, colormode, n_frames, source_format);
+    Py_END_ALLOW_THREADS
+    if (copy_info == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_NoMemory();
+        }
+        return NULL;
+    }
+    PyObject* return_tuple = Py_BuildValue("(dd)", copy_info[0], copy_info[1]);
+    free(copy_info);
+    return return_tuple;
+}
+
 
 static PyMethodDef _rpigratings_methods[] = { 
     {   
@@ -1383,7 +3475,7 @@ static PyMethodDef _rpigratings_methods[] = {
         "Initialise the display and return a framebuffer object.\n"
 	":Param xres:  the virtual width of the display\n"
 	":Param yres:  the virtual height of the display\n"
-	":Param depth: the number of bits per pixel - 16 or 24\n"
+	":Param depth: the number of bits per pixel - 16, 24 or 32\n"
 	":rtype framebuffer capsule: a framebuffer object for use\n"
 	"with other functions in this module.\n"
 	"WARNING: only one instance of this object should\n"
@@ -1417,6 +3509,12 @@ static PyMethodDef _rpigratings_methods[] = {
         "Displays data that has been loaded into memory to the screen.\n"
 	":Param fb0: a framebuffer object created from an init() call\n"
 	":Param data: a raw data object created from a load_grating() call\n"
+	":Param trig_pin: GPIO pin to wait for, 0 to start immediately\n"
+	":Param contrast: optional, contrast of a modulation grating\n"
+	":Param background: optional, background of a modulation grating,\n"
+	"      and the shade around a letterboxed grating\n"
+	":Param gamma: optional, bytes of length 256 mapping each grey\n"
+	"      level of an 8 bit grating to the value displayed, or None\n"
 	":rtype None:"
     },
 {   
@@ -1429,6 +3527,8 @@ static PyMethodDef _rpigratings_methods[] = {
     },
 {
 	"display_raw", py_displayraw, METH_VARARGS,
+	":Param gamma: optional, as for display_grating\n"
+	":Param background: optional, shade around a letterboxed raw\n"
 	":rtype None:"
 },  
     {   
@@ -1460,6 +3560,159 @@ static PyMethodDef _rpigratings_methods[] = {
 	"load_raw", py_loadraw, METH_VARARGS,
 	":rtype raw_data capsule"
     },  
+    {
+	"display_noise", py_displaynoise, METH_VARARGS,
+	"Displays sparse noise or a random checkerboard, generated each frame.\n"
+	":Param fb0: a framebuffer object returned from init()\n"
+	":Param noise: (seed, kind, polarity, columns, rows, density, hold, n_frames)\n"
+	":Param trig_pin: GPIO pin to wait for a trigger on, 0 to start now\n"
+	":Param contrast: 0 to 1\n"
+	":Param background: grey level of unlit cells\n"
+	":Param gamma: optional bytes(256) gamma table\n"
+	":rtype tuple: mean and std interframe interval, start time"
+    },
+    {
+	"noise_cells", py_noisecells, METH_VARARGS,
+	"Generates one frame of noise, as display_noise() shows it.\n"
+	":Param noise: as for display_noise()\n"
+	":Param frame: frame number\n"
+	":rtype bytes: one modulation level per cell, 255 white, 1 black, 128 background"
+    },
+    {
+	"benchmark_noise", py_benchmarknoise, METH_VARARGS,
+	"Times generating and drawing noise frames, without a framebuffer.\n"
+	":Param width, height: size of the frames drawn\n"
+	":Param colormode: colormode tag of the frames drawn\n"
+	":Param noise: as for display_noise()\n"
+	":rtype tuple: mean and std time per frame in usecs"
+    },
+    {
+	"display_patches", py_displaypatches, METH_VARARGS,
+	"Composites several loaded stimuli over the background, each at its own\n"
+	"place on the Screen and on its own schedule.\n"
+	":Param fb0: a framebuffer object returned from init()\n"
+	":Param patches: sequence of (capsule, x, y, start, refreshes, contrast),\n"
+	"with x, y the top left corner in pixels, start the refresh the patch\n"
+	"appears on, refreshes how long it is shown for (0 for the stimulus's own\n"
+	"length) and contrast the contrast of modulation stimuli\n"
+	":Param trig_pin: GPIO pin to wait for a trigger on, 0 to start now\n"
+	":Param gamma: optional bytes(256) gamma table\n"
+	":Param background: grey level shown around the patches\n"
+	":rtype tuple: mean and std interframe interval, start time"
+    },
+    {
+	"write_parameters", py_writeparameters, METH_VARARGS,
+	"Writes closed-loop parameters into a shared parameter block.\n"
+	":Param block: writable buffer holding the parameter block\n"
+	":Param x, y: centre of the stimulus in pixels, NaN for the Screen centre\n"
+	":Param phase: degrees\n"
+	":Param contrast: 0 to 1\n"
+	":Param orientation: degrees\n"
+	":rtype int: the update id of this write"
+    },
+    {
+	"read_parameters", py_readparameters, METH_VARARGS,
+	"Reads a consistent snapshot of a shared parameter block.\n"
+	":Param block: buffer holding the parameter block\n"
+	":rtype tuple: update id, write time in ns, x, y, phase, contrast, orientation"
+    },
+    {
+	"display_closed_loop", py_displayclosedloop, METH_VARARGS,
+	"Displays a grating rendered each frame from a shared parameter block.\n"
+	":Param fb0: a framebuffer object returned from init()\n"
+	":Param block: buffer holding the parameter block\n"
+	":Param duration: seconds\n"
+	":Param sf, tf: spatial and temporal frequency, as for build_grating()\n"
+	":Param waveform: SINE or SQUARE\n"
+	":Param percent_diameter, percent_sigma: the aperture, 0 for none\n"
+	":Param trig_pin: GPIO pin to wait for a trigger on, 0 to start now\n"
+	":Param background: grey level shown outside the aperture\n"
+	":Param gamma: optional bytes(256) gamma table\n"
+	":rtype tuple: mean and std interframe interval, start time, updates written,\n"
+	"updates shown, mean and max latency from write to display in usecs"
+    },
+    {
+	"vsync_intervals", py_vsyncintervals, METH_VARARGS,
+	"Times the display loop flipping solid frames, without a stimulus.\n"
+	":Param fb0: a framebuffer object returned from init()\n"
+	":Param n_frames: number of refreshes to time\n"
+	":Param shade: grey level to fill the frames with\n"
+	":rtype list: n_frames-1 interframe intervals in usecs"
+    },
+    {
+	"set_realtime", py_setrealtime, METH_VARARGS,
+	"Gives the calling thread SCHED_FIFO priority, pins it to a CPU\n"
+	"and locks the process's memory.\n"
+	":Param priority: SCHED_FIFO priority, 1 to 99\n"
+	":Param cpu: CPU to pin the thread to, or -1 to leave it unpinned\n"
+	":rtype tuple: the previous scheduling, to pass to clear_realtime()"
+    },
+    {
+	"clear_realtime", py_clearrealtime, METH_VARARGS,
+	"Restores the scheduling of the calling thread, and unlocks memory.\n"
+	":Param policy, priority, cpus: as returned by set_realtime()\n"
+	":rtype None:"
+    },
+    {
+	"share_frames", py_shareframes, METH_VARARGS,
+	"Finds whether every frame of one loaded grating is also a frame\n"
+	"of another, e.g. because it is the other reversed in time.\n"
+	":Param source: grating_data capsule whose frames are kept\n"
+	":Param candidate: grating_data capsule that could share them\n"
+	":rtype grating_data capsule or None: a grating showing source's\n"
+	"      frames as candidate would be shown. source must stay loaded\n"
+	"      until it is released with unload_grating()."
+    },
+    {
+	"stimulus_properties", py_stimulusproperties, METH_VARARGS,
+	"Describes a loaded grating or raw.\n"
+	":Param data: a grating_data or raw_data capsule\n"
+	":rtype dict: pixel_format, width, height, frames_stored,\n"
+	"      n_frames, refresh_per_frame, frames_per_second, the\n"
+	"      scale it is displayed at, and the mean fraction of\n"
+	"      each frame that is redrawn, below 1 for raws that only\n"
+	"      change in places"
+    },
+    {
+	"read_header", py_readheader, METH_VARARGS,
+	"Describes a grating or raw file from its header alone, without\n"
+	"reading any frames.\n"
+	":Param filename: (string) the file\n"
+	":Param stim_type: 1 for a grating, 2 for a raw\n"
+	":Param default_format: colormode tag assumed for legacy headers,\n"
+	"      which do not record one\n"
+	":rtype dict: header_version (0 for a legacy header), pixel_format,\n"
+	"      width, height, frames_stored, n_frames, refresh_per_frame,\n"
+	"      frames_per_second, header_size, the memory in bytes it\n"
+	"      takes once loaded, and the parameters it was built with,\n"
+	"      or None for raws and headers older than version 2"
+    },
+    {
+	"attach_grating", py_attachgrating, METH_VARARGS,
+	"Maps a grating file held in shared memory (tmpfs or hugetlbfs)\n"
+	"instead of copying it into private memory.\n"
+	":Param fb0: a framebuffer object returned from init()\n"
+	":Param filename: (string) the shared grating file\n"
+	":Param length: (int, optional) length in bytes of the grating\n"
+	"      itself, when the file is padded beyond it. Defaults to the\n"
+	"      length of the file.\n"
+	":rtype grating_data capsule: released with unload_grating()."
+    },
+    {
+	"attach_raw", py_attachraw, METH_VARARGS,
+	"As attach_grating, for raw files.\n"
+	":Param tile_map: (string or None, optional) a file holding the\n"
+	"      tile map returned by tile_map() for this raw, mapped\n"
+	"      instead of comparing every frame to build the map again\n"
+	":rtype raw_data capsule: released with unload_raw()."
+    },
+    {
+	"tile_map", py_tilemap, METH_VARARGS,
+	"The map of the tiles that change in each frame of a loaded raw,\n"
+	"for saving with a pooled raw and passing to attach_raw().\n"
+	":Param data: a raw_data capsule\n"
+	":rtype bytes: or None if the raw has no map"
+    },
     {   
         "unload_grating", py_unloadgrating, METH_VARARGS,
         "Unloads raw animation data, freeing the assosiated memory\n"
@@ -1476,11 +3729,37 @@ static PyMethodDef _rpigratings_methods[] = {
 	":Param fb0: an initialised framebuffer object\n"
 	":rtype None:"
     },  
+    {
+	"benchmark_copy", py_benchmarkcopy, METH_VARARGS,
+	"Times the per-frame copy loop used by the display functions.\n"
+	":Param width: frame width in pixels\n"
+	":Param height: frame height in pixels\n"
+	":Param colormode: colormode tag\n"
+	":Param n_frames: number of frames to copy\n"
+	":Param source_format: optional colormode tag the frames are\n"
+	"      stored in, GRAY8MODE to time palette expansion\n"
+	":rtype tuple: mean and standard deviation of the copy time in usecs"
+    },
     {   
 	"convertraw", py_convertraw, METH_VARARGS,
 	"fillertext\n"
 	":type None:"
     },
+    {
+	"convert_chunk", py_convertchunk, METH_VARARGS,
+	"Converts interleaved uint8 RGB pixels, as read by convertraw,\n"
+	"into a colormode.\n"
+	":Param rgb: bytes-like object, a whole number of pixels long\n"
+	":Param colormode: colormode tag to convert to\n"
+	":rtype bytes:"
+    },
+    {
+	"raw_header", py_rawheader, METH_VARARGS,
+	"Builds the header of a raw file.\n"
+	":Param width, height, frames_stored, n_frames, refresh_per_frame,\n"
+	"      colormode\n"
+	":rtype bytes:"
+    },
     {NULL, NULL, 0, NULL}
 };
 
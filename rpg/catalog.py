@@ -0,0 +1,200 @@
+"""
+A catalog of the gratings and raws in a directory.
+
+Loading a directory of stimuli reads every frame of every file, which
+can take minutes, and a file that does not fit the Screen, or a set
+too large for memory, would otherwise only be found once loading
+reached it.
+
+Every grating and raw records its resolution, pixel format, frame
+counts and (for gratings) the parameters it was built with in its
+header. The builders and converters also copy this into a small
+catalog file, CATALOG_NAME, in the file's directory, so a whole
+directory can be validated against a Screen, its memory use added up,
+and its files ordered, from one read of the catalog before any frame
+data is touched.
+
+Files are matched to their catalog entries by size and modification
+time. Files that were copied in, changed, or written by an older
+version of rpg are described from their header instead (a read of a
+few hundred bytes each), and the catalog is brought up to date if the
+directory is writable.
+
+Typical usage:
+  >>> entries = rpg.read_catalog("~/gratings")
+  >>> entries["90"]["parameters"]["angle"]
+  90.0
+"""
+import fcntl
+import json
+import os
+
+import _rpigratings as rpigratings
+
+CATALOG_NAME = ".rpg-catalog.json"
+CATALOG_VERSION = 1
+STIM_TYPES = {"grating": 1, "raw": 2}
+#Legacy headers do not record a pixel format, see describe()
+_DEFAULT_FORMAT = 0b0000
+
+
+def is_catalog_file(name):
+    """
+    Returns:
+      True if name is the catalog, or its temporary file, rather than
+      a stimulus
+    """
+    return name in (CATALOG_NAME, "." + CATALOG_NAME + ".tmp")
+
+
+def stimulus_files(directory):
+    """
+    Returns:
+      sorted list of the names of the files in directory, other than
+      the catalog
+    """
+    return sorted(name for name in os.listdir(directory) if not is_catalog_file(name))
+
+
+def describe(filename, kind, colormode=_DEFAULT_FORMAT):
+    """
+    Describe a grating or raw from its header, without reading its frames.
+
+    Args:
+      filename: path to the file
+      kind: "grating" or "raw"
+      colormode: colormode tag of the Screen the file is for. Only
+        used for files with legacy headers, which do not record the
+        pixel format their frames are stored in.
+
+    Returns:
+      catalog entry, a dictionary of kind, size, mtime_ns,
+      header_version, pixel_format, width, height, frames_stored,
+      n_frames, refresh_per_frame, frames_per_second, header_size,
+      memory (bytes once loaded) and parameters (those it was built
+      with, or None)
+    """
+    st = os.stat(filename)
+    entry = rpigratings.read_header(filename, STIM_TYPES[kind], colormode)
+    entry.update({"kind": kind, "size": st.st_size, "mtime_ns": st.st_mtime_ns})
+    return entry
+
+
+def _is_current(entry, st, kind):
+    """
+    Internal function testing whether a catalog entry still describes
+    the file with stat result st. Legacy entries depend on the colormode
+    they were described with, so are always described again.
+    """
+    return (entry.get("kind") == kind and entry.get("size") == st.st_size and
+            entry.get("mtime_ns") == st.st_mtime_ns and entry.get("header_version", 0) > 0)
+
+
+def _locked(directory):
+    """
+    Internal function returning an open, exclusively locked, descriptor
+    of directory. The catalog is only rewritten while it is held, and
+    locking the directory itself leaves no lock file behind in it.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def _read(directory):
+    try:
+        with open(os.path.join(directory, CATALOG_NAME)) as f:
+            catalog = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if catalog.get("version") != CATALOG_VERSION:
+        return {}
+    return catalog.get("entries", {})
+
+
+def _write(directory, entries):
+    tmp = os.path.join(directory, "." + CATALOG_NAME + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"version": CATALOG_VERSION, "entries": entries}, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(directory, CATALOG_NAME))
+
+
+def record(filename, kind):
+    """
+    Add or update the catalog entry for filename, in the catalog of the
+    directory it is in. Called by the builders and converters once a
+    file is complete. Directories that cannot be written to are left
+    without a catalog.
+
+    Args:
+      filename: path to the grating or raw
+      kind: "grating" or "raw"
+    """
+    filename = os.path.abspath(os.path.expanduser(filename))
+    directory, name = os.path.split(filename)
+    entry = describe(filename, kind)
+    try:
+        fd = _locked(directory)
+        try:
+            entries = _read(directory)
+            entries[name] = entry
+            _write(directory, entries)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def read_catalog(directory, kind="grating", colormode=_DEFAULT_FORMAT):
+    """
+    Describe every file in directory, from the catalog where its entry is
+    up to date and from the file's header where it is not.
+
+    Args:
+      directory: path to a directory of gratings or of raws
+      kind: "grating" or "raw", what the files are expected to be
+      colormode: colormode tag of the Screen, assumed for legacy headers
+
+    Returns:
+      dictionary of file name to catalog entry (see describe()), in
+      sorted file name order. Files that are not valid files of kind
+      have an entry holding only "error", the reason.
+    """
+    directory = os.path.expanduser(directory)
+    cached = _read(directory)
+    entries = {}
+    described = {}
+    for name in stimulus_files(directory):
+        path = os.path.join(directory, name)
+        st = os.stat(path)
+        entry = cached.get(name)
+        if entry is None or not _is_current(entry, st, kind):
+            try:
+                entry = describe(path, kind, colormode)
+            except (OSError, ValueError) as e:
+                entries[name] = {"error": str(e)}
+                continue
+            if entry["header_version"] > 0:
+                described[name] = entry
+        entries[name] = entry
+    stale = [name for name in cached if name not in entries or "error" in entries[name]]
+    if described or stale:
+        try:
+            fd = _locked(directory)
+            try:
+                #Read again under the lock and only change entries that are
+                #as first read, so that entries recorded in the meantime,
+                #e.g. by a builder writing into the directory, are kept
+                current = _read(directory)
+                for name, entry in described.items():
+                    if current.get(name) == cached.get(name):
+                        current[name] = entry
+                for name in stale:
+                    if current.get(name) == cached.get(name):
+                        del current[name]
+                _write(directory, current)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+    return entries
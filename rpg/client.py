@@ -0,0 +1,178 @@
+"""
+A client for the resident rpg stimulus server (see rpg.server).
+
+Typical usage:
+  >>> from rpg.client import Client
+  >>> with Client("/tmp/rpg.sock") as client:
+  ...     client.load("g0", "~/gratings/0")
+  ...     perf = client.display("g0")
+
+Requests can be pipelined, sending several before waiting for any of
+the responses:
+  >>> responses = client.pipeline([("load", {"name": "g0", "path": "~/gratings/0"}),
+  ...                              ("load", {"name": "g90", "path": "~/gratings/90"}),
+  ...                              ("schedule", {"names": ["g0", "g90"], "intertrial_time": 2})])
+"""
+import json
+import socket
+import time as t
+from collections import namedtuple
+
+from rpg.server import DEFAULT_SOCKET
+
+Response = namedtuple("Response", ["id", "ok", "result", "error", "latency_us", "round_trip_us"])
+
+
+class Client:
+    def __init__(self, address=DEFAULT_SOCKET, timeout=None):
+        """
+        Connect to a running rpg server.
+
+        Args:
+          address: the server's Unix socket path, or a (host, port) tuple
+            for a TCP server.
+          timeout: socket timeout in seconds, None to block indefinitely.
+            Displays block until the stimulus has played, so a timeout
+            should be longer than the longest stimulus.
+        """
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = tuple(address)
+        self._socket.settimeout(timeout)
+        self._socket.connect(address)
+        self._file = self._socket.makefile("rwb")
+        self._next_id = 0
+        self._sent = {}
+
+    def send(self, cmd, **args):
+        """
+        Send a request without waiting for its response.
+
+        Args:
+          cmd: command name, e.g. "load" or "display"
+          args: the command's arguments
+
+        Returns:
+          the id of the request, matching the id of its response
+        """
+        request_id = self._next_id
+        self._next_id += 1
+        request = dict(args, cmd=cmd, id=request_id)
+        self._file.write((json.dumps(request) + "\n").encode())
+        self._file.flush()
+        self._sent[request_id] = t.perf_counter()
+        return request_id
+
+    def receive(self):
+        """
+        Wait for the next response. Responses arrive in the order that
+        requests were sent.
+
+        Returns:
+          Response named tuple with fields id, ok, result, error,
+          latency_us (time spent in the server) and round_trip_us
+          (time since the request was sent by this client).
+        """
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("rpg server closed the connection")
+        response = json.loads(line.decode())
+        sent = self._sent.pop(response.get("id"), None)
+        round_trip = None if sent is None else (t.perf_counter() - sent) * 1e6
+        return Response(response.get("id"), response["ok"], response.get("result"),
+                        response.get("error"), response.get("latency_us"), round_trip)
+
+    def pipeline(self, requests):
+        """
+        Send several requests back to back, then collect their responses.
+
+        Args:
+          requests: iterable of (cmd, args_dict) pairs
+
+        Returns:
+          list of Response named tuples, in request order
+        """
+        ids = [self.send(cmd, **args) for cmd, args in requests]
+        return [self.receive() for _ in ids]
+
+    def request(self, cmd, **args):
+        """
+        Send a request and wait for its response.
+
+        Returns:
+          the command's result
+
+        Raises:
+          RuntimeError if the server reports that the command failed
+        """
+        self.send(cmd, **args)
+        response = self.receive()
+        if not response.ok:
+            raise RuntimeError(response.error)
+        return response.result
+
+    def load(self, name, path, kind="grating"):
+        """
+        Load a grating or raw file on the server under name.
+        """
+        return self.request("load", name=name, path=path, kind=kind)
+
+    def unload(self, name):
+        """
+        Release the stimulus loaded under name.
+        """
+        return self.request("unload", name=name)
+
+    def display(self, name, trigger_pin=0, contrast=None, background=None):
+        """
+        Display a loaded stimulus and wait for it to finish. contrast and
+        background may only be given for gratings built with colormode
+        "modulation", see Screen.display_grating().
+
+        Returns:
+          the performance record as a dictionary, or None if waiting for
+          the trigger was cancelled
+        """
+        args = {"name": name, "trigger_pin": trigger_pin}
+        if contrast is not None:
+            args["contrast"] = contrast
+        if background is not None:
+            args["background"] = background
+        return self.request("display", **args)
+
+    def schedule(self, names, intertrial_time=0, start_time=None):
+        """
+        Queue loaded stimuli for display, returning immediately.
+
+        Args:
+          names: list of stimulus names, displayed in order
+          intertrial_time: seconds of background between stimuli
+          start_time: unix time to start the first stimulus, None for now
+        """
+        return self.request("schedule", names=list(names), intertrial_time=intertrial_time,
+                            start_time=start_time)
+
+    def stats(self):
+        """
+        Returns:
+          dictionary of server statistics
+        """
+        return self.request("stats")
+
+    def shutdown(self):
+        """
+        Ask the server to stop.
+        """
+        return self.request("shutdown")
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
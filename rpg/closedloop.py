@@ -0,0 +1,128 @@
+"""
+Closed-loop stimulus parameters held in shared memory.
+
+Screen.display_closed_loop renders a grating afresh on every frame from
+the latest parameters in a ParameterBlock: its position, phase, contrast
+and orientation. Another thread, or another process opening the block by
+name, changes them during playback with update(), e.g. to make a patch
+follow the eye or its contrast follow running speed.
+
+The block is a small file on /dev/shm guarded by a seqlock, so neither
+side ever waits for the other: a write takes a few microseconds whatever
+the display is doing, and the display always picks up the most recent
+complete write at the start of each frame. There must only be one writer
+per block.
+
+Typical usage, with the writer in another process:
+  >>> params = rpg.ParameterBlock("gaze")
+  >>> with rpg.Screen() as screen:
+  ...     perf = screen.display_closed_loop(params, {"duration": 10, "spac_freq": 0.1,
+  ...                                                "percent_sigma": 5})
+
+  >>> params = rpg.ParameterBlock("gaze")    # in the eye tracking process
+  >>> params.update(x=eye_x, y=eye_y)
+"""
+import math
+import mmap
+import os
+
+import _rpigratings as rpigratings
+from rpg.pool import SHM_ROOT
+
+BLOCK_SIZE = mmap.PAGESIZE
+DEFAULTS = {"x": None, "y": None, "phase": 0, "contrast": 1, "orientation": 0}
+
+
+class ParameterBlock:
+    def __init__(self, name="rpg", root=SHM_ROOT, **initial):
+        """
+        Open, creating if necessary, the parameter block called name.
+        Every process opening a block with the same name and root shares
+        its parameters.
+
+        Args:
+          name: name of the block
+          root: directory the block is created in, defaults to /dev/shm
+          initial: starting values for any of x, y, phase, contrast and
+            orientation (see update()), used only if the block has never
+            been written to.
+        """
+        self.name = name
+        self.path = os.path.join(os.path.expanduser(root), "rpg-params-" + name)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < BLOCK_SIZE:
+                os.ftruncate(fd, BLOCK_SIZE)
+            self.buffer = mmap.mmap(fd, BLOCK_SIZE)
+        finally:
+            os.close(fd)
+        if self.update_id == 0:
+            self.update(**dict(DEFAULTS, **initial))
+
+    @property
+    def update_id(self):
+        """
+        The number of times the block has been written to.
+        """
+        return rpigratings.read_parameters(self.buffer)[0]
+
+    def read(self):
+        """
+        Returns:
+          dictionary of the current x, y, phase, contrast and orientation
+        """
+        values = rpigratings.read_parameters(self.buffer)[2:]
+        params = dict(zip(("x", "y", "phase", "contrast", "orientation"), values))
+        for key in ("x", "y"):
+            if math.isnan(params[key]):
+                params[key] = None
+        return params
+
+    def update(self, **params):
+        """
+        Change some or all of the parameters. Parameters not given keep
+        their current values. The display shows the change from the next
+        frame it starts rendering.
+
+        Args:
+          x, y: centre of the stimulus in pixels from the top left of the
+            Screen, or None for the centre of the Screen
+          phase: spatial phase of the grating in degrees, added to any
+            drift set by temp_freq
+          contrast: between 0 and 1
+          orientation: in degrees, as for options["angle"] when building
+            gratings
+
+        Returns:
+          the update id of this write
+        """
+        unknown = set(params) - set(DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown parameters %s, must be from %s" %(sorted(unknown), sorted(DEFAULTS)))
+        values = self.read()
+        values.update(params)
+        if values["contrast"] < 0 or values["contrast"] > 1:
+            raise ValueError("contrast must be between 0 and 1")
+        x = math.nan if values["x"] is None else values["x"]
+        y = math.nan if values["y"] is None else values["y"]
+        return rpigratings.write_parameters(self.buffer, x, y, values["phase"],
+                                            values["contrast"], values["orientation"])
+
+    def close(self):
+        """
+        Unmap the block. It stays in shared memory for other processes.
+        """
+        self.buffer.close()
+
+    def unlink(self):
+        """
+        Remove the block from shared memory. Processes that have it open
+        keep their mapping.
+        """
+        os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
@@ -0,0 +1,34 @@
+"""
+The rpg-ingest console script, converting a stream of raw RGB video
+frames into an rpg raw file with rpg.ingest_raw. For example:
+
+  $ ffmpeg -i movie.mp4 -f rawvideo -pix_fmt rgb24 -s 1280x720 - | rpg-ingest - ~/raws/movie.raw 1280 720 2
+"""
+import argparse
+
+import rpg
+
+
+def main(argv=None):
+    """
+    Entry point for the rpg-ingest console script.
+    """
+    parser = argparse.ArgumentParser(prog="rpg-ingest", description="Convert a stream of RGB frames into an rpg raw file")
+    parser.add_argument("source", help="file of interleaved uint8 RGB frames, or - for standard input")
+    parser.add_argument("new_filename", help="path of the raw file to write")
+    parser.add_argument("width", type=int, help="frame width in pixels")
+    parser.add_argument("height", type=int, help="frame height in pixels")
+    parser.add_argument("refreshes_per_frame", type=int, help="monitor refreshes to display each frame for")
+    parser.add_argument("--colormode", default=16, help="bits per pixel, 16, 24, 32 or gray (default 16)")
+    parser.add_argument("--n-frames", type=int, help="frames to display (default every frame read)")
+    parser.add_argument("--chunk-frames", type=int, default=8, help="frames converted at a time (default 8)")
+    args = parser.parse_args(argv)
+
+    colormode = int(args.colormode) if str(args.colormode).isdigit() else args.colormode
+    frames = rpg.ingest_raw(args.source, args.new_filename, args.width, args.height,
+                            args.refreshes_per_frame, colormode, args.n_frames, args.chunk_frames)
+    print("Converted %d frames into %s" %(frames, args.new_filename))
+
+
+if __name__ == "__main__":
+    main()
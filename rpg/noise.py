@@ -0,0 +1,135 @@
+"""
+Sparse noise and random checkerboards for receptive field mapping.
+
+A Noise stimulus stores no frames. Screen.display_noise generates each
+frame as it is displayed, from a seed and a few parameters, so thousands
+of frames cost no disc space, no memory and no load time. Every cell of
+every frame is a function of the seed, the frame number and the cell's
+position alone. The frames shown can be regenerated at any time, in any
+order, with Noise.frame(), which is pure Python and so also works on a
+machine without the rpg C module, e.g. for reverse correlation.
+
+Typical usage:
+  >>> noise = rpg.Noise(seed=1234, grid=(32, 18), density=0.05, hold=2, n_frames=3000)
+  >>> with rpg.Screen() as screen:
+  ...     perf = screen.display_noise(noise)
+  >>> first = noise.frame(0)    # later, for analysis
+"""
+SPARSE = 0
+CHECKERBOARD = 1
+POLARITIES = {"on": 1, "off": 2, "both": 3}
+
+_MASK = (1 << 64) - 1
+
+
+def _random(seed, counter):
+    """
+    Internal function computing the counter'th output of a splitmix64
+    generator started at seed, exactly as noise_random() in the C module.
+    """
+    z = (seed + (counter + 1) * 0x9E3779B97F4A7C15) & _MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+    return z ^ (z >> 31)
+
+
+class Noise:
+    def __init__(self, seed, grid=(16, 9), density=0.05, polarity="both", kind="sparse",
+                 hold=1, n_frames=600):
+        """
+        Describe a sparse noise or random checkerboard stimulus.
+
+        Args:
+          seed: integer from 0 to 2**64-1. The same seed and parameters
+            always give the same frames.
+          grid: (columns, rows) of cells. Cells are the largest whole
+            number of pixels that fits the grid onto the Screen, and the
+            grid is centred on it.
+          density: for sparse noise, the probability that a cell is lit
+            in any one frame. For a checkerboard, the probability that a
+            cell is white rather than black, usually 0.5.
+          polarity: for sparse noise, "on" (lit cells are white), "off"
+            (lit cells are black) or "both" (white or black with equal
+            probability). Unlit cells show the background.
+          kind: "sparse" or "checkerboard"
+          hold: refreshes each frame is shown for, e.g. 2 for 30 frames a
+            second on a 60 Hz monitor
+          n_frames: number of frames, the stimulus lasts n_frames * hold
+            refreshes
+        """
+        if kind not in ("sparse", "checkerboard"):
+            raise ValueError("kind must be 'sparse' or 'checkerboard', not %s" %kind.__repr__())
+        if polarity not in POLARITIES:
+            raise ValueError("polarity must be 'on', 'off' or 'both', not %s" %polarity.__repr__())
+        if seed < 0 or seed > _MASK:
+            raise ValueError("seed must be between 0 and 2**64-1")
+        if grid[0] < 1 or grid[1] < 1:
+            raise ValueError("grid must have at least one column and one row")
+        if density < 0 or density > 1:
+            raise ValueError("density must be between 0 and 1")
+        if hold < 1:
+            raise ValueError("hold must be at least 1")
+        if n_frames < 2:
+            raise ValueError("n_frames must be at least 2")
+        self.seed = seed
+        self.grid = (grid[0], grid[1])
+        self.density = density
+        self.polarity = polarity
+        self.kind = kind
+        self.hold = hold
+        self.n_frames = n_frames
+
+    def _args(self):
+        """
+        Internal function returning the parameters as passed to the C module.
+        """
+        return (self.seed, SPARSE if self.kind == "sparse" else CHECKERBOARD, POLARITIES[self.polarity],
+                self.grid[0], self.grid[1], self.density, self.hold, self.n_frames)
+
+    def parameters(self):
+        """
+        Returns:
+          dictionary of the parameters, which are all that is needed to
+          recreate the stimulus with Noise(**parameters)
+        """
+        return {"seed": self.seed, "grid": self.grid, "density": self.density, "polarity": self.polarity,
+                "kind": self.kind, "hold": self.hold, "n_frames": self.n_frames}
+
+    def frame(self, index):
+        """
+        Regenerate one frame exactly as it is displayed.
+
+        Args:
+          index: frame number, from 0 to n_frames - 1
+
+        Returns:
+          tuple of rows, top first, each a tuple of one value per cell,
+          left first: 1 for white, -1 for black and 0 for background
+        """
+        columns, rows = self.grid
+        n_cells = columns * rows
+        threshold = int(self.density * 16777216.0)
+        polarity = POLARITIES[self.polarity]
+        values = []
+        for cell in range(n_cells):
+            z = _random(self.seed, index * n_cells + cell)
+            lit = (z >> 40) < threshold
+            if self.kind == "checkerboard":
+                values.append(1 if lit else -1)
+            elif not lit:
+                values.append(0)
+            elif polarity == POLARITIES["both"]:
+                values.append(1 if z & 1 else -1)
+            else:
+                values.append(1 if polarity == POLARITIES["on"] else -1)
+        return tuple(tuple(values[row * columns:(row + 1) * columns]) for row in range(rows))
+
+    def frames(self):
+        """
+        Generator regenerating every frame in order, as frame() does.
+        """
+        for index in range(self.n_frames):
+            yield self.frame(index)
+
+    def __len__(self):
+        return self.n_frames
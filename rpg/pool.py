@@ -0,0 +1,303 @@
+"""
+A named stimulus pool held in shared memory.
+
+Screen.load_grating and Screen.load_raw copy every file into private
+memory, so each process pays the full load cost and two processes can
+never share a loaded stimulus. A StimulusPool instead keeps stimuli as
+files on a memory-backed filesystem (/dev/shm, or a hugetlbfs mount
+such as /dev/hugepages). Entries are named by the hash of their
+content, and Grating and Raw objects attach to an entry by mapping it,
+so attaching to an already-pooled stimulus takes milliseconds and
+every attached process shares the same physical pages. Entries outlive
+the processes that created them, until they are evicted or the machine
+reboots.
+
+A named /dev/shm directory is used rather than memfd, since a memfd
+can only be shared with processes that are handed its descriptor and
+does not survive the process that created it.
+
+Typical usage:
+  >>> pool = rpg.StimulusPool("orientations")
+  >>> with rpg.Screen() as screen:
+  ...     grating = screen.load_grating("~/gratings/0", pool=pool)
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+
+SHM_ROOT = "/dev/shm"
+HUGEPAGE_ROOT = "/dev/hugepages"
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def _hugepage_size():
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("Hugepagesize:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("Kernel does not report a huge page size")
+
+
+class StimulusPool:
+    def __init__(self, name="rpg", hugepages=False, root=None):
+        """
+        Open, creating if necessary, the stimulus pool called name.
+        Every process opening a pool with the same name and root
+        shares its entries.
+
+        Args:
+          name: name of the pool
+          hugepages: store entries on a hugetlbfs mount, which reduces
+            TLB pressure and page table setup when attaching large sets.
+            Huge pages must be reserved first, e.g. through
+            /proc/sys/vm/nr_hugepages.
+          root: directory the pool is created in. Defaults to /dev/shm,
+            or /dev/hugepages when hugepages is True.
+        """
+        if root is None:
+            root = HUGEPAGE_ROOT if hugepages else SHM_ROOT
+        self.name = name
+        self.hugepages = hugepages
+        self.path = os.path.join(os.path.expanduser(root), "rpg-pool-" + name)
+        # hugetlbfs only supports mapped files, so the index is kept on tmpfs
+        self._meta_path = os.path.join(SHM_ROOT, "rpg-pool-" + name + "-index") if hugepages else self.path
+        os.makedirs(self.path, exist_ok=True)
+        os.makedirs(self._meta_path, exist_ok=True)
+        self._block_size = _hugepage_size() if hugepages else mmap.PAGESIZE
+        self._refs = {}
+
+    def _entry_path(self, content_hash):
+        return os.path.join(self.path, content_hash)
+
+    def _tile_map_path(self, content_hash):
+        # Kept beside the index, since hugetlbfs only supports mapped files,
+        # and hidden so that entries() does not list it
+        return os.path.join(self._meta_path, "." + content_hash + ".tiles")
+
+    def _locked_index(self):
+        """
+        Internal function returning an open, exclusively locked, lock file.
+        The index is only read or written while this lock is held.
+        """
+        lock = open(os.path.join(self._meta_path, ".lock"), "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self._meta_path, "index.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_index(self, index):
+        tmp = os.path.join(self._meta_path, ".index.json")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self._meta_path, "index.json"))
+
+    @staticmethod
+    def _file_key(filename, st):
+        """
+        Internal function identifying a file on disc, with stat result
+        st, without reading it. A file that is rewritten gets a new key,
+        and so is hashed again.
+        """
+        return "%s:%d:%d:%d" %(os.path.realpath(filename), st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def add(self, filename):
+        """
+        Copy filename into the pool, unless an up to date copy is already
+        pooled. Files with identical content are only stored once.
+
+        Args:
+          filename: path to a grating or raw file
+
+        Returns:
+          the content hash naming the pool entry
+        """
+        lock = self._locked_index()
+        try:
+            return self._add(filename)[0]
+        finally:
+            lock.close()
+
+    def _add(self, filename):
+        """
+        Internal function implementing add(), called with the index locked.
+
+        Returns:
+          (content hash, length of the content in bytes). Entries are
+          padded out to a whole number of pages, so the length of the
+          entry file can be longer.
+        """
+        filename = os.path.expanduser(filename)
+        st = os.stat(filename)
+        key = self._file_key(filename, st)
+        index = self._read_index()
+        content_hash = index.get(key)
+        if content_hash is not None and os.path.exists(self._entry_path(content_hash)):
+            return content_hash, st.st_size
+        content_hash = self._copy_in(filename, st.st_size)
+        index[key] = content_hash
+        self._write_index(index)
+        return content_hash, st.st_size
+
+    def _copy_in(self, filename, size):
+        """
+        Internal function copying the first size bytes of filename into
+        a temporary pool file, through a shared mapping so that
+        hugetlbfs (which does not support write()) works too, then
+        renaming it to its content hash.
+        """
+        mapped_size = -(-size // self._block_size) * self._block_size
+        tmp = os.path.join(self.path, ".incoming-%d" %os.getpid())
+        digest = hashlib.blake2b(digest_size=20)
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, mapped_size)
+            with mmap.mmap(fd, mapped_size) as dest, open(filename, "rb") as src:
+                offset = 0
+                while offset < size:
+                    chunk = src.read(min(CHUNK_SIZE, size - offset))
+                    if not chunk:
+                        raise OSError("%s shrank while being pooled" %filename)
+                    dest[offset:offset + len(chunk)] = chunk
+                    digest.update(chunk)
+                    offset += len(chunk)
+        except BaseException:
+            os.close(fd)
+            os.unlink(tmp)
+            raise
+        os.close(fd)
+        content_hash = digest.hexdigest()
+        if os.path.exists(self._entry_path(content_hash)):
+            os.unlink(tmp)
+        else:
+            os.rename(tmp, self._entry_path(content_hash))
+        return content_hash
+
+    def acquire(self, filename):
+        """
+        Internal function used by Grating and Raw. Pools filename if
+        needed and takes a reference on its entry: a shared lock on the
+        entry file, which stops any process evicting it while attached.
+
+        Returns:
+          (path of pool entry, length of its content in bytes, content
+          hash, open file holding the lock)
+        """
+        lock = self._locked_index()
+        try:
+            content_hash, length = self._add(filename)
+            path = self._entry_path(content_hash)
+            holder = open(path, "rb")
+            fcntl.flock(holder, fcntl.LOCK_SH)
+        finally:
+            lock.close()
+        self._refs[content_hash] = self._refs.get(content_hash, 0) + 1
+        return path, length, content_hash, holder
+
+    def tile_map(self, content_hash):
+        """
+        Internal function used by Raw.
+
+        Returns:
+          path of the tile map saved with the entry by store_tile_map(),
+          or None if none has been saved
+        """
+        path = self._tile_map_path(content_hash)
+        return path if os.path.exists(path) else None
+
+    def store_tile_map(self, content_hash, tile_map):
+        """
+        Internal function used by Raw. Saves the tile map built when a
+        raw was first attached from the entry (see Screen.load_raw()),
+        so that later attachments, from any process, map it rather than
+        comparing every frame of the raw again.
+
+        Args:
+          content_hash: the entry's content hash
+          tile_map: bytes returned by rpigratings.tile_map()
+        """
+        path = self._tile_map_path(content_hash)
+        lock = self._locked_index()
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(tile_map)
+            os.replace(path + ".tmp", path)
+        finally:
+            lock.close()
+
+    def release(self, content_hash, holder):
+        """
+        Internal function dropping a reference taken with acquire().
+        """
+        holder.close()
+        self._refs[content_hash] -= 1
+        if self._refs[content_hash] == 0:
+            del self._refs[content_hash]
+
+    def refcount(self, content_hash):
+        """
+        Returns:
+          the number of Grating and Raw objects in this process that are
+          attached to the entry. Attachments from other processes are not
+          counted, but still block evict().
+        """
+        return self._refs.get(content_hash, 0)
+
+    def entries(self):
+        """
+        Returns:
+          dictionary of content hash to size in bytes, for every entry
+        """
+        return {name: os.path.getsize(self._entry_path(name))
+                for name in os.listdir(self.path)
+                if not name.startswith(".") and name != "index.json"}
+
+    def evict(self, content_hash):
+        """
+        Remove an entry from the pool, freeing its memory.
+
+        Args:
+          content_hash: as returned by add(), or a key of entries()
+
+        Returns:
+          None
+
+        Raises:
+          OSError if any process is still attached to the entry
+        """
+        path = self._entry_path(content_hash)
+        lock = self._locked_index()
+        try:
+            with open(path, "rb") as entry:
+                try:
+                    fcntl.flock(entry, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise OSError("Pool entry %s is still attached" %content_hash)
+                os.unlink(path)
+            if os.path.exists(self._tile_map_path(content_hash)):
+                os.unlink(self._tile_map_path(content_hash))
+            index = self._read_index()
+            self._write_index({key: value for key, value in index.items() if value != content_hash})
+        finally:
+            lock.close()
+
+    def clear(self):
+        """
+        Evict every entry that no process is attached to.
+
+        Returns:
+          list of the content hashes of entries left in the pool
+        """
+        remaining = []
+        for content_hash in self.entries():
+            try:
+                self.evict(content_hash)
+            except OSError:
+                remaining.append(content_hash)
+        return remaining
@@ -0,0 +1,341 @@
+"""
+A resident stimulus server for rpg.
+
+The server owns a single Screen for its whole lifetime, keeps loaded
+stimuli in memory between experiments, and accepts commands over a
+Unix domain socket (or a TCP socket bound to localhost). This avoids
+starting a fresh Python process, reloading every stimulus and
+reconfiguring the display with fbset for every experiment.
+
+The protocol is newline-delimited JSON. Each request is a single line
+holding an object with a "cmd" key, an optional "id" key that is
+echoed back, and the command's arguments:
+
+  {"id": 1, "cmd": "load", "name": "g0", "path": "~/gratings/0"}
+  {"id": 2, "cmd": "display", "name": "g0"}
+
+Every request gets exactly one response line, in the order the requests
+were received, so clients may pipeline many requests before reading any
+responses:
+
+  {"id": 1, "ok": true, "result": null, "latency_us": 812.0}
+  {"id": 2, "ok": true, "result": {...}, "latency_us": 2003145.5}
+
+latency_us is the time between the server reading the request and
+writing its response. Failed requests have "ok" set to false and an
+"error" string instead of "result".
+
+Commands:
+  load:     name, path, kind ("grating" or "raw", defaults to "grating")
+  unload:   name
+  display:  name, trigger_pin (defaults to 0), contrast and background
+            (modulation gratings only). Blocks until the stimulus has
+            played, then shows the background shade. The result is the
+            performance record as a dictionary.
+  schedule: names (list), intertrial_time (seconds, defaults to 0),
+            start_time (unix time, defaults to now). Queues the stimuli
+            on the display thread and returns immediately; performance
+            records appear in the "history" of the stats command.
+  stats:    No arguments. Returns loaded stimuli, queued displays, recent
+            performance records and the mean latency of each command.
+  shutdown: No arguments. Stops the server once the response is sent.
+
+Start a server from the terminal with the rpg console script:
+
+  $ rpg --socket /tmp/rpg.sock --resolution 1280x720
+
+and talk to it with rpg.client.Client.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time as t
+from collections import deque
+
+import rpg
+
+DEFAULT_SOCKET = "/tmp/rpg.sock"
+HISTORY_LENGTH = 1000
+
+
+class _ReusableTCPServer(socketserver.ThreadingTCPServer):
+    # Restarting on the same port should not wait out TIME_WAIT
+    allow_reuse_address = True
+
+
+def _remove_stale_socket(address):
+    """
+    Internal function removing a Unix socket left behind at address by a
+    server that is no longer running, so that a new server can bind it.
+
+    Raises:
+      OSError if a server is still listening at address, or address
+      is not a socket
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(address).st_mode):
+            raise OSError("%s exists and is not a socket" %address)
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(address)
+    except ConnectionRefusedError:
+        os.unlink(address)
+        return
+    except FileNotFoundError:
+        return
+    finally:
+        probe.close()
+    raise OSError("A server is already listening on %s" %address)
+
+
+class StimulusServer:
+    def __init__(self, screen, address=DEFAULT_SOCKET, logfile_name="rpglog.txt"):
+        """
+        A server that keeps stimuli resident and displays them on request.
+
+        Args:
+          screen: an open rpg.Screen instance. The server does not close it.
+          address: a filesystem path for a Unix domain socket, or a
+            (host, port) tuple for a TCP socket. TCP servers should be
+            bound to "127.0.0.1"; the protocol has no authentication.
+          logfile_name: Name of log file to write performance records to,
+            written into directory ~/rpg/logs/. Set to None to disable.
+
+        Raises:
+          OSError if another server is already listening on address. A
+          socket file left behind by a server that has exited is replaced.
+        """
+        self.screen = screen
+        self.address = address
+        self.logfile_name = logfile_name
+        self.stimuli = {}
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        self.pending = 0
+        self._latency = {}
+        self._lock = threading.Lock()
+        self._commands = {
+            "load": self._cmd_load,
+            "unload": self._cmd_unload,
+            "display": self._cmd_display,
+            "schedule": self._cmd_schedule,
+            "stats": self._cmd_stats,
+            "shutdown": self._cmd_shutdown,
+        }
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    response = server.handle_line(line)
+                    self.wfile.write(response)
+                    self.wfile.flush()
+
+        if isinstance(address, str):
+            _remove_stale_socket(address)
+            self._server = socketserver.ThreadingUnixStreamServer(address, Handler)
+        else:
+            self._server = _ReusableTCPServer(tuple(address), Handler)
+        self._server.daemon_threads = True
+
+    def serve_forever(self):
+        """
+        Handle requests until shutdown is requested by a client or
+        close() is called from another thread.
+
+        Returns:
+          None
+        """
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.unlink(self.address)
+
+    def close(self):
+        """
+        Stop serving and wait for queued displays to finish. Loaded
+        stimuli are released, the Screen is left open.
+
+        Returns:
+          None
+        """
+        self._server.shutdown()
+        self.screen._display_thread().submit(lambda: None).result()
+        with self._lock:
+            self.stimuli.clear()
+
+    def handle_line(self, line):
+        """
+        Execute a single request line and build its response line.
+
+        Args:
+          line: bytes holding one JSON encoded request.
+
+        Returns:
+          bytes holding one JSON encoded response, newline terminated.
+        """
+        received = t.perf_counter()
+        request_id = None
+        cmd = None
+        try:
+            request = json.loads(line.decode())
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            request_id = request.pop("id", None)
+            cmd = request.pop("cmd", None)
+            if cmd not in self._commands:
+                raise ValueError("Unknown command %s" %cmd.__repr__())
+            response = {"id": request_id, "ok": True, "result": self._commands[cmd](**request)}
+        except Exception as e:
+            response = {"id": request_id, "ok": False, "error": "%s: %s" %(type(e).__name__, e)}
+        latency = (t.perf_counter() - received) * 1e6
+        response["latency_us"] = latency
+        with self._lock:
+            count, total = self._latency.get(cmd, (0, 0.0))
+            self._latency[cmd] = (count + 1, total + latency)
+        return (json.dumps(response) + "\n").encode()
+
+    def _get(self, name):
+        with self._lock:
+            if name not in self.stimuli:
+                raise KeyError("No stimulus loaded as %s" %name.__repr__())
+            return self.stimuli[name]
+
+    def _cmd_load(self, name, path, kind="grating"):
+        path = os.path.expanduser(path)
+        if kind == "grating":
+            stimulus = self.screen.load_grating(path)
+        elif kind == "raw":
+            stimulus = self.screen.load_raw(path)
+        else:
+            raise ValueError("kind must be 'grating' or 'raw', not %s" %kind.__repr__())
+        with self._lock:
+            self.stimuli[name] = (kind, path, stimulus)
+        return None
+
+    def _cmd_unload(self, name):
+        with self._lock:
+            if name not in self.stimuli:
+                raise KeyError("No stimulus loaded as %s" %name.__repr__())
+            del self.stimuli[name]
+        return None
+
+    def _display(self, name, trigger_pin=0, start_time=None, contrast=None, background=None):
+        """
+        Runs on the Screen's display thread, so displays from every
+        connection are serialised.
+        """
+        kind, path, stimulus = self._get(name)
+        if start_time is not None:
+            delay = start_time - t.time()
+            if delay > 0:
+                t.sleep(delay)
+        if kind == "grating":
+            perf = self.screen.display_grating(stimulus, trigger_pin, contrast, background)
+        else:
+            perf = self.screen.display_raw(stimulus, trigger_pin)
+        self.screen.display_greyscale(self.screen.background)
+        if perf is None:
+            return None
+        record = dict(perf._asdict(), name=name, kind=kind)
+        with self._lock:
+            self.history.append(record)
+        if self.logfile_name is not None:
+            self.screen._print_log(self.logfile_name, kind.capitalize(), path, perf)
+        return record
+
+    def _scheduled(self, name, start_time):
+        try:
+            return self._display(name, 0, start_time)
+        except Exception as e:
+            with self._lock:
+                self.history.append({"name": name, "error": "%s: %s" %(type(e).__name__, e)})
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def _cmd_display(self, name, trigger_pin=0, contrast=None, background=None):
+        if trigger_pin == 1:
+            raise ValueError("trigger_pin cannot be set to 1. This pin is reserved for feedback")
+        kind = self._get(name)[0]
+        if kind != "grating" and (contrast is not None or background is not None):
+            raise ValueError("contrast and background can only be set for gratings")
+        return self.screen._display_thread().submit(self._display, name, trigger_pin, None,
+                                                    contrast, background).result()
+
+    def _cmd_schedule(self, names, intertrial_time=0, start_time=None):
+        for name in names:
+            self._get(name)
+        if start_time is None:
+            start_time = t.time()
+        executor = self.screen._display_thread()
+        with self._lock:
+            self.pending += len(names)
+        for n, name in enumerate(names):
+            # Only the first start is absolute, later starts are relative to
+            # the end of the preceding stimulus, as for display_gratings_randomly
+            executor.submit(self._scheduled, name, start_time if n == 0 else None)
+            if intertrial_time and n < len(names) - 1:
+                executor.submit(t.sleep, intertrial_time)
+        return {"queued": len(names)}
+
+    def _cmd_stats(self):
+        with self._lock:
+            return {
+                "loaded": {name: {"kind": kind, "path": path} for name, (kind, path, _) in self.stimuli.items()},
+                "pending": self.pending,
+                "displayed": len(self.history),
+                "history": list(self.history)[-20:],
+                "mean_latency_us": {cmd: total / count for cmd, (count, total) in self._latency.items()},
+            }
+
+    def _cmd_shutdown(self):
+        threading.Thread(target=self._server.shutdown, daemon=True).start()
+        return None
+
+
+def _parse_resolution(text):
+    width, height = text.lower().split("x")
+    return (int(width), int(height))
+
+
+def main(argv=None):
+    """
+    Entry point for the rpg console script.
+    """
+    parser = argparse.ArgumentParser(prog="rpg", description="Resident rpg stimulus server")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path (default %(default)s)")
+    group.add_argument("--port", type=int, help="serve on localhost TCP port instead of a Unix socket")
+    parser.add_argument("--resolution", type=_parse_resolution, default=(1280, 720), help="WIDTHxHEIGHT (default 1280x720)")
+    parser.add_argument("--background", type=int, default=127, help="background shade, 0 to 255 (default 127)")
+    parser.add_argument("--colormode", default=16, help="bits per pixel (default 16)")
+    parser.add_argument("--logfile", default="rpglog.txt", help="log file name within ~/rpg/logs/")
+    args = parser.parse_args(argv)
+
+    address = ("127.0.0.1", args.port) if args.port is not None else args.socket
+    colormode = int(args.colormode) if str(args.colormode).isdigit() else args.colormode
+    with rpg.Screen(args.resolution, args.background, colormode) as screen:
+        screen.display_greyscale(screen.background)
+        server = StimulusServer(screen, address, args.logfile)
+        print("rpg server listening on %s" %(address,))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        screen._display_thread().submit(lambda: None).result()
+        server.stimuli.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
-from distutils.core import setup, Extension
+from setuptools import setup, Extension
 from setuptools.command.install import install
 import os
 
@@ -77,5 +77,7 @@ setup(name='rpg',
       packages = ['rpg'],
       description='A drifting grating implimentation',
       ext_modules=[rpygrating_module],
+      entry_points={'console_scripts': ['rpg = rpg.server:main',
+                                      'rpg-ingest = rpg.ingest:main']},
       cmdclass={'install': InstallWrapper}
 )
@@ -0,0 +1,87 @@
+"""
+A stand-in for the compiled _rpigratings extension, so that rpg, the
+real Screen included, can be tested on a machine without a Raspberry
+Pi, a framebuffer or wiringPi. Importing this module installs it as
+_rpigratings, so it must be imported before rpg.
+
+Nothing is drawn. Every call that would reach the framebuffer is
+recorded in calls, as (function name, file of the stimulus or None,
+remaining arguments), and displays return a performance record at once.
+Stimuli are stored as RGB565 unless their file is given another pixel
+format in pixel_formats.
+"""
+import sys
+
+PERFORMANCE = (16667.0, 10.0, 0)
+calls = []
+pixel_formats = {}
+
+
+class Capsule:
+    """
+    Stands in for the PyCapsule objects the extension returns.
+    """
+    def __init__(self, kind, filename=None):
+        self.kind = kind
+        self.filename = filename
+
+
+def _record(name, stimulus, *args):
+    calls.append((name, None if stimulus is None else stimulus.filename, args))
+
+
+def init(width, height, colormode):
+    return Capsule("framebuffer")
+
+
+def close_display(fb0):
+    _record("close_display", None)
+
+
+def load_grating(fb0, filename):
+    return Capsule("grating_data", filename)
+
+
+def load_raw(fb0, filename):
+    return Capsule("raw_data", filename)
+
+
+def stimulus_properties(stimulus):
+    return {"pixel_format": pixel_formats.get(stimulus.filename, 0), "width": 1280,
+            "height": 720, "frames_stored": 60, "n_frames": 60, "refresh_per_frame": 1,
+            "frames_per_second": 60, "scale": 1,
+            "changed_fraction": 1.0}
+
+
+def unload_grating(grating):
+    pass
+
+
+def unload_raw(raw):
+    pass
+
+
+def display_grating(fb0, grating, *args):
+    _record("display_grating", grating, *args)
+    return PERFORMANCE
+
+
+def display_raw(fb0, raw, *args):
+    _record("display_raw", raw, *args)
+    return PERFORMANCE
+
+
+def display_color(fb0, *args):
+    _record("display_color", None, *args)
+
+
+def set_realtime(priority, cpu):
+    _record("set_realtime", None, priority, cpu)
+    return (0, 0, None)
+
+
+def clear_realtime(old_policy, old_priority, old_affinity):
+    _record("clear_realtime", None, old_policy, old_priority)
+
+
+sys.modules["_rpigratings"] = sys.modules[__name__]
@@ -0,0 +1,48 @@
+"""
+Tests of the compiled _rpigratings extension itself, skipped where it
+has not been built. Calls that need a framebuffer are made with None in
+its place, which fails only once the arguments have been parsed.
+"""
+import importlib.machinery
+import importlib.util
+import unittest
+
+
+def _load_extension():
+    """
+    The compiled extension, or None if it is not built. Loaded afresh,
+    since the other tests install extension_stub in its place.
+    """
+    spec = importlib.machinery.PathFinder.find_spec("_rpigratings")
+    if spec is None:
+        return None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+rpigratings = _load_extension()
+
+
+@unittest.skipIf(rpigratings is None, "the _rpigratings extension is not built")
+class ExtensionTest(unittest.TestCase):
+    def assertParses(self, func, *args):
+        """
+        Calling func with args gets past argument parsing, to the check
+        of the framebuffer capsule
+        """
+        with self.assertRaisesRegex(ValueError, "PyCapsule"):
+            func(*args)
+
+    def test_display_closed_loop_parses_its_arguments(self):
+        params = bytearray(4096)
+        #duration, spac_freq, temp_freq, waveform, percent_diameter,
+        #percent_sigma, trigger_pin, background and then gamma
+        self.assertParses(rpigratings.display_closed_loop, None, params, 1.0, 0.1, 1.0, 1,
+                          20.0, 0.0, 0, 127)
+        self.assertParses(rpigratings.display_closed_loop, None, params, 1.0, 0.1, 1.0, 1,
+                          20.0, 0.0, 0, 127, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
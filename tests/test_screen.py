@@ -0,0 +1,50 @@
+"""
+Tests of the Screen's display thread and real-time mode, with the
+extension stubbed out (see extension_stub.py).
+"""
+import asyncio
+import threading
+import unittest
+
+import extension_stub
+import rpg
+
+
+class DisplayThreadTest(unittest.TestCase):
+    def setUp(self):
+        extension_stub.calls.clear()
+        self.screen = rpg.Screen()
+
+    def tearDown(self):
+        self.screen.close()
+
+    def called(self):
+        return [name for name, _, _ in extension_stub.calls]
+
+    def test_realtime_displays_run_on_the_display_thread(self):
+        self.screen.enable_realtime(priority=10)
+        threads = []
+        self.screen._on_display_thread(lambda: threads.append(threading.get_ident()))
+        self.assertEqual(threads, [self.screen._display_thread_id])
+        self.assertNotEqual(threads[0], threading.get_ident())
+        self.screen.disable_realtime()
+        self.assertEqual(self.called(), ["set_realtime", "clear_realtime"])
+
+    def test_close_on_the_display_thread_does_not_deadlock(self):
+        for realtime in (False, True):
+            with self.subTest(realtime=realtime):
+                extension_stub.calls.clear()
+                screen = rpg.Screen()
+                if realtime:
+                    screen.enable_realtime()
+                #An out of range colour closes the Screen from the display thread
+                with self.assertRaises(ValueError):
+                    asyncio.run(asyncio.wait_for(screen.display_greyscale_async(300), 10))
+                self.assertFalse(screen.isopen)
+                self.assertIsNone(screen.realtime)
+                self.assertIn("close_display", self.called())
+                self.assertEqual("clear_realtime" in self.called(), realtime)
+
+
+if __name__ == "__main__":
+    unittest.main()
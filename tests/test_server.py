@@ -0,0 +1,172 @@
+"""
+Tests of the resident stimulus server and its client. Each test serves
+a real Screen, with the extension stubbed out (see extension_stub.py),
+over a temporary Unix socket.
+"""
+import os
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+
+import extension_stub
+import rpg
+from rpg.client import Client
+from rpg.server import StimulusServer
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        extension_stub.calls.clear()
+        extension_stub.pixel_formats.clear()
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, "rpg.sock")
+        self.screen = rpg.Screen()
+        self.server = StimulusServer(self.screen, self.address, logfile_name=None)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = Client(self.address, timeout=10)
+
+    def tearDown(self):
+        self.client.close()
+        if self.thread.is_alive():
+            self.server.close()
+            self.thread.join(10)
+        self.screen.close()
+        shutil.rmtree(self.directory)
+
+    def load_both(self):
+        self.client.load("g0", "~/gratings/0")
+        self.client.load("movie", "/raws/movie", kind="raw")
+
+    def displayed(self):
+        """
+        (function, file, trigger pin) of every stimulus the extension was
+        asked to display
+        """
+        return [(name, filename, args[0]) for name, filename, args in extension_stub.calls
+                if name in ("display_grating", "display_raw")]
+
+    def test_pipelined_responses_are_in_order_and_echo_ids(self):
+        requests = [("load", {"name": "g0", "path": "/gratings/0"}),
+                    ("load", {"name": "g90", "path": "/gratings/90"}),
+                    ("nonsense", {}),
+                    ("display", {"name": "g90"}),
+                    ("stats", {})]
+        ids = [self.client.send(cmd, **args) for cmd, args in requests]
+        responses = [self.client.receive() for _ in ids]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual([response.id for response in responses], ids)
+        self.assertEqual([response.ok for response in responses], [True, True, False, True, True])
+        self.assertEqual(responses[3].result["name"], "g90")
+        self.assertEqual(sorted(responses[4].result["loaded"]), ["g0", "g90"])
+
+    def test_every_response_has_latency(self):
+        responses = self.client.pipeline([("stats", {}), ("unload", {"name": "missing"}),
+                                          ("load", {"name": "g0", "path": "/gratings/0"})])
+        for response in responses:
+            self.assertIsInstance(response.latency_us, float)
+            self.assertGreaterEqual(response.latency_us, 0)
+            self.assertIsNotNone(response.round_trip_us)
+
+    def test_load_display_unload(self):
+        self.load_both()
+        record = self.client.display("g0", trigger_pin=6)
+        self.assertEqual(record["name"], "g0")
+        self.assertEqual(record["kind"], "grating")
+        self.assertEqual(record["mean_interframe"], extension_stub.PERFORMANCE[0])
+        self.client.display("movie")
+        self.assertEqual(self.displayed(), [("display_grating", os.path.expanduser("~/gratings/0"), 6),
+                                            ("display_raw", "/raws/movie", 0)])
+        #The background is shown once each stimulus has played
+        self.assertEqual(extension_stub.calls[-1][0], "display_color")
+        self.client.unload("g0")
+        self.assertEqual(list(self.client.stats()["loaded"]), ["movie"])
+
+    def test_display_passes_contrast_and_background_to_modulation_gratings(self):
+        extension_stub.pixel_formats["/gratings/modulated"] = rpg.MOD8MODE
+        self.client.load("modulated", "/gratings/modulated")
+        self.client.display("modulated", contrast=0.25, background=100)
+        self.client.display("modulated")
+        calls = [args for name, _, args in extension_stub.calls if name == "display_grating"]
+        self.assertEqual([args[1:3] for args in calls], [(0.25, 100), (1, self.screen.background)])
+
+    def test_schedule_queues_and_records_history(self):
+        self.load_both()
+        self.assertEqual(self.client.schedule(["g0", "movie", "g0"], intertrial_time=0.01), {"queued": 3})
+        deadline = time.time() + 10
+        while self.client.stats()["pending"] and time.time() < deadline:
+            time.sleep(0.01)
+        stats = self.client.stats()
+        self.assertEqual(stats["pending"], 0)
+        self.assertEqual(stats["displayed"], 3)
+        self.assertEqual([record["name"] for record in stats["history"]], ["g0", "movie", "g0"])
+        self.assertEqual([name for name, _, _ in self.displayed()],
+                         ["display_grating", "display_raw", "display_grating"])
+        self.assertIn("schedule", stats["mean_latency_us"])
+
+    def test_errors(self):
+        self.load_both()
+        failures = {
+            "unknown command": ("nonsense", {}),
+            "unknown name": ("display", {"name": "missing"}),
+            "feedback pin": ("display", {"name": "g0", "trigger_pin": 1}),
+            "contrast on a raw": ("display", {"name": "movie", "contrast": 0.5}),
+            "contrast on a stored grating": ("display", {"name": "g0", "contrast": 0.5}),
+            "unknown kind": ("load", {"name": "x", "path": "/x", "kind": "video"}),
+            "schedule unknown name": ("schedule", {"names": ["g0", "missing"]}),
+        }
+        for label, (cmd, args) in failures.items():
+            self.client.send(cmd, **args)
+            response = self.client.receive()
+            self.assertFalse(response.ok, label)
+            self.assertIsNone(response.result, label)
+            self.assertTrue(response.error, label)
+            self.assertIsNotNone(response.latency_us, label)
+        with self.assertRaises(RuntimeError):
+            self.client.display("missing")
+        self.assertEqual(self.displayed(), [])
+        self.assertEqual(self.client.stats()["pending"], 0)
+
+    def test_refuses_a_socket_another_server_is_listening_on(self):
+        with self.assertRaises(OSError):
+            StimulusServer(self.screen, self.address, logfile_name=None)
+        self.assertTrue(os.path.exists(self.address))
+        self.assertEqual(self.client.stats()["pending"], 0)
+
+    def test_replaces_a_stale_socket(self):
+        stale = os.path.join(self.directory, "stale.sock")
+        left_behind = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        left_behind.bind(stale)
+        left_behind.close()
+        server = StimulusServer(self.screen, stale, logfile_name=None)
+        server._server.server_close()
+
+    def test_refuses_a_path_that_is_not_a_socket(self):
+        path = os.path.join(self.directory, "file")
+        with open(path, "w") as f:
+            f.write("not a socket")
+        with self.assertRaises(OSError):
+            StimulusServer(self.screen, path, logfile_name=None)
+        self.assertTrue(os.path.exists(path))
+
+    def test_tcp_reuse_address_is_not_set_process_wide(self):
+        server = StimulusServer(self.screen, ("127.0.0.1", 0), logfile_name=None)
+        try:
+            self.assertTrue(server._server.allow_reuse_address)
+            self.assertFalse(socketserver.ThreadingTCPServer.allow_reuse_address)
+        finally:
+            server._server.server_close()
+
+    def test_shutdown(self):
+        self.assertIsNone(self.client.shutdown())
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.address))
+
+
+if __name__ == "__main__":
+    unittest.main()